@@ -0,0 +1,208 @@
+#!bin/python
+
+"""
+This file contains the ASGI entry point of TorPaste, for running it under an
+asyncio server such as Uvicorn or Hypercorn instead of Gunicorn:
+
+    uvicorn asgi:app
+
+The Flask application and the backends stay synchronous. Every request is
+handled in a thread of a pool shared by the whole process, while the event
+loop only moves request and response bodies between the server and these
+threads. A backend call that waits on the network therefore only holds a
+thread, not a whole worker process, so a single process can have as many
+backend requests in flight as there are threads in the pool.
+
+Request bodies are handed to the application while they are received, and
+response bodies are sent while they are produced, so uploads and raw pastes
+are streamed in this mode too.
+"""
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+
+from werkzeug.wsgi import FileWrapper
+
+from backends.utils import STREAM_CHUNK_SIZE
+from torpaste import app as wsgi_app
+
+
+class _RequestBody(object):
+    """
+    The wsgi.input of a request, which receives the request body from the
+    event loop as the application reads it.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b""
+        self._more = True
+
+    def _fill(self, size):
+        while self._more and (size < 0 or len(self._buffer) < size):
+            message = asyncio.run_coroutine_threadsafe(
+                self._receive(), self._loop).result()
+            if message["type"] == "http.disconnect":
+                self._more = False
+                break
+            self._buffer += message.get("body", b"")
+            self._more = message.get("more_body", False)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while b"\n" not in self._buffer and self._more and \
+                (size < 0 or len(self._buffer) < size):
+            self._fill(len(self._buffer) + 1)
+
+        end = self._buffer.find(b"\n") + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+def _file_wrapper(file, block_size=STREAM_CHUNK_SIZE):
+    # Every part of the body is a round trip to the event loop, so files are
+    # sent in larger parts than usual
+    return FileWrapper(file, max(block_size, STREAM_CHUNK_SIZE))
+
+
+class WsgiBridge(object):
+    """
+    An ASGI application that runs a WSGI application in a thread pool.
+    """
+
+    def __init__(self, application, threads):
+        self._application = application
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="torpaste")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        loop = asyncio.get_running_loop()
+        environ = self._environ(scope, _RequestBody(receive, loop))
+
+        await loop.run_in_executor(
+            self._executor, self._run, environ, send, loop)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _environ(self, scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode(
+                "utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.input_terminated": True,
+            "wsgi.file_wrapper": _file_wrapper,
+        }
+
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                name = "HTTP_" + name
+            if name in environ:
+                value = environ[name] + "," + value
+            environ[name] = value
+
+        return environ
+
+    def _run(self, environ, send, loop):
+        """
+        Runs the WSGI application for a request, in a thread of the pool,
+        and sends its response through the event loop.
+        """
+
+        def call(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["start"] = {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+
+        def send_start():
+            if not response.get("sent"):
+                call(response["start"])
+                response["sent"] = True
+
+        result = self._application(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    send_start()
+                    call({
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    })
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        send_start()
+        call({"type": "http.response.body", "body": b""})
+
+
+# The number of requests each process handles at the same time
+THREADS = getenv("TP_ASGI_THREADS") or "100"
+
+try:
+    THREADS = int(THREADS)
+except ValueError:
+    print("Invalid TP_ASGI_THREADS: " + THREADS)
+    exit(1)
+
+app = WsgiBridge(wsgi_app, THREADS)
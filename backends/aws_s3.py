@@ -1,81 +1,357 @@
+from concurrent.futures import ThreadPoolExecutor
 from os import getenv
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+# the application catches backend errors through this module attribute
+from backends import exceptions as e  # noqa: F401
+from backends.utils import EXPIRY_INDEX_PREFIX
+from backends.utils import RECENT_INDEX_PREFIX
+from backends.utils import STREAM_CHUNK_SIZE
+from backends.utils import expiry_index_key
 from backends.utils import filters_match
+from backends.utils import getenv_int
 from backends.utils import getenv_required
+from backends.utils import is_index_key
+from backends.utils import parse_expiry_index_key
+from backends.utils import parse_recent_index_key
+from backends.utils import recent_index_key
 from backends.utils import wrap_exception
 
 _ENV_ACCESS_KEY_ID = 'TP_BACKEND_AWS_S3_ACCESS_KEY_ID'
 _ENV_SECRET_ACCESS_KEY = 'TP_BACKEND_AWS_S3_SECRET_ACCESS_KEY'
 _ENV_BUCKET = 'TP_BACKEND_AWS_S3_BUCKET'
+_ENV_ENDPOINT_URL = 'TP_BACKEND_AWS_S3_ENDPOINT_URL'
+_ENV_METADATA_THREADS = 'TP_BACKEND_AWS_S3_METADATA_THREADS'
+_ENV_POOL_SIZE = 'TP_BACKEND_AWS_S3_POOL_SIZE'
+_ENV_TIMEOUT = 'TP_BACKEND_AWS_S3_TIMEOUT_SECONDS'
+_ENV_MAX_ATTEMPTS = 'TP_BACKEND_AWS_S3_MAX_ATTEMPTS'
 
 _DEFAULT_BUCKET = 'torpaste'
+_DEFAULT_METADATA_THREADS = 10
+_DEFAULT_POOL_SIZE = 50
+_DEFAULT_TIMEOUT = 10
+_DEFAULT_MAX_ATTEMPTS = 5
 
-_s3 = None
+# Metadata keys whose values are part of the index keys, so that the listing
+# can be filtered on them without loading every paste's metadata
+_INDEXED_KEYS = ['visibility']
+
+# Marks that the date index has been built for the pastes stored before it,
+# and holds the last of them that was added until then
+_INDEX_BUILT_KEY = 'index/recent.built'
+_INDEX_PROGRESS_KEY = 'index/recent.progress'
+
+# A single client is shared by all the threads of the process, since unlike
+# resource objects clients are thread safe
+_client = None
 _bucket = None
 
+# Fetches the metadata of many pastes at once when listing them
+_metadata_executor = None  # type: ThreadPoolExecutor
+
+# Only ever set once the date index is known to be built
+_recent_index_built = False
+
 _wrap_aws_exception = wrap_exception(
     ClientError,
     'Error while communicating with AWS S3')
 
 
+def _is_missing(ex):
+    return ex.response['Error']['Code'] in ('404', 'NoSuchKey')
+
+
 @_wrap_aws_exception
 def initialize_backend():
-    global _s3
+    global _client
     global _bucket
+    global _metadata_executor
+
+    timeout = getenv_int(_ENV_TIMEOUT, _DEFAULT_TIMEOUT)
 
-    _s3 = boto3.resource(
+    _client = boto3.client(
         's3',
         aws_access_key_id=getenv_required(_ENV_ACCESS_KEY_ID),
-        aws_secret_access_key=getenv_required(_ENV_SECRET_ACCESS_KEY))
+        aws_secret_access_key=getenv_required(_ENV_SECRET_ACCESS_KEY),
+        # Another S3 compatible service, such as a local one for testing
+        endpoint_url=getenv(_ENV_ENDPOINT_URL) or None,
+        config=Config(
+            max_pool_connections=getenv_int(
+                _ENV_POOL_SIZE, _DEFAULT_POOL_SIZE),
+            connect_timeout=timeout,
+            read_timeout=timeout,
+            retries={
+                'max_attempts': getenv_int(
+                    _ENV_MAX_ATTEMPTS, _DEFAULT_MAX_ATTEMPTS),
+                'mode': 'adaptive',
+            }))
 
     _bucket = getenv(_ENV_BUCKET, _DEFAULT_BUCKET)
-    _s3.create_bucket(Bucket=_bucket)
+    try:
+        _client.create_bucket(Bucket=_bucket)
+    except ClientError as ex:
+        if ex.response['Error']['Code'] != 'BucketAlreadyOwnedByYou':
+            raise
+
+    _metadata_executor = ThreadPoolExecutor(
+        max_workers=getenv_int(
+            _ENV_METADATA_THREADS, _DEFAULT_METADATA_THREADS))
+
+    # The pastes of a new bucket are all added to the date index as they
+    # are created, while the others are added by build_index.py
+    if not _is_recent_index_built() and \
+            'Contents' not in _client.list_objects_v2(
+                Bucket=_bucket, MaxKeys=1):
+        _client.put_object(Bucket=_bucket, Key=_INDEX_BUILT_KEY, Body=b'')
+
+
+def _is_recent_index_built():
+    global _recent_index_built
+
+    if not _recent_index_built:
+        _recent_index_built = \
+            _get_object_text(_INDEX_BUILT_KEY) is not None
+    return _recent_index_built
+
+
+def _get_object_text(key):
+    try:
+        response = _client.get_object(Bucket=_bucket, Key=key)
+    except ClientError as ex:
+        if not _is_missing(ex):
+            raise
+        return None
+
+    return response['Body'].read().decode('utf-8')
+
+
+@_wrap_aws_exception
+def build_recent_index(limit):
+    """
+    Adds the next pastes stored before the date index existed to it, after
+    the ones added by the previous calls. This is done by build_index.py,
+    instead of when the backend starts, since it lists the whole bucket.
+    :param limit: the maximum number of pastes to add
+    :return: the number of pastes added, and True if none is left
+    """
+    if _is_recent_index_built():
+        return 0, True
+
+    kwargs = {'Bucket': _bucket, 'MaxKeys': min(limit, 1000)}
+    start_after = _get_object_text(_INDEX_PROGRESS_KEY)
+    if start_after is not None:
+        kwargs['StartAfter'] = start_after
+
+    response = _client.list_objects_v2(**kwargs)
+    keys = [obj['Key'] for obj in response.get('Contents', [])]
+
+    # Paste IDs are hexadecimal, so they all sort before the index objects
+    paste_ids = [key for key in keys if not is_index_key(key)]
+    for paste_id, metadata in zip(
+            paste_ids, _get_many_paste_metadata(paste_ids)):
+        if metadata is None:
+            continue
+        for key in _index_keys(paste_id, metadata):
+            _put_index_key(key)
+
+    if response.get('IsTruncated') and len(paste_ids) == len(keys):
+        _client.put_object(
+            Bucket=_bucket, Key=_INDEX_PROGRESS_KEY,
+            Body=keys[-1].encode('utf-8'))
+        return len(paste_ids), False
+
+    _client.put_object(Bucket=_bucket, Key=_INDEX_BUILT_KEY, Body=b'')
+    _client.delete_object(Bucket=_bucket, Key=_INDEX_PROGRESS_KEY)
+    return len(paste_ids), True
+
+
+def _index_keys(paste_id, metadata):
+    """
+    Returns the keys of all the index objects of a paste with the given
+    metadata.
+    """
+    keys = [
+        recent_index_key(paste_id, metadata, _INDEXED_KEYS),
+        expiry_index_key(paste_id, metadata),
+    ]
+    return [key for key in keys if key is not None]
+
+
+def _put_index_key(key):
+    _client.put_object(Bucket=_bucket, Key=key, Body=b'')
 
 
 @_wrap_aws_exception
 def new_paste(paste_id, paste_content):
-    _s3.Bucket(_bucket).put_object(
+    _client.put_object(
+        Bucket=_bucket,
+        Key=paste_id,
+        Body=paste_content.encode('utf-8'))
+
+
+@_wrap_aws_exception
+def new_paste_stream(paste_id, paste_stream):
+    # Large pastes are uploaded in parts
+    _client.upload_fileobj(paste_stream, _bucket, paste_id)
+
+
+@_wrap_aws_exception
+def create_paste(paste_id, paste_content, metadata):
+    # The metadata is written along with the content, instead of with a
+    # copy of the object afterwards
+    _client.put_object(
+        Bucket=_bucket,
+        Key=paste_id,
         Body=paste_content.encode('utf-8'),
-        Key=paste_id)
+        Metadata=metadata)
+
+    for key in _index_keys(paste_id, metadata):
+        _put_index_key(key)
+
+
+@_wrap_aws_exception
+def create_paste_stream(paste_id, paste_stream, metadata):
+    _client.upload_fileobj(
+        paste_stream, _bucket, paste_id,
+        ExtraArgs={'Metadata': metadata})
+
+    for key in _index_keys(paste_id, metadata):
+        _put_index_key(key)
 
 
 @_wrap_aws_exception
 def update_paste_metadata(paste_id, metadata):
-    obj = _s3.Object(_bucket, paste_id)
-    obj.metadata.clear()
-    obj.metadata.update(metadata)
-    obj.copy_from(CopySource={'Bucket': _bucket, 'Key': paste_id},
-                  Metadata=obj.metadata,
-                  MetadataDirective='REPLACE')
+    old_metadata = _client.head_object(
+        Bucket=_bucket, Key=paste_id)['Metadata']
+
+    _client.copy_object(
+        Bucket=_bucket,
+        Key=paste_id,
+        CopySource={'Bucket': _bucket, 'Key': paste_id},
+        Metadata=metadata,
+        MetadataDirective='REPLACE')
+
+    old_keys = _index_keys(paste_id, old_metadata)
+    new_keys = _index_keys(paste_id, metadata)
+    for key in new_keys:
+        if key not in old_keys:
+            _put_index_key(key)
+    for key in old_keys:
+        if key not in new_keys:
+            _client.delete_object(Bucket=_bucket, Key=key)
+
+
+@_wrap_aws_exception
+def get_expired_paste_ids(now, limit):
+    # The expiry index lists the pastes that expire first first, so only
+    # its start is ever listed
+    response = _client.list_objects_v2(
+        Bucket=_bucket,
+        Prefix=EXPIRY_INDEX_PREFIX,
+        MaxKeys=min(limit, 1000))
+
+    paste_ids = []
+    for obj in response.get('Contents', []):
+        expires, paste_id = parse_expiry_index_key(obj['Key'])
+        if expires > now:
+            break
+        paste_ids.append(paste_id)
+
+    return paste_ids
+
+
+@_wrap_aws_exception
+def delete_paste(paste_id):
+    metadata = _head_paste_metadata(paste_id)
+    if metadata is None:
+        # An interrupted deletion may have left the paste in the expiry
+        # index, among the pastes that have expired, which are listed first
+        response = _client.list_objects_v2(
+            Bucket=_bucket, Prefix=EXPIRY_INDEX_PREFIX)
+        _delete_keys([
+            obj['Key'] for obj in response.get('Contents', [])
+            if parse_expiry_index_key(obj['Key'])[1] == paste_id
+        ])
+        return
+
+    # The expiry index object goes last, so that a paste is never left
+    # without the object the reaper finds it by
+    expiry_key = expiry_index_key(paste_id, metadata)
+    _delete_keys([paste_id] + [
+        key for key in _index_keys(paste_id, metadata) if key != expiry_key])
+    if expiry_key is not None:
+        _delete_keys([expiry_key])
+
+
+def _delete_keys(keys):
+    if not keys:
+        return
+
+    response = _client.delete_objects(
+        Bucket=_bucket,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+
+    # Quiet deletions only report the objects that could not be deleted
+    for error in response.get('Errors', []):
+        raise ClientError({'Error': error}, 'DeleteObjects')
 
 
 @_wrap_aws_exception
 def does_paste_exist(paste_id):
     try:
-        _s3.Object(_bucket, paste_id).load()
+        _client.head_object(Bucket=_bucket, Key=paste_id)
     except ClientError as ex:
-        if ex.response['Error']['Code'] != '404':
+        if not _is_missing(ex):
             raise
-        else:
-            return False
-    else:
-        return True
+        return False
+
+    return True
 
 
 @_wrap_aws_exception
 def get_paste_contents(paste_id):
-    body = _s3.Object(_bucket, paste_id).get()['Body'].read()
-    return body.decode('utf-8')
+    response = _client.get_object(Bucket=_bucket, Key=paste_id)
+    return response['Body'].read().decode('utf-8')
+
+
+@_wrap_aws_exception
+def get_paste(paste_id):
+    try:
+        response = _client.get_object(Bucket=_bucket, Key=paste_id)
+    except ClientError as ex:
+        if not _is_missing(ex):
+            raise
+        return None
+
+    return response['Body'].read().decode('utf-8'), response['Metadata']
+
+
+@_wrap_aws_exception
+def open_paste_stream(paste_id):
+    try:
+        response = _client.get_object(Bucket=_bucket, Key=paste_id)
+    except ClientError as ex:
+        if not _is_missing(ex):
+            raise
+        return None
+
+    return _iter_body(response['Body'])
+
+
+def _iter_body(body):
+    try:
+        for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+            yield chunk
+    finally:
+        body.close()
 
 
 @_wrap_aws_exception
 def get_paste_metadata(paste_id):
-    obj = _s3.Object(_bucket, paste_id)
-    obj.load()
-    return obj.metadata
+    return _client.head_object(Bucket=_bucket, Key=paste_id)['Metadata']
 
 
 @_wrap_aws_exception
@@ -83,14 +359,134 @@ def get_paste_metadata_value(paste_id, key):
     return get_paste_metadata(paste_id).get(key)
 
 
+def _head_paste_metadata(paste_id):
+    try:
+        response = _client.head_object(Bucket=_bucket, Key=paste_id)
+    except ClientError as ex:
+        if not _is_missing(ex):
+            raise
+        return None
+
+    return response['Metadata']
+
+
+def _get_many_paste_metadata(paste_ids):
+    """
+    Fetches the metadata of many pastes concurrently, since S3 has no way
+    to return it along with a listing.
+    :return: a list with the metadata of every paste, in the same order,
+             with None for the pastes that no longer exist
+    """
+    return list(_metadata_executor.map(_head_paste_metadata, paste_ids))
+
+
+def _filter_paste_ids(paste_ids, filters, fdefaults):
+    if not filters:
+        return paste_ids
+
+    return [
+        paste_id for paste_id, metadata
+        in zip(paste_ids, _get_many_paste_metadata(paste_ids))
+        if metadata is not None and
+        filters_match(metadata, filters, fdefaults)
+    ]
+
+
+def _list_paste_ids():
+    """
+    Yields the IDs of all the stored pastes, one listing page at a time.
+    """
+    paginator = _client.get_paginator('list_objects_v2')
+
+    for response in paginator.paginate(Bucket=_bucket):
+        yield [
+            obj['Key'] for obj in response.get('Contents', [])
+            if not is_index_key(obj['Key'])
+        ]
+
+
 def _get_all_paste_ids(filters, fdefaults):
-    for obj in _s3.Bucket(_bucket).objects.all():
-        paste_id = obj.key
-        metadata = get_paste_metadata(paste_id)
-        if filters_match(metadata, filters, fdefaults):
+    for paste_ids in _list_paste_ids():
+        for paste_id in _filter_paste_ids(paste_ids, filters, fdefaults):
             yield paste_id
 
 
 @_wrap_aws_exception
 def get_all_paste_ids(filters={}, fdefaults={}):
     return list(_get_all_paste_ids(filters, fdefaults)) or ['none']
+
+
+@_wrap_aws_exception
+def get_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    paste_ids = []
+
+    # Never ask for more objects than are missing from the page, so that
+    # the page ends exactly where an S3 listing page ends
+    while len(paste_ids) < limit:
+        kwargs = {'Bucket': _bucket, 'MaxKeys': limit - len(paste_ids)}
+        if cursor is not None:
+            kwargs['ContinuationToken'] = cursor
+
+        response = _client.list_objects_v2(**kwargs)
+        paste_ids.extend(_filter_paste_ids(
+            [
+                obj['Key'] for obj in response.get('Contents', [])
+                if not is_index_key(obj['Key'])
+            ],
+            filters, fdefaults))
+
+        cursor = response.get('NextContinuationToken')
+        if cursor is None:
+            break
+
+    return paste_ids, cursor
+
+
+@_wrap_aws_exception
+def get_recent_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    # The pastes stored before the date index existed are missing from it
+    # until build_index.py is done, so they are listed by Paste ID until then
+    if not _is_recent_index_built():
+        return get_paste_ids_page(filters, fdefaults, limit, cursor)
+
+    indexed = {k: v for k, v in filters.items() if k in _INDEXED_KEYS}
+    remaining = {k: v for k, v in filters.items() if k not in indexed}
+
+    paste_ids = []
+    last_key = None
+
+    # The cursor is the index key of the last paste of the previous page
+    while True:
+        kwargs = {
+            'Bucket': _bucket,
+            'Prefix': RECENT_INDEX_PREFIX,
+            'MaxKeys': min(limit + 1, 1000),
+        }
+        if cursor is not None:
+            kwargs['StartAfter'] = cursor
+
+        response = _client.list_objects_v2(**kwargs)
+
+        # Filters on the indexed keys need no request at all, and the
+        # metadata for the others is fetched for the whole listing page
+        candidates = []
+        for obj in response.get('Contents', []):
+            paste_id, values = parse_recent_index_key(obj['Key'])
+            if filters_match(values, indexed, fdefaults):
+                candidates.append((paste_id, obj['Key']))
+
+        matches = set(_filter_paste_ids(
+            [paste_id for paste_id, _ in candidates], remaining, fdefaults))
+
+        for paste_id, key in candidates:
+            if paste_id not in matches:
+                continue
+
+            if len(paste_ids) == limit:
+                return paste_ids, last_key
+            paste_ids.append(paste_id)
+            last_key = key
+
+        if not response.get('IsTruncated'):
+            return paste_ids, None
+        cursor = response['Contents'][-1]['Key']
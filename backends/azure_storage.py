@@ -1,26 +1,52 @@
+from contextlib import contextmanager
 from os import getenv
 
 from azure.common import AzureException
+from azure.common import AzureHttpError
+from azure.common import AzureMissingResourceHttpError
 from azure.storage.blob import BlockBlobService
 from azure.storage.blob import Include
 
+# the application catches backend errors through this module attribute
+from backends import exceptions as e  # noqa: F401
+from backends.utils import EXPIRY_INDEX_PREFIX
+from backends.utils import RECENT_INDEX_PREFIX
+from backends.utils import STREAM_CHUNK_SIZE
+from backends.utils import expiry_index_key
 from backends.utils import filters_match
 from backends.utils import getenv_int
 from backends.utils import getenv_required
+from backends.utils import is_index_key
+from backends.utils import parse_expiry_index_key
+from backends.utils import parse_recent_index_key
+from backends.utils import recent_index_key
 from backends.utils import wrap_exception
 
 _ENV_ACCOUNT_NAME = 'TP_BACKEND_AZURE_STORAGE_ACCOUNT_NAME'
 _ENV_ACCOUNT_KEY = 'TP_BACKEND_AZURE_STORAGE_ACCOUNT_KEY'
 _ENV_CONTAINER = 'TP_BACKEND_AZURE_STORAGE_CONTAINER'
 _ENV_TIMEOUT = 'TP_BACKEND_AZURE_STORAGE_TIMEOUT_SECONDS'
+_ENV_EMULATED = 'TP_BACKEND_AZURE_STORAGE_EMULATED'
 
 _DEFAULT_CONTAINER = 'torpaste'
 _DEFAULT_TIMEOUT = 10
 
+# Metadata keys whose values are part of the index blob names, so that the
+# listing can be filtered on them without loading every paste's metadata
+_INDEXED_KEYS = ['visibility']
+
+# Marks that the date index has been built for the pastes stored before it,
+# and holds the marker of the listing of the rest of them until then
+_INDEX_BUILT_BLOB = 'index/recent.built'
+_INDEX_PROGRESS_BLOB = 'index/recent.progress'
+
 _blob_service = None  # type: BlockBlobService
 _container = None  # type: str
 _timeout = None  # type: int
 
+# Only ever set once the date index is known to be built
+_recent_index_built = False
+
 
 _wrap_azure_exception = wrap_exception(
     AzureException,
@@ -33,27 +59,226 @@ def initialize_backend():
     global _container
     global _timeout
 
-    _blob_service = BlockBlobService(
-        account_name=getenv_required(_ENV_ACCOUNT_NAME),
-        account_key=getenv_required(_ENV_ACCOUNT_KEY))
+    # The storage emulator, such as Azurite, uses a well-known account
+    if getenv(_ENV_EMULATED) in ('1', 'true', 'True'):
+        _blob_service = BlockBlobService(is_emulated=True)
+    else:
+        _blob_service = BlockBlobService(
+            account_name=getenv_required(_ENV_ACCOUNT_NAME),
+            account_key=getenv_required(_ENV_ACCOUNT_KEY))
     _container = getenv(_ENV_CONTAINER, _DEFAULT_CONTAINER)
     _timeout = getenv_int(_ENV_TIMEOUT, _DEFAULT_TIMEOUT)
 
     _blob_service.create_container(
         _container, fail_on_exist=False, timeout=_timeout)
 
+    # The pastes of a new container are all added to the date index as they
+    # are created, while the others are added by build_index.py
+    if not _is_recent_index_built() and not list(_blob_service.list_blobs(
+            _container, num_results=1, timeout=_timeout)):
+        _blob_service.create_blob_from_bytes(
+            _container, _INDEX_BUILT_BLOB, b'', timeout=_timeout)
+
+
+def _is_recent_index_built():
+    global _recent_index_built
+
+    if not _recent_index_built:
+        _recent_index_built = _blob_service.exists(
+            _container, _INDEX_BUILT_BLOB, timeout=_timeout)
+    return _recent_index_built
+
+
+@_wrap_azure_exception
+def build_recent_index(limit):
+    """
+    Adds the next pastes stored before the date index existed to it, after
+    the ones added by the previous calls. This is done by build_index.py,
+    instead of when the backend starts, since it lists the whole container.
+    :param limit: the maximum number of pastes to add
+    :return: the number of pastes added, and True if none is left
+    """
+    if _is_recent_index_built():
+        return 0, True
+
+    try:
+        marker = _blob_service.get_blob_to_text(
+            _container, _INDEX_PROGRESS_BLOB, timeout=_timeout).content
+    except AzureMissingResourceHttpError:
+        marker = None
+
+    blobs = _blob_service.list_blobs(
+        _container, include=Include.METADATA, num_results=limit,
+        marker=marker or None, timeout=_timeout)
+
+    added = 0
+    reached_index = False
+    for blob in blobs:
+        # Paste IDs are hexadecimal, so they all sort before the index blobs
+        if is_index_key(blob.name):
+            reached_index = True
+            break
+        _create_index_blobs(blob.name, blob.metadata)
+        added += 1
+
+    if blobs.next_marker and not reached_index:
+        _blob_service.create_blob_from_text(
+            _container, _INDEX_PROGRESS_BLOB, blobs.next_marker,
+            timeout=_timeout)
+        return added, False
+
+    _blob_service.create_blob_from_bytes(
+        _container, _INDEX_BUILT_BLOB, b'', timeout=_timeout)
+    if marker is not None:
+        _blob_service.delete_blob(
+            _container, _INDEX_PROGRESS_BLOB, timeout=_timeout)
+    return added, True
+
 
 @_wrap_azure_exception
 def new_paste(paste_id, paste_content):
-    _blob_service.create_blob_from_text(
-        _container, paste_id, paste_content, timeout=_timeout)
+    with _ignore_existing_blob():
+        _blob_service.create_blob_from_text(
+            _container, paste_id, paste_content, if_none_match='*',
+            timeout=_timeout)
+
+
+@_wrap_azure_exception
+def new_paste_stream(paste_id, paste_stream):
+    # Large pastes are uploaded in blocks
+    with _ignore_existing_blob():
+        _blob_service.create_blob_from_stream(
+            _container, paste_id, paste_stream, if_none_match='*',
+            timeout=_timeout)
+
+
+@_wrap_azure_exception
+def create_paste(paste_id, paste_content, metadata):
+    # The metadata is written along with the content, in the same request
+    with _ignore_existing_blob():
+        _blob_service.create_blob_from_text(
+            _container, paste_id, paste_content, metadata=metadata,
+            if_none_match='*', timeout=_timeout)
+        _create_index_blobs(paste_id, metadata)
+        return
+
+    # The paste was created in the meantime, possibly with other metadata
+    update_paste_metadata(paste_id, metadata)
+
+
+@_wrap_azure_exception
+def create_paste_stream(paste_id, paste_stream, metadata):
+    with _ignore_existing_blob():
+        _blob_service.create_blob_from_stream(
+            _container, paste_id, paste_stream, metadata=metadata,
+            if_none_match='*', timeout=_timeout)
+        _create_index_blobs(paste_id, metadata)
+        return
+
+    update_paste_metadata(paste_id, metadata)
+
+
+def _index_names(paste_id, metadata):
+    """
+    Returns the names of all the index blobs of a paste with the given
+    metadata.
+    """
+    names = [
+        recent_index_key(paste_id, metadata, _INDEXED_KEYS),
+        expiry_index_key(paste_id, metadata),
+    ]
+    return [name for name in names if name is not None]
+
+
+def _create_index_blobs(paste_id, metadata, skip=()):
+    for name in _index_names(paste_id, metadata):
+        if name not in skip:
+            _blob_service.create_blob_from_bytes(
+                _container, name, b'', timeout=_timeout)
+
+
+@contextmanager
+def _ignore_existing_blob():
+    """
+    Paste IDs are the hash of the content, so a paste that already exists
+    has that content already, and the conditional write failing is fine.
+    """
+    try:
+        yield
+    except AzureHttpError as ex:
+        if ex.status_code not in (409, 412):
+            raise
 
 
 @_wrap_azure_exception
 def update_paste_metadata(paste_id, metadata):
+    old_metadata = _blob_service.get_blob_metadata(
+        _container, paste_id, timeout=_timeout)
+
     _blob_service.set_blob_metadata(
         _container, paste_id, metadata, timeout=_timeout)
 
+    old_names = _index_names(paste_id, old_metadata)
+    new_names = _index_names(paste_id, metadata)
+    _create_index_blobs(paste_id, metadata, skip=old_names)
+    for name in old_names:
+        if name not in new_names:
+            _blob_service.delete_blob(
+                _container, name, timeout=_timeout)
+
+
+@_wrap_azure_exception
+def get_expired_paste_ids(now, limit):
+    # The expiry index lists the pastes that expire first first, so only
+    # its start is ever listed
+    blobs = _blob_service.list_blobs(
+        _container, prefix=EXPIRY_INDEX_PREFIX,
+        num_results=min(limit, 5000), timeout=_timeout)
+
+    paste_ids = []
+    for blob in blobs:
+        expires, paste_id = parse_expiry_index_key(blob.name)
+        if expires > now:
+            break
+        paste_ids.append(paste_id)
+
+    return paste_ids
+
+
+@_wrap_azure_exception
+def delete_paste(paste_id):
+    try:
+        metadata = _blob_service.get_blob_metadata(
+            _container, paste_id, timeout=_timeout)
+    except AzureMissingResourceHttpError:
+        # An interrupted deletion may have left the paste in the expiry
+        # index, among the pastes that have expired, which are listed first
+        blobs = _blob_service.list_blobs(
+            _container, prefix=EXPIRY_INDEX_PREFIX, num_results=1000,
+            timeout=_timeout)
+        _delete_blobs([
+            blob.name for blob in blobs
+            if parse_expiry_index_key(blob.name)[1] == paste_id
+        ])
+        return
+
+    # The expiry index blob goes last, so that a paste is never left
+    # without the blob the reaper finds it by
+    expiry_name = expiry_index_key(paste_id, metadata)
+    _delete_blobs([paste_id] + [
+        name for name in _index_names(paste_id, metadata)
+        if name != expiry_name])
+    if expiry_name is not None:
+        _delete_blobs([expiry_name])
+
+
+def _delete_blobs(names):
+    for name in names:
+        try:
+            _blob_service.delete_blob(_container, name, timeout=_timeout)
+        except AzureMissingResourceHttpError:
+            pass
+
 
 @_wrap_azure_exception
 def does_paste_exist(paste_id):
@@ -69,6 +294,43 @@ def get_paste_contents(paste_id):
     return blob.content
 
 
+@_wrap_azure_exception
+def get_paste(paste_id):
+    try:
+        blob = _blob_service.get_blob_to_text(
+            _container, paste_id, timeout=_timeout)
+    except AzureMissingResourceHttpError:
+        return None
+
+    return blob.content, blob.metadata
+
+
+@_wrap_azure_exception
+def open_paste_stream(paste_id):
+    try:
+        properties = _blob_service.get_blob_properties(
+            _container, paste_id, timeout=_timeout).properties
+    except AzureMissingResourceHttpError:
+        return None
+
+    return _iter_blob(paste_id, properties.content_length)
+
+
+def _iter_blob(paste_id, length):
+    for start in range(0, length, STREAM_CHUNK_SIZE):
+        yield _get_blob_range(
+            paste_id, start, min(start + STREAM_CHUNK_SIZE, length) - 1)
+
+
+@_wrap_azure_exception
+def _get_blob_range(paste_id, start, end):
+    blob = _blob_service.get_blob_to_bytes(
+        _container, paste_id, start_range=start, end_range=end,
+        timeout=_timeout)
+
+    return blob.content
+
+
 @_wrap_azure_exception
 def get_paste_metadata(paste_id):
     return _blob_service.get_blob_metadata(
@@ -88,6 +350,8 @@ def _get_all_paste_ids(filters, fdefaults):
         _container, include=Include.METADATA, timeout=_timeout)
 
     for blob in blobs:
+        if is_index_key(blob.name):
+            continue
         if filters_match(blob.metadata, filters, fdefaults):
             yield blob.name
 
@@ -95,3 +359,64 @@ def _get_all_paste_ids(filters, fdefaults):
 @_wrap_azure_exception
 def get_all_paste_ids(filters={}, fdefaults={}):
     return list(_get_all_paste_ids(filters, fdefaults)) or ['none']
+
+
+@_wrap_azure_exception
+def get_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    paste_ids = []
+
+    # Never ask for more blobs than are missing from the page, so that the
+    # page ends exactly where an Azure listing page ends
+    while len(paste_ids) < limit:
+        blobs = _blob_service.list_blobs(
+            _container, include=Include.METADATA,
+            num_results=limit - len(paste_ids), marker=cursor,
+            timeout=_timeout)
+
+        for blob in blobs:
+            if is_index_key(blob.name):
+                continue
+            if filters_match(blob.metadata, filters, fdefaults):
+                paste_ids.append(blob.name)
+
+        cursor = blobs.next_marker or None
+        if cursor is None:
+            break
+
+    return paste_ids, cursor
+
+
+@_wrap_azure_exception
+def get_recent_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    # The pastes stored before the date index existed are missing from it
+    # until build_index.py is done, so they are listed by Paste ID until then
+    if not _is_recent_index_built():
+        return get_paste_ids_page(filters, fdefaults, limit, cursor)
+
+    indexed = {k: v for k, v in filters.items() if k in _INDEXED_KEYS}
+    remaining = {k: v for k, v in filters.items() if k not in indexed}
+
+    paste_ids = []
+
+    # Never ask for more index blobs than are missing from the page, so that
+    # the page ends exactly where an Azure listing page ends
+    while len(paste_ids) < limit:
+        blobs = _blob_service.list_blobs(
+            _container, prefix=RECENT_INDEX_PREFIX,
+            num_results=limit - len(paste_ids), marker=cursor,
+            timeout=_timeout)
+
+        for blob in blobs:
+            paste_id, values = parse_recent_index_key(blob.name)
+            if not filters_match(values, indexed, fdefaults):
+                continue
+            if remaining and not filters_match(
+                    get_paste_metadata(paste_id), remaining, fdefaults):
+                continue
+            paste_ids.append(paste_id)
+
+        cursor = blobs.next_marker or None
+        if cursor is None:
+            break
+
+    return paste_ids, cursor
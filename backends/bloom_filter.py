@@ -0,0 +1,327 @@
+"""
+This file contains a backend layer that keeps a Bloom filter of the IDs of
+all the stored pastes, so that requests for pastes that do not exist, such
+as the random IDs of crawlers and scanners, are answered without asking the
+backend. A Bloom filter never misses a paste it was told about, but may
+claim that a paste exists when it does not, in which case the backend is
+asked as before.
+
+The filter is kept in a memory-mapped file shared by all the TorPaste
+processes of a node, such as the Gunicorn workers, so that a paste created
+by any of them is known to all the others at once. It is built from the
+listing of the backend when it starts, every paste created through it is
+added to it, and it is rebuilt periodically by one of the processes, so
+that the pastes created on other nodes are eventually added too. Tools that
+store pastes without going through it, such as migrate.py, invalidate it, and
+until it is rebuilt every paste is looked up in the backend.
+
+The file starts with a header, followed by a log of the pastes added since
+the filter was last rebuilt and by the bits of the filter. Writers take an
+fcntl lock on the file, while readers take no lock at all. A rebuild reads
+the whole listing without holding that lock, and then adds the pastes of the
+log that were created in the meantime, before replacing the bits.
+"""
+
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+
+from backends.layer import BackendLayer
+from backends.utils import open_shared_file
+
+DEFAULT_PATH = "/dev/shm/torpaste-bloom"
+
+_MAGIC = b"TPBF2\x00\x00\x00"
+
+# magic, bit count, hash count, log capacity, time of the last rebuild or 0
+# if it has to be rebuilt, number of pastes added to the log, number of times
+# it was invalidated
+_HEADER = struct.Struct("<8sQIIdQQ")
+_HEADER_SIZE = 64
+
+_FALSE_POSITIVE_RATE = 0.01
+
+# Every log entry is the part of the hash of a Paste ID the filter uses
+_LOG_ENTRY_SIZE = 16
+_LOG_CAPACITY = 4096
+
+# The byte ranges of the file locked by the writers of the filter, and by
+# the process rebuilding it
+_WRITE_LOCK = 0
+_REBUILD_LOCK = 1
+
+_LISTING_PAGE_SIZE = 1000
+
+# How often the processes check whether the filter was invalidated
+_INVALIDATION_CHECK_SECONDS = 60
+
+# The operations that look up a paste, and what they return for a paste that
+# does not exist
+_READS = {
+    "does_paste_exist": False,
+    "get_paste": None,
+    "open_paste_stream": None,
+    "open_encoded_paste_stream": (None, None),
+}
+
+# The operations that store a new paste
+_WRITES = [
+    "new_paste",
+    "new_paste_stream",
+    "create_paste",
+    "create_paste_stream",
+]
+
+
+def _hash(paste_id):
+    return sha256(paste_id.encode("utf-8")).digest()[:_LOG_ENTRY_SIZE]
+
+
+def invalidate(path):
+    """
+    Makes the filters backed by the given path, whatever their size, look up
+    every paste in the backend until they are rebuilt, which their processes
+    do soon. It has to be called on every node by the tools that store
+    pastes without going through the filter.
+    :param path: the file backing the filters, as given to BloomFilterLayer
+    """
+    directory, prefix = os.path.split(path)
+    try:
+        names = os.listdir(directory or ".")
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        if not name.startswith(prefix + "."):
+            continue
+        try:
+            fd = os.open(os.path.join(directory, name), os.O_RDWR)
+        except FileNotFoundError:
+            # Replaced by the file of another size meanwhile
+            continue
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, _WRITE_LOCK)
+            header = os.pread(fd, _HEADER.size, 0)
+            if len(header) < _HEADER.size or \
+                    not header.startswith(_MAGIC):
+                continue
+            header = list(_HEADER.unpack(header))
+            header[4] = 0
+            header[6] += 1
+            os.pwrite(fd, _HEADER.pack(*header), 0)
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+
+class BloomFilterLayer(BackendLayer):
+    def __init__(self, backend, path, capacity, rebuild_seconds):
+        """
+        :param path: the file backing the filter
+        :param capacity: the number of pastes the filter is sized for, past
+                         which it claims that more missing pastes exist
+        :param rebuild_seconds: how often the filter is rebuilt from the
+                                listing of the backend
+        """
+        super(BloomFilterLayer, self).__init__(backend)
+
+        if capacity <= 0:
+            raise ValueError("Bloom filter capacity must be positive")
+
+        self._bits = int(math.ceil(
+            -capacity * math.log(_FALSE_POSITIVE_RATE) / math.log(2) ** 2))
+        self._bits += -self._bits % 8
+        self._hashes = max(1, round(self._bits / capacity * math.log(2)))
+        self._rebuild_seconds = rebuild_seconds
+
+        self._log_offset = _HEADER_SIZE
+        self._bits_offset = self._log_offset + \
+            _LOG_CAPACITY * _LOG_ENTRY_SIZE
+
+        self._write_lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        # A new file holds a filter that was never built
+        self._fd = open_shared_file(
+            path,
+            _HEADER.pack(_MAGIC, self._bits, self._hashes, _LOG_CAPACITY,
+                         0, 0, 0),
+            self._bits_offset + self._bits // 8)
+        self._map = mmap.mmap(self._fd, 0)
+
+        # Forked processes each start a rebuilding thread of their own
+        self._rebuilder_pid = None
+
+    @contextmanager
+    def _locked(self, lock, start):
+        """
+        Takes a lock for the threads of this process, and the range of the
+        file starting at the given offset for the other processes.
+        """
+        with lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, start)
+
+    def _header(self):
+        return _HEADER.unpack_from(self._map, 0)
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self._bits for i in range(self._hashes)]
+
+    @staticmethod
+    def _set(bits, offset, positions):
+        for position in positions:
+            bits[offset + (position >> 3)] |= 1 << (position & 7)
+
+    def might_exist(self, paste_id):
+        """
+        Returns False if the paste is certainly not stored, or True if it
+        may be.
+        """
+        self._start_rebuilder()
+
+        if not self._header()[4]:
+            # Never built, or invalidated since
+            return True
+
+        for position in self._positions(_hash(paste_id)):
+            byte = self._map[self._bits_offset + (position >> 3)]
+            if not byte & (1 << (position & 7)):
+                return False
+        return True
+
+    def _add(self, paste_id):
+        digest = _hash(paste_id)
+
+        with self._locked(self._write_lock, _WRITE_LOCK):
+            self._set(self._map, self._bits_offset, self._positions(digest))
+
+            header = list(self._header())
+            entry = self._log_offset + \
+                header[5] % _LOG_CAPACITY * _LOG_ENTRY_SIZE
+            self._map[entry:entry + _LOG_ENTRY_SIZE] = digest
+            header[5] += 1
+            _HEADER.pack_into(self._map, 0, *header)
+
+    def _list_paste_ids(self):
+        """
+        Yields the IDs of all the pastes of the backend, whatever their
+        visibility.
+        """
+        if not hasattr(self._backend, "get_paste_ids_page"):
+            for paste_id in self._backend.get_all_paste_ids({}, {}):
+                if paste_id != "none":
+                    yield paste_id
+            return
+
+        cursor = None
+        while True:
+            page, cursor = self._backend.get_paste_ids_page(
+                {}, {}, _LISTING_PAGE_SIZE, cursor)
+            for paste_id in page:
+                yield paste_id
+            if cursor is None:
+                return
+
+    def rebuild(self, force=False):
+        """
+        Rebuilds the filter from the listing of the backend, unless another
+        process rebuilt it recently and it was not invalidated since.
+        """
+        with self._locked(self._rebuild_lock, _REBUILD_LOCK):
+            with self._locked(self._write_lock, _WRITE_LOCK):
+                built, logged, invalidations = self._header()[4:7]
+
+            if not force and built and \
+                    time.time() - built < self._rebuild_seconds:
+                return
+
+            bits = bytearray(self._bits // 8)
+            for paste_id in self._list_paste_ids():
+                self._set(bits, 0, self._positions(_hash(paste_id)))
+
+            with self._locked(self._write_lock, _WRITE_LOCK):
+                header = list(self._header())
+                if header[5] - logged > _LOG_CAPACITY:
+                    # Too many pastes were added to tell which, so keep all
+                    # the current ones
+                    current = self._map[self._bits_offset:]
+                    bits = (
+                        int.from_bytes(bits, "little") |
+                        int.from_bytes(current, "little")
+                    ).to_bytes(len(bits), "little")
+                else:
+                    for n in range(logged, header[5]):
+                        entry = self._log_offset + \
+                            n % _LOG_CAPACITY * _LOG_ENTRY_SIZE
+                        self._set(bits, 0, self._positions(
+                            self._map[entry:entry + _LOG_ENTRY_SIZE]))
+
+                # Every paste that exists is in both the old and the new
+                # bits, so readers never miss it while they are replaced
+                self._map[self._bits_offset:] = bits
+                if header[6] == invalidations:
+                    # Otherwise the listing may have missed the pastes
+                    # stored since, and it has to be rebuilt again
+                    header[4] = time.time()
+                _HEADER.pack_into(self._map, 0, *header)
+
+    def _start_rebuilder(self):
+        if self._rebuilder_pid == os.getpid():
+            return
+        self._rebuilder_pid = os.getpid()
+
+        thread = threading.Thread(
+            target=self._rebuild_periodically, daemon=True)
+        thread.start()
+
+    def _rebuild_periodically(self):
+        while True:
+            time.sleep(min(
+                self._rebuild_seconds, _INVALIDATION_CHECK_SECONDS))
+            try:
+                self.rebuild()
+            except Exception:
+                # The backend may be unavailable for a while, and the current
+                # filter is still good until the next attempt
+                pass
+
+    def __getattr__(self, name):
+        attribute = getattr(self._backend, name)
+
+        if name in _READS:
+            missing = _READS[name]
+
+            def operation(paste_id, *args):
+                if not self.might_exist(paste_id):
+                    return missing
+                return attribute(paste_id, *args)
+        elif name in _WRITES:
+            def operation(paste_id, *args):
+                # Pastes are added before they are stored, so that the
+                # filter never misses a paste that exists
+                self._add(paste_id)
+                return attribute(paste_id, *args)
+        else:
+            return attribute
+
+        # Only the operations the backend provides are wrapped, and later
+        # lookups find them without going through __getattr__ again
+        setattr(self, name, operation)
+        return operation
+
+    def initialize_backend(self):
+        self._backend.initialize_backend()
+
+        # Only the first of the processes starting together builds it
+        self.rebuild()
@@ -0,0 +1,281 @@
+"""
+This file contains a backend layer that compresses the content of pastes
+before it is stored, and decompresses it when it is read. The codec of every
+compressed paste is stored in its metadata, under the "codec" key, and every
+codec output starts with a magic number that can never start valid UTF-8, so
+pastes stored before compression was enabled are still read as they are.
+
+The codecs are the ones HTTP clients understand as a Content-Encoding, so
+that raw pastes can be sent to the clients that accept them exactly as they
+are stored, without ever being decompressed on the server.
+
+The layer needs a backend that can store and read bytes, through
+new_paste_stream and open_paste_stream.
+"""
+
+import zlib
+from io import BytesIO
+from itertools import chain
+from tempfile import SpooledTemporaryFile
+
+from backends.layer import BackendLayer
+from backends.utils import STREAM_CHUNK_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The metadata key holding the codec of a compressed paste
+_CODEC_KEY = "codec"
+
+# Pastes smaller than this barely shrink, and are stored as they are
+_MIN_SIZE = 256
+
+# Compressed pastes are kept in memory up to this size before being stored,
+# and in a temporary file after that
+_SPOOL_SIZE = 1024 * 1024
+
+
+class _Gzip(object):
+    magic = b"\x1f\x8b"
+
+    def compressor(self):
+        # The wbits of the gzip container, which HTTP calls gzip
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def decompressor(self):
+        return zlib.decompressobj(31)
+
+
+class _Zstd(object):
+    magic = b"\x28\xb5\x2f\xfd"
+
+    def compressor(self):
+        return zstandard.ZstdCompressor().compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+_CODECS = {
+    "gzip": _Gzip(),
+    "zstd": _Zstd(),
+}
+
+
+def _sniff_codec(data):
+    for name, codec in _CODECS.items():
+        if data.startswith(codec.magic):
+            return name
+    return None
+
+
+def _iter_chunks(stream):
+    if hasattr(stream, "read"):
+        return iter(lambda: stream.read(STREAM_CHUNK_SIZE), b"")
+    return iter(stream)
+
+
+def _close(stream):
+    if hasattr(stream, "close"):
+        stream.close()
+
+
+class CompressionLayer(BackendLayer):
+    def __init__(self, backend, codec):
+        super(CompressionLayer, self).__init__(backend)
+
+        if codec not in _CODECS:
+            raise ValueError("Unknown compression codec " + codec)
+        if codec == "zstd" and zstandard is None:
+            raise ValueError("The zstd codec needs the zstandard package")
+        if not hasattr(backend, "new_paste_stream") or \
+                not hasattr(backend, "open_paste_stream"):
+            raise ValueError("The backend cannot store compressed pastes")
+
+        self._codec = codec
+
+    def _open(self, paste_id):
+        """
+        Opens the stored content of a paste, and finds out its codec from
+        its first bytes.
+        :return: a (codec, stream) tuple, where codec is None if the paste is
+                 not compressed and stream is what open_paste_stream of the
+                 backend returns, or None if the paste does not exist
+        """
+        stream = self._backend.open_paste_stream(paste_id)
+        if stream is None:
+            return None
+
+        # Files are left as they are, so that they can still be sent with
+        # sendfile()
+        if hasattr(stream, "read") and hasattr(stream, "seek"):
+            first = stream.read(4)
+            stream.seek(-len(first), 1)
+            return _sniff_codec(first), stream
+
+        chunks = iter(stream)
+        first = b""
+        for chunk in chunks:
+            first += chunk
+            # Make sure enough bytes are read to tell every magic number apart
+            if len(first) >= 4:
+                break
+
+        chunks = self._chunks(stream, chain([first], chunks))
+        return _sniff_codec(first), chunks
+
+    def _chunks(self, stream, chunks):
+        try:
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+        finally:
+            _close(stream)
+
+    def _decompress(self, codec, stream):
+        decompressor = _CODECS[codec].decompressor()
+        try:
+            for chunk in _iter_chunks(stream):
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+        finally:
+            _close(stream)
+
+    def _compress(self, paste_stream):
+        """
+        Compresses the content read from a binary file object.
+        :return: a binary file object with the compressed content, positioned
+                 at its start
+        """
+        compressor = _CODECS[self._codec].compressor()
+        compressed = SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+
+        for chunk in _iter_chunks(paste_stream):
+            compressed.write(compressor.compress(chunk))
+        compressed.write(compressor.flush())
+
+        compressed.seek(0)
+        return compressed
+
+    def _store(self, paste_stream, write):
+        """
+        Stores the content read from a binary file object compressed, unless
+        it is too small to be worth it.
+        :param write: a callable that writes a binary file object and the
+                      codec of its content, or None, to the backend
+        """
+        start = paste_stream.tell()
+        small = len(paste_stream.read(_MIN_SIZE)) < _MIN_SIZE
+        paste_stream.seek(start)
+
+        if small:
+            write(paste_stream, None)
+            return
+
+        compressed = self._compress(paste_stream)
+        try:
+            write(compressed, self._codec)
+        finally:
+            compressed.close()
+
+    def new_paste(self, paste_id, paste_content):
+        self.new_paste_stream(paste_id, BytesIO(paste_content.encode("utf-8")))
+
+    def new_paste_stream(self, paste_id, paste_stream):
+        def write(stream, codec):
+            self._backend.new_paste_stream(paste_id, stream)
+            if codec is None:
+                return
+
+            try:
+                metadata = self._backend.get_paste_metadata(paste_id)
+            except self._backend.e.WarningException:
+                metadata = {}
+            metadata[_CODEC_KEY] = codec
+            self._backend.update_paste_metadata(paste_id, metadata)
+
+        self._store(paste_stream, write)
+
+    def create_paste(self, paste_id, paste_content, metadata):
+        self.create_paste_stream(
+            paste_id, BytesIO(paste_content.encode("utf-8")), metadata)
+
+    def create_paste_stream(self, paste_id, paste_stream, metadata):
+        metadata = {k: v for k, v in metadata.items() if k != _CODEC_KEY}
+
+        def write(stream, codec):
+            if codec is not None:
+                metadata[_CODEC_KEY] = codec
+
+            if hasattr(self._backend, "create_paste_stream"):
+                self._backend.create_paste_stream(paste_id, stream, metadata)
+            else:
+                self._backend.new_paste_stream(paste_id, stream)
+                self._backend.update_paste_metadata(paste_id, metadata)
+
+        self._store(paste_stream, write)
+
+    def update_paste_metadata(self, paste_id, metadata):
+        metadata = {k: v for k, v in metadata.items() if k != _CODEC_KEY}
+
+        # Keep the codec the content is stored with, which the callers do not
+        # know about
+        codec = self._backend.get_paste_metadata_value(paste_id, _CODEC_KEY)
+        if codec is not None:
+            metadata[_CODEC_KEY] = codec
+
+        self._backend.update_paste_metadata(paste_id, metadata)
+
+    def get_paste(self, paste_id):
+        stored = self._open(paste_id)
+        if stored is None:
+            return None
+
+        codec, stream = stored
+        try:
+            metadata = self._backend.get_paste_metadata(paste_id)
+        except self._backend.e.WarningException:
+            metadata = {}
+        except BaseException:
+            _close(stream)
+            raise
+
+        codec = metadata.get(_CODEC_KEY, codec)
+        if codec is not None:
+            chunks = self._decompress(codec, stream)
+        else:
+            chunks = self._chunks(stream, _iter_chunks(stream))
+
+        return b"".join(chunks).decode("utf-8"), metadata
+
+    def get_paste_contents(self, paste_id):
+        paste = self.get_paste(paste_id)
+        if paste is None:
+            raise self._backend.e.ErrorException(
+                "Paste %s does not exist" % paste_id)
+        return paste[0]
+
+    def open_paste_stream(self, paste_id):
+        return self.open_encoded_paste_stream(paste_id, ())[0]
+
+    def open_encoded_paste_stream(self, paste_id, encodings):
+        """
+        Opens a paste for streaming its contents, compressed if it is stored
+        with one of the given content encodings, or decompressed otherwise.
+        :param paste_id: ASCII string which represents the ID of the paste
+        :param encodings: the content encodings the client accepts
+        :return: an (iterable of byte strings or binary file object, content
+                 encoding or None) tuple, or (None, None) if the paste
+                 doesn't exist
+        """
+        stored = self._open(paste_id)
+        if stored is None:
+            return None, None
+
+        codec, stream = stored
+        if codec is None or codec in encodings:
+            return stream, codec
+        return self._decompress(codec, stream), None
@@ -1,23 +1,138 @@
+from collections import deque
+from contextlib import ExitStack
 from contextlib import contextmanager
-from itertools import groupby
-from operator import itemgetter
+from threading import Condition
 
-from backends.utils import filters_match
+from backends.exceptions import ErrorException
+from backends.utils import STREAM_CHUNK_SIZE
+
+# Number of rows fetched at a time from queries that can return many rows
+_FETCH_SIZE = 1000
+
+
+class ConnectionPool(object):
+    """
+    Keeps the connections to the database that are not in use, up to
+    max_size, for the next operations to reuse.
+
+    The server may close a connection at any time while it is idle, so every
+    connection is checked with a query before being reused, and replaced if
+    it fails. This costs a round trip per operation, but retrying the
+    operation on a new connection instead would not be safe once some of its
+    statements ran, and the caller of connection() cannot be made to run
+    them again.
+    """
+
+    def __init__(self, connect, min_size, max_size):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('Invalid connection pool size')
+
+        self._connect = connect
+        self._max_size = max_size
+        self._size = 0
+        self._idle = deque()
+        self._condition = Condition()
+
+        for _ in range(min_size):
+            self._idle.append(self._open())
+
+    def _open(self):
+        with self._condition:
+            self._size += 1
+        try:
+            return self._connect()
+        except BaseException:
+            self._discard(None)
+            raise
+
+    def _discard(self, connection):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _is_healthy(self, connection):
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            connection.rollback()
+        except Exception:
+            return False
+        return True
+
+    def _acquire(self):
+        with self._condition:
+            while not self._idle and self._size >= self._max_size:
+                self._condition.wait()
+
+            if not self._idle:
+                connection = None
+            else:
+                connection = self._idle.pop()
+
+        if connection is None:
+            return self._open()
+
+        if not self._is_healthy(connection):
+            self._discard(connection)
+            return self._open()
+
+        return connection
+
+    def _release(self, connection):
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+
+        try:
+            yield connection
+        except BaseException:
+            try:
+                connection.rollback()
+            except Exception:
+                self._discard(connection)
+            else:
+                self._release(connection)
+            raise
+
+        self._release(connection)
 
 
 class DbApi2(object):
-    def __init__(self, connection, paramstyle):
-        self._connection = connection
+    def __init__(self, connect, paramstyle, min_connections=1,
+                 max_connections=1, server_side_cursors=False):
+        self._pool = ConnectionPool(connect, min_connections, max_connections)
         self._paramstyle = paramstyle
+        self._server_side_cursors = server_side_cursors
 
     @contextmanager
-    def _get_cursor(self, commit):
-        cursor = self._connection.cursor()
+    def _get_cursor(self, commit, name=None):
+        with self._pool.connection() as connection:
+            cursor = connection.cursor(name) if name else connection.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
 
-        yield cursor
-
-        if commit:
-            self._connection.commit()
+            # End read transactions too, so that pooled connections are not
+            # left idle in a transaction
+            if commit:
+                connection.commit()
+            else:
+                connection.rollback()
 
     def _read_cursor(self):
         return self._get_cursor(commit=False)
@@ -25,9 +140,26 @@ class DbApi2(object):
     def _write_cursor(self):
         return self._get_cursor(commit=True)
 
+    def _stream_cursor(self):
+        """
+        Returns a read cursor for queries whose results should be streamed
+        instead of being fetched all at once, which is a named (server-side)
+        cursor if the database supports them.
+        """
+        name = 'torpaste_stream' if self._server_side_cursors else None
+        return self._get_cursor(commit=False, name=name)
+
     def _prepare_sql(self, sql):
         return sql.replace('?', self._paramstyle)
 
+    def _begin_snapshot(self, cursor):
+        """
+        Makes all the queries of the transaction of the cursor read the
+        database as it was when the first one ran. It must be called before
+        any query of the transaction.
+        """
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
     def initialize_backend(self):
         with self._write_cursor() as cursor:
             cursor.execute(self._prepare_sql('''
@@ -43,22 +175,59 @@ class DbApi2(object):
                   value TEXT,
                   PRIMARY KEY (id, key))
             '''))
+            cursor.execute(self._prepare_sql('''
+                CREATE INDEX IF NOT EXISTS pastes_metadata_key_value
+                ON pastes_metadata (key, value, id)
+            '''))
 
     def new_paste(self, paste_id, paste_content):
+        # Paste IDs are the hash of the content, so a paste that already
+        # exists has that content already
         with self._write_cursor() as cursor:
             cursor.execute(self._prepare_sql('''
                 INSERT INTO pastes (id, content) VALUES (?, ?)
+                ON CONFLICT (id) DO NOTHING
             '''), [paste_id, paste_content])
 
-    def update_paste_metadata(self, paste_id, metadata):
+    def create_paste(self, paste_id, paste_content, metadata):
+        # A single transaction, so that the paste never exists without its
+        # metadata
         with self._write_cursor() as cursor:
             cursor.execute(self._prepare_sql('''
+                INSERT INTO pastes (id, content) VALUES (?, ?)
+                ON CONFLICT (id) DO NOTHING
+            '''), [paste_id, paste_content])
+            self._replace_metadata(cursor, paste_id, metadata)
+
+    def create_pastes(self, pastes):
+        # The whole batch is a single transaction, with a single statement
+        # for every table
+        with self._write_cursor() as cursor:
+            cursor.executemany(self._prepare_sql('''
+                INSERT INTO pastes (id, content) VALUES (?, ?)
+                ON CONFLICT (id) DO NOTHING
+            '''), [(paste_id, content) for (paste_id, content, _) in pastes])
+            cursor.executemany(self._prepare_sql('''
                 DELETE FROM pastes_metadata WHERE id = ?
-            '''), [paste_id])
+            '''), [(paste_id,) for (paste_id, _, _) in pastes])
             cursor.executemany(self._prepare_sql('''
                 INSERT INTO pastes_metadata VALUES (?, ?, ?)
-            '''), [(paste_id, key, value) for (key, value) in
-                   metadata.items()])
+            '''), [(paste_id, key, value)
+                   for (paste_id, _, metadata) in pastes
+                   for (key, value) in metadata.items()])
+
+    def update_paste_metadata(self, paste_id, metadata):
+        with self._write_cursor() as cursor:
+            self._replace_metadata(cursor, paste_id, metadata)
+
+    def _replace_metadata(self, cursor, paste_id, metadata):
+        cursor.execute(self._prepare_sql('''
+            DELETE FROM pastes_metadata WHERE id = ?
+        '''), [paste_id])
+        cursor.executemany(self._prepare_sql('''
+            INSERT INTO pastes_metadata VALUES (?, ?, ?)
+        '''), [(paste_id, key, value) for (key, value) in
+               metadata.items()])
 
     def does_paste_exist(self, paste_id):
         with self._read_cursor() as cursor:
@@ -76,6 +245,58 @@ class DbApi2(object):
             row = cursor.fetchone()
         return row[0] if row else None
 
+    def get_paste(self, paste_id):
+        with self._read_cursor() as cursor:
+            cursor.execute(self._prepare_sql('''
+                SELECT p.content, m.key, m.value
+                FROM pastes p
+                LEFT JOIN pastes_metadata m ON m.id = p.id
+                WHERE p.id = ?
+            '''), [paste_id])
+            rows = cursor.fetchall()
+
+        if not rows:
+            return None
+
+        metadata = {key: value for (_, key, value) in rows if key is not None}
+        return rows[0][0], metadata
+
+    def open_paste_stream(self, paste_id):
+        # The length and all the parts are read in a single transaction, so
+        # that they are all of the same version of the paste, and like the
+        # listings the connection is held until the stream is read or closed
+        with ExitStack() as stack:
+            cursor = stack.enter_context(self._read_cursor())
+            self._begin_snapshot(cursor)
+            cursor.execute(self._prepare_sql('''
+                SELECT length(content) FROM pastes WHERE id = ?
+            '''), [paste_id])
+            row = cursor.fetchone()
+
+            if row is None:
+                return None
+            return self._iter_content(
+                stack.pop_all(), cursor, paste_id, row[0] or 0)
+
+    def _iter_content(self, stack, cursor, paste_id, length):
+        # Both length() and substr() count characters, not bytes
+        read = 0
+        with stack:
+            for start in range(1, length + 1, STREAM_CHUNK_SIZE):
+                cursor.execute(self._prepare_sql('''
+                    SELECT substr(content, ?, ?) FROM pastes WHERE id = ?
+                '''), [start, STREAM_CHUNK_SIZE, paste_id])
+                row = cursor.fetchone()
+
+                if row is None:
+                    break
+                read += len(row[0])
+                yield row[0].encode('utf-8')
+
+        if read != length:
+            raise ErrorException(
+                'The paste %s changed while it was read' % paste_id)
+
     def get_paste_metadata(self, paste_id):
         with self._read_cursor() as cursor:
             cursor.execute(self._prepare_sql('''
@@ -92,19 +313,131 @@ class DbApi2(object):
             row = cursor.fetchone()
         return row[0] if row else None
 
-    def _get_all_paste_ids(self, filters, fdefaults):
+    def get_expired_paste_ids(self, now, limit):
+        # Expiry times are UNIX timestamps stored as text too, so the pastes
+        # that expired first are found in the (key, value, id) index
         with self._read_cursor() as cursor:
             cursor.execute(self._prepare_sql('''
-                SELECT id, key, value FROM pastes_metadata
-                UNION
-                SELECT id, '', '' FROM pastes
-            '''))
-            rows = cursor.fetchall()
+                SELECT id FROM pastes_metadata
+                WHERE key = ? AND value <= ?
+                ORDER BY value, id
+                LIMIT ?
+            '''), ['expires', '%010d' % now, limit])
+            return [paste_id for (paste_id,) in cursor.fetchall()]
+
+    def delete_paste(self, paste_id):
+        with self._write_cursor() as cursor:
+            cursor.execute(self._prepare_sql('''
+                DELETE FROM pastes_metadata WHERE id = ?
+            '''), [paste_id])
+            cursor.execute(self._prepare_sql('''
+                DELETE FROM pastes WHERE id = ?
+            '''), [paste_id])
+
+    def _compile_filters(self, filters, fdefaults):
+        """
+        Compiles listing filters to the joins and conditions of a query on
+        the pastes table aliased as p, with one join per filtered key. A
+        paste without a filtered key matches if the default of the filter
+        is the value it asks for, otherwise the join is an inner one, so
+        that the database can look the matching pastes up in the
+        (key, value, id) index.
+        :return: the SQL of the joins, the SQL of the WHERE condition, and
+                 the query parameters for both, in order
+        """
+        joins = []
+        conditions = []
+        join_params = []
+        condition_params = []
+
+        for i, (key, value) in enumerate(sorted(filters.items())):
+            alias = 'm%d' % i
+
+            if fdefaults.get(key) == value:
+                joins.append(
+                    'LEFT JOIN pastes_metadata {0} '
+                    'ON {0}.id = p.id AND {0}.key = ?'.format(alias))
+                join_params.append(key)
+                conditions.append(
+                    '({0}.value = ? OR {0}.value IS NULL)'.format(alias))
+                condition_params.append(value)
+            else:
+                joins.append(
+                    'JOIN pastes_metadata {0} '
+                    'ON {0}.id = p.id AND {0}.key = ? AND {0}.value = ?'
+                    .format(alias))
+                join_params.extend([key, value])
+
+        return (' '.join(joins),
+                ' AND '.join(conditions) or '1 = 1',
+                join_params + condition_params)
+
+    def _get_all_paste_ids(self, filters, fdefaults):
+        joins, where, params = self._compile_filters(filters, fdefaults)
+
+        with self._stream_cursor() as cursor:
+            cursor.execute(self._prepare_sql('''
+                SELECT p.id FROM pastes p {0}
+                WHERE {1}
+                ORDER BY p.id
+            '''.format(joins, where)), params)
 
-        for paste_id, rows in groupby(rows, itemgetter(0)):
-            metadata = {key: value for (_, key, value) in rows}
-            if filters_match(metadata, filters, fdefaults):
-                yield paste_id
+            while True:
+                rows = cursor.fetchmany(_FETCH_SIZE)
+                if not rows:
+                    break
+                for (paste_id,) in rows:
+                    yield paste_id
 
     def get_all_paste_ids(self, filters={}, fdefaults={}):
         return list(self._get_all_paste_ids(filters, fdefaults)) or ['none']
+
+    def get_paste_ids_page(self, filters, fdefaults, limit, cursor=None):
+        joins, where, params = self._compile_filters(filters, fdefaults)
+
+        if cursor is not None:
+            where += ' AND p.id > ?'
+            params.append(cursor)
+
+        with self._read_cursor() as db_cursor:
+            db_cursor.execute(self._prepare_sql('''
+                SELECT p.id FROM pastes p {0}
+                WHERE {1}
+                ORDER BY p.id
+                LIMIT ?
+            '''.format(joins, where)), params + [limit + 1])
+            paste_ids = [paste_id for (paste_id,) in db_cursor.fetchall()]
+
+        if len(paste_ids) > limit:
+            return paste_ids[:limit], paste_ids[limit - 1]
+        return paste_ids, None
+
+    def get_recent_paste_ids_page(self, filters, fdefaults, limit,
+                                  cursor=None):
+        joins, where, params = self._compile_filters(filters, fdefaults)
+
+        # Dates are UNIX timestamps stored as text, which sort like numbers
+        # as long as they have the same number of digits, so the ordering
+        # can be served by the (key, value, id) index
+        if cursor is not None:
+            date, _, paste_id = cursor.partition(':')
+            where += ' AND (d.value < ? OR (d.value = ? AND p.id < ?))'
+            params.extend([date, date, paste_id])
+
+        with self._read_cursor() as db_cursor:
+            db_cursor.execute(self._prepare_sql('''
+                SELECT p.id, d.value FROM pastes p
+                JOIN pastes_metadata d ON d.id = p.id AND d.key = ?
+                {0}
+                WHERE {1}
+                ORDER BY d.value DESC, p.id DESC
+                LIMIT ?
+            '''.format(joins, where)), ['date'] + params + [limit + 1])
+            rows = db_cursor.fetchall()
+
+        paste_ids = [paste_id for (paste_id, _) in rows[:limit]]
+
+        if len(rows) > limit:
+            return paste_ids, '%s:%s' % (rows[limit - 1][1],
+                                         rows[limit - 1][0])
+        return paste_ids, None
@@ -65,6 +65,28 @@ def initialize_backend():
     return
 
 
+def initialize_search():
+    """
+    This method is optional, and only needed along with search_paste_ids.
+    It is called after initialize_backend when the search of the pastes is
+    enabled, and only then. Here you can set up the full-text index of the
+    pastes, which must not be kept up to date by the backend before.
+    """
+    return
+
+
+def get_data_path():
+    """
+    This method is optional, and only for the backends that store their data
+    on the machine TorPaste runs on. It should return the path of the file
+    or the directory the data is stored in, next to which the files shared
+    by the TorPaste processes using that data, such as the reaper lock, are
+    kept by default.
+    :return: the path of the data of the backend
+    """
+    return "data"
+
+
 def new_paste(paste_id, paste_content):
     """
     This method is called when the Flask application wants to create a new
@@ -82,6 +104,67 @@ def new_paste(paste_id, paste_content):
     return
 
 
+def new_paste_stream(paste_id, paste_stream):
+    """
+    This method is optional. If your backend can store the contents of a
+    paste in parts, implement it and the Flask application will use it to
+    create pastes instead of new_paste, so that large pastes never have to
+    be held in memory all at once. It must behave exactly like new_paste,
+    except that the content is read from a binary file object holding it in
+    UTF-8, up to the end of the file.
+    :param paste_id: a not necessarily unique id of the paste
+    :param paste_stream: a binary file object with the content of the paste
+                         in UTF-8
+    :return:
+    """
+
+    return
+
+
+def create_paste(paste_id, paste_content, metadata):
+    """
+    This method is optional. If your backend can store the contents and the
+    metadata of a new paste in a single operation, implement it and the
+    Flask application will use it to create pastes instead of calling
+    new_paste and update_paste_metadata one after the other. It is only
+    called for pastes that do not exist yet.
+    :param paste_id: a not necessarily unique id of the paste
+    :param paste_content: content of the paste (utf-8 encoded)
+    :param metadata: dictionary containing the metadata
+    :return:
+    """
+
+    return
+
+
+def create_paste_stream(paste_id, paste_stream, metadata):
+    """
+    This method is optional, and is to create_paste what new_paste_stream
+    is to new_paste.
+    :param paste_id: a not necessarily unique id of the paste
+    :param paste_stream: a binary file object with the content of the paste
+                         in UTF-8
+    :param metadata: dictionary containing the metadata
+    :return:
+    """
+
+    return
+
+
+def create_pastes(pastes):
+    """
+    This method is optional. It must work exactly like calling create_paste
+    for every paste provided, but store them all at once, for instance with
+    a single transaction, so that many pastes can be imported quickly. If
+    the backend does not have this method, the pastes are created one by
+    one instead.
+    :param pastes: a list of (paste id, content, metadata) tuples
+    :return:
+    """
+
+    return
+
+
 def update_paste_metadata(paste_id, metadata):
     """
     This method is called by the Flask application to update a paste's
@@ -124,6 +207,41 @@ def get_paste_contents(paste_id):
     return "Hello"
 
 
+def get_paste(paste_id):
+    """
+    This method is optional. If your backend can fetch the contents and the
+    metadata of a paste in a single operation (for example with one query or
+    one HTTP request), implement it and the Flask application will use it
+    instead of calling does_paste_exist, get_paste_contents and
+    get_paste_metadata one after the other. If the backend does not have
+    this method, the application falls back to those three calls. Unlike
+    the other methods, it is not guaranteed that the Paste ID exists.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return: a (content, metadata) tuple with the content of the paste in
+             UTF-8 encoding and a dictionary with its metadata, or None if
+             a paste with the given ID does not exist
+    """
+
+    return "Hello", {"Key": "Value"}
+
+
+def open_paste_stream(paste_id):
+    """
+    This method is optional. If your backend can read the contents of a
+    paste in parts, implement it and the Flask application will use it to
+    send raw pastes without loading them into memory all at once. It must
+    return an iterable of byte strings which together are the paste content
+    in UTF-8, or a binary file object positioned at the start of the
+    content, which the application sends with sendfile() where possible.
+    Like get_paste, it is not guaranteed that the Paste ID exists.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return: an iterable of byte strings or a binary file object, or None
+             if a paste with the given ID does not exist
+    """
+
+    return [b"Hel", b"lo"]
+
+
 def get_paste_metadata(paste_id):
     """
     This method must return a Python Dictionary with all the currently
@@ -170,3 +288,106 @@ def get_all_paste_ids(filters={}, fdefaults={}):
     """
 
     return ['none']
+
+
+def get_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    """
+    This method is optional. It must return one page of the IDs of the
+    pastes which match the filters provided, exactly like get_all_paste_ids
+    does for all of them, so that the paste listing does not need to load
+    every paste ID at once. Pages are chained by an opaque cursor string of
+    your choice: the first page is requested with no cursor, and every page
+    returns the cursor of the page after it, or None if it is the last one.
+    The pages must not overlap and, unlike get_all_paste_ids, an empty page
+    is an empty list. If the backend does not have this method, the
+    application pages through the results of get_all_paste_ids instead.
+    :param filters: a dictionary of filters
+    :param fdefaults: a dictionary with the default value for each filter
+                      if it's not present
+    :param limit: the maximum number of paste IDs to return
+    :param cursor: the cursor returned with the previous page, or None for
+                   the first page
+    :return: a list with at most limit paste IDs, and the cursor of the next
+             page or None
+    """
+
+    return [], None
+
+
+def get_recent_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    """
+    This method is optional. It must work exactly like get_paste_ids_page,
+    but only return the pastes which have a "date" metadata key, newest
+    first, so that the most recent pastes can be listed. The date is a UNIX
+    timestamp, as a string. This is meant to be backed by an index of the
+    pastes ordered by date, so that the first pages are cheap to get no
+    matter how many pastes are stored. If the backend does not have this
+    method, the paste listing is ordered by Paste ID instead.
+    :param filters: a dictionary of filters
+    :param fdefaults: a dictionary with the default value for each filter
+                      if it's not present
+    :param limit: the maximum number of paste IDs to return
+    :param cursor: the cursor returned with the previous page, or None for
+                   the first page
+    :return: a list with at most limit paste IDs, and the cursor of the next
+             page or None
+    """
+
+    return [], None
+
+
+def search_paste_ids(query, filters, fdefaults, limit, cursor=None):
+    """
+    This method is optional. It must return the IDs of the public pastes
+    which contain all the words of the query, as split by
+    backends.utils.search_terms, in pages like get_paste_ids_page, most
+    recent first. Only the first backends.utils.SEARCH_INDEXED_CHARS
+    characters of every paste need to be searched. This is meant to be
+    backed by a full-text index of the public pastes that is updated as
+    they are stored and as their visibility changes, so that the other
+    pastes are never indexed. If the backend does not have this method,
+    TorPaste searches the pastes through an index of its own, kept in a
+    local file.
+    :param query: the search query, as typed by the user
+    :param filters: a dictionary of filters
+    :param fdefaults: a dictionary with the default value for each filter
+                      if it's not present
+    :param limit: the maximum number of paste IDs to return
+    :param cursor: the cursor returned with the previous page, or None for
+                   the first page
+    :return: a list with at most limit paste IDs, and the cursor of the next
+             page or None
+    """
+
+    return [], None
+
+
+def get_expired_paste_ids(now, limit):
+    """
+    This method is optional. It must return the IDs of the pastes whose
+    "expires" metadata key holds a time at or before the one provided, the
+    ones that expired first first. The expiry time is a UNIX timestamp, as
+    a string, like the date. This is meant to be backed by an index of the
+    pastes ordered by expiry time, so that the expired pastes are found
+    without going through all the others. If the backend does not have this
+    method or delete_paste, expired pastes are hidden but never deleted.
+    :param now: the current time, as a UNIX timestamp
+    :param limit: the maximum number of paste IDs to return
+    :return: a list with at most limit paste IDs
+    """
+
+    return []
+
+
+def delete_paste(paste_id):
+    """
+    This method is optional. It must delete the paste with the given Paste
+    ID, along with all of its metadata and its entries in any index. It is
+    not guaranteed that the Paste ID exists, in which case only the entries
+    an interrupted deletion may have left in the expiry index must be
+    removed, so that get_expired_paste_ids stops returning it.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return:
+    """
+
+    return
@@ -1,9 +1,41 @@
 #!../bin/python
 # -*- coding: utf-8 -*-
 
+"""
+This is the filesystem backend, which stores every paste as a file under
+pastes/<first two characters of the id>/<next two characters>/<id>.
+
+Each paste is a single record file, which starts with a short header holding
+the paste metadata, followed by the paste content:
+
+    \\x00TPR1\\n
+    {"date": "1500000000", "visibility": "public"}\\n
+    <paste content in UTF-8>
+
+Older versions of this backend stored only the content in that file, and every
+metadata key in a separate <id>.<key> file next to it. Such pastes are still
+supported and are converted to the record format the first time they are read.
+"""
+
 import backends.exceptions as e
+import json
 import os
-import codecs
+import shutil
+import time
+from bisect import bisect_right
+from itertools import islice
+
+from backends.filesystem_index import FilesystemIndex
+from backends.utils import filters_match
+
+# Metadata keys that the paste listing can be filtered on without opening
+# every paste's metadata.
+_INDEXED_KEYS = ["visibility"]
+
+# The first bytes of every paste stored in the record format
+_RECORD_MAGIC = b"\x00TPR1\n"
+
+_index = FilesystemIndex("pastes/.index", _INDEXED_KEYS)
 
 
 def initialize_backend():
@@ -15,6 +47,194 @@ def initialize_backend():
 
     os.makedirs("pastes", exist_ok=True)
 
+    _index.ensure_built(_walk_pastes)
+
+
+def get_data_path():
+    return os.path.abspath("pastes")
+
+
+def _walk_pastes():
+    """
+    This method walks the entire paste tree and yields the Paste ID and the
+    metadata of every paste. It is only used to build the listing index.
+    """
+
+    for i in os.listdir("pastes"):
+        if "." in i:
+            continue
+        for j in os.listdir("pastes/" + i):
+            if "." in j:
+                continue
+            for k in os.listdir("pastes/" + i + "/" + j):
+                if "." in k:
+                    continue
+                yield k, _read_metadata(k, convert=False)
+
+
+def _paste_dir(paste_id):
+    return "pastes/" + paste_id[0:2] + "/" + paste_id[2:4]
+
+
+def _paste_path(paste_id):
+    return _paste_dir(paste_id) + "/" + paste_id
+
+
+def _load_paste(paste_id):
+    """
+    This method reads a paste from disk, in either the record or the legacy
+    format, without converting it.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return: a (content, metadata, legacy) tuple, where content is the
+             paste content in UTF-8 bytes, and legacy is True if the paste
+             is still stored in the legacy format
+    """
+
+    with open(_paste_path(paste_id), "rb") as fd:
+        metadata = _read_header(fd)
+        content = fd.read()
+
+    if metadata is None:
+        return content, _load_legacy_metadata(paste_id), True
+    return content, metadata, False
+
+
+def _read_header(fd):
+    """
+    This method reads the metadata header at the start of a paste file, and
+    leaves the file positioned at the start of the paste content.
+    :param fd: a binary file object of the paste, positioned at its start
+    :return: a dictionary with the metadata of the paste, or None if the
+             paste is stored in the legacy format, which has no header
+    """
+
+    if fd.read(len(_RECORD_MAGIC)) != _RECORD_MAGIC:
+        fd.seek(0)
+        return None
+    return json.loads(fd.readline().decode("utf-8"))
+
+
+def _load_legacy_metadata(paste_id):
+    metadata = {}
+    for f in _legacy_metadata_files(paste_id):
+        with open(_paste_dir(paste_id) + "/" + f, "rb") as fd:
+            metadata[f[len(paste_id) + 1:]] = fd.read().decode("utf-8")
+
+    return metadata
+
+
+def _is_record(paste_id):
+    with open(_paste_path(paste_id), "rb") as fd:
+        return fd.read(len(_RECORD_MAGIC)) == _RECORD_MAGIC
+
+
+def _legacy_metadata_files(paste_id):
+    return [
+        f for f in os.listdir(_paste_dir(paste_id))
+        if f.startswith(paste_id + ".")
+    ]
+
+
+def _write_paste(paste_id, paste_content, metadata):
+    """
+    This method atomically replaces a paste on disk with a record holding
+    the given content and metadata. The content is either a string, UTF-8
+    bytes, or a binary file object to copy it from.
+    """
+
+    tmp = _paste_dir(paste_id) + "/." + paste_id + ".tmp"
+
+    # The content is synced before the rename, so that a crash never leaves
+    # a paste that was replaced empty or cut short, and the directory after
+    # it, so that the paste is not lost once the write returned
+    with open(tmp, "wb") as fd:
+        fd.write(
+            _RECORD_MAGIC +
+            json.dumps(metadata).encode("utf-8") + b"\n"
+        )
+        if isinstance(paste_content, str):
+            fd.write(paste_content.encode("utf-8"))
+        elif isinstance(paste_content, bytes):
+            fd.write(paste_content)
+        else:
+            shutil.copyfileobj(paste_content, fd)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+    os.replace(tmp, _paste_path(paste_id))
+    _fsync_dir(_paste_dir(paste_id))
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _make_paste_dir(paste_id):
+    """
+    This method creates the directory of a paste if it does not exist, and
+    syncs the directories it was created in, so that the pastes written to
+    it are not lost with it after a crash.
+    """
+
+    path = _paste_dir(paste_id)
+    if os.path.isdir(path):
+        return
+
+    os.makedirs(path, exist_ok=True)
+    _fsync_dir(os.path.dirname(path))
+    _fsync_dir("pastes")
+
+
+def _remove_legacy_metadata(paste_id):
+    for f in _legacy_metadata_files(paste_id):
+        os.remove(_paste_dir(paste_id) + "/" + f)
+
+
+def _read_paste(paste_id):
+    """
+    This method reads a paste from disk and converts it to the record format
+    if it is still stored in the legacy one.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return: a (content, metadata) tuple, where content is the paste
+             content in UTF-8 bytes
+    """
+
+    content, metadata, legacy = _load_paste(paste_id)
+
+    if legacy:
+        with _index.locked():
+            # Another worker may have changed the paste in the meantime
+            content, metadata, legacy = _load_paste(paste_id)
+            if legacy:
+                _write_paste(paste_id, content, metadata)
+                _remove_legacy_metadata(paste_id)
+
+    return content, metadata
+
+
+def _read_metadata(paste_id, convert=True):
+    """
+    This method reads the metadata of a paste from disk. Only the header of
+    pastes stored in the record format is read, however large they are.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :param convert: whether to convert the paste to the record format if it
+                    is still stored in the legacy one
+    :return: a dictionary with the metadata of the paste
+    """
+
+    with open(_paste_path(paste_id), "rb") as fd:
+        metadata = _read_header(fd)
+
+    if metadata is not None:
+        return metadata
+    if convert:
+        return _read_paste(paste_id)[1]
+    return _load_legacy_metadata(paste_id)
+
 
 def new_paste(paste_id, paste_content):
     """
@@ -29,20 +249,42 @@ def new_paste(paste_id, paste_content):
     :return:
     """
 
-    a = paste_id[0:2]
-    b = paste_id[2:4]
+    _new_paste(paste_id, paste_content)
 
-    os.makedirs("pastes/" + a + "/" + b, exist_ok=True)
 
-    ppath = "pastes/" + a + "/" + b + "/" + paste_id
+def new_paste_stream(paste_id, paste_stream):
+    """
+    This method creates a new paste like new_paste, but copies its content
+    from a binary file object instead of a string.
+    :param paste_id: a not necessarily unique id of the paste
+    :param paste_stream: a binary file object with the content of the paste
+                         in UTF-8
+    :return:
+    """
+
+    _new_paste(paste_id, paste_stream)
+
+
+def _new_paste(paste_id, paste_content):
+    _make_paste_dir(paste_id)
 
     try:
-        with codecs.open(
-            ppath,
-            encoding="utf-8",
-            mode="w+"
-        ) as fd:
-            fd.write(paste_content)
+        with _index.locked():
+            if not os.path.isfile(_paste_path(paste_id)):
+                metadata, legacy = None, False
+            elif _is_record(paste_id):
+                # Paste IDs are the hash of the content, so a paste that
+                # already exists has that content already
+                return
+            else:
+                metadata, legacy = _load_paste(paste_id)[1:]
+
+            _write_paste(paste_id, paste_content, metadata or {})
+
+            if legacy:
+                _remove_legacy_metadata(paste_id)
+            if metadata is None:
+                _index.record(paste_id, None, {})
     except Exception:
         raise e.ErrorException(
             "An issue occurred with the local filesystem. Please try again " +
@@ -53,31 +295,51 @@ def new_paste(paste_id, paste_content):
     return
 
 
-def update_paste_metadata(paste_id, metadata):
+def create_paste(paste_id, paste_content, metadata):
     """
-    This method is called by the Flask application to update a paste's
-    metadata. For this to happen, the application passes the Paste ID,
-    which is typically an ASCII string, as well as a Python dictionary
-    that contains the new metadata. This method must overwrite any and
-    all metadata with the passed dictionary. For example, if a paste has
-    the keys a and b and this method is called with only keys b and c,
-    the final metadata must be b and c only, and not a.
-    :param paste_id: ASCII coded id of the paste
+    This method creates a new paste along with its metadata, by writing a
+    single record file, so that the paste never exists without its
+    metadata.
+    :param paste_id: a not necessarily unique id of the paste
+    :param paste_content: content of the paste (utf-8 encoded)
     :param metadata: dictionary containing the metadata
     :return:
     """
 
-    a = paste_id[0:2]
-    b = paste_id[2:4]
+    _create_paste(paste_id, paste_content, metadata)
 
-    os.makedirs("pastes/" + a + "/" + b, exist_ok=True)
 
-    ppath = "pastes/" + a + "/" + b + "/" + paste_id
+def create_paste_stream(paste_id, paste_stream, metadata):
+    """
+    This method creates a new paste like create_paste, but copies its
+    content from a binary file object instead of a string.
+    :param paste_id: a not necessarily unique id of the paste
+    :param paste_stream: a binary file object with the content of the paste
+                         in UTF-8
+    :param metadata: dictionary containing the metadata
+    :return:
+    """
+
+    _create_paste(paste_id, paste_stream, metadata)
+
+
+def _create_paste(paste_id, paste_content, metadata):
+    _make_paste_dir(paste_id)
 
     try:
-        for j in os.listdir("pastes/" + a + "/" + b):
-            if ("." in j) and (paste_id in j):
-                os.remove("pastes/" + a + "/" + b + "/" + j)
+        with _index.locked():
+            # Another worker may have created the paste in the meantime
+            if os.path.isfile(_paste_path(paste_id)):
+                old_metadata, legacy = _load_paste(paste_id)[1:]
+            else:
+                old_metadata, legacy = None, False
+
+            _write_paste(paste_id, paste_content, metadata)
+
+            if legacy:
+                _remove_legacy_metadata(paste_id)
+
+            _index.record(paste_id, old_metadata, metadata)
     except Exception:
         raise e.ErrorException(
             "An issue occurred with the local filesystem. Please try again " +
@@ -85,14 +347,33 @@ def update_paste_metadata(paste_id, metadata):
             "administrator."
         )
 
+    return
+
+
+def update_paste_metadata(paste_id, metadata):
+    """
+    This method is called by the Flask application to update a paste's
+    metadata. For this to happen, the application passes the Paste ID,
+    which is typically an ASCII string, as well as a Python dictionary
+    that contains the new metadata. This method must overwrite any and
+    all metadata with the passed dictionary. For example, if a paste has
+    the keys a and b and this method is called with only keys b and c,
+    the final metadata must be b and c only, and not a.
+    :param paste_id: ASCII coded id of the paste
+    :param metadata: dictionary containing the metadata
+    :return:
+    """
+
     try:
-        for k, v in metadata.items():
-            with codecs.open(
-                ppath + "." + k,
-                encoding="utf-8",
-                mode="w+"
-            ) as fd:
-                fd.write(v)
+        with _index.locked():
+            content, old_metadata, legacy = _load_paste(paste_id)
+
+            _write_paste(paste_id, content, metadata)
+
+            if legacy:
+                _remove_legacy_metadata(paste_id)
+
+            _index.record(paste_id, old_metadata, metadata)
     except Exception:
         raise e.ErrorException(
             "An issue occurred with the local filesystem. Please try again " +
@@ -113,10 +394,7 @@ def does_paste_exist(paste_id):
     :return: True if paste with given ID exists, false otherwise
     """
 
-    a = paste_id[0:2]
-    b = paste_id[2:4]
-
-    return os.path.isfile("pastes/" + a + "/" + b + "/" + paste_id)
+    return os.path.isfile(_paste_path(paste_id))
 
 
 def get_paste_contents(paste_id):
@@ -128,16 +406,29 @@ def get_paste_contents(paste_id):
     :return: the content of the paste in UTF-8 encoding
     """
 
-    a = paste_id[0:2]
-    b = paste_id[2:4]
+    try:
+        return _read_paste(paste_id)[0].decode("utf-8")
+    except Exception:
+        raise e.ErrorException(
+            "An issue occurred with the local filesystem. Please try again " +
+            "later. If the problem persists, try notifying a system " +
+            "administrator."
+        )
+
+
+def get_paste(paste_id):
+    """
+    This method returns the contents and the metadata of the paste with the
+    given Paste ID with a single read, or None if it does not exist.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return: a (content, metadata) tuple, or None if the paste doesn't exist
+    """
 
     try:
-        with codecs.open(
-            "pastes/" + a + "/" + b + "/" + paste_id,
-            encoding="utf-8",
-            mode="r"
-        ) as fd:
-            return fd.read()
+        content, metadata = _read_paste(paste_id)
+        return content.decode("utf-8"), metadata
+    except FileNotFoundError:
+        return None
     except Exception:
         raise e.ErrorException(
             "An issue occurred with the local filesystem. Please try again " +
@@ -146,6 +437,39 @@ def get_paste_contents(paste_id):
         )
 
 
+def open_paste_stream(paste_id):
+    """
+    This method opens the paste with the given Paste ID for streaming its
+    contents. The file is returned positioned at the start of the content,
+    so that the server can send it with sendfile() where it is supported.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return: a binary file object, or None if the paste doesn't exist
+    """
+
+    try:
+        fd = open(_paste_path(paste_id), "rb")
+    except FileNotFoundError:
+        return None
+    except Exception:
+        raise e.ErrorException(
+            "An issue occurred with the local filesystem. Please try again " +
+            "later. If the problem persists, try notifying a system " +
+            "administrator."
+        )
+
+    try:
+        _read_header(fd)
+    except Exception:
+        fd.close()
+        raise e.ErrorException(
+            "An issue occurred with the local filesystem. Please try again " +
+            "later. If the problem persists, try notifying a system " +
+            "administrator."
+        )
+
+    return fd
+
+
 def get_paste_metadata(paste_id):
     """
     This method must return a Python Dictionary with all the currently
@@ -156,21 +480,8 @@ def get_paste_metadata(paste_id):
     :return: a dictionary with the metadata of a given paste
     """
 
-    a = paste_id[0:2]
-    b = paste_id[2:4]
-
-    ret = {}
-
     try:
-        for f in os.listdir("pastes/" + a + "/" + b + "/"):
-            if (paste_id in f) and ("." in f):
-                t = f.split(".")[1]
-                with codecs.open(
-                    "pastes/" + a + "/" + b + "/" + f,
-                    encoding="utf-8",
-                    mode="r"
-                ) as fd:
-                    ret[t] = fd.read()
+        ret = _read_metadata(paste_id)
     except Exception:
         raise e.ErrorException(
             "An issue occurred with the local filesystem. Please try again " +
@@ -207,6 +518,59 @@ def get_paste_metadata_value(paste_id, key):
         return None
 
 
+def get_expired_paste_ids(now, limit):
+    """
+    This method returns the IDs of the pastes whose "expires" metadata key
+    holds a time at or before the given one, the ones that expired first
+    first. It is used to delete the expired pastes in batches.
+    :param now: the current time, as a UNIX timestamp
+    :param limit: the maximum number of Paste IDs to return
+    :return: a list of Paste IDs
+    """
+
+    try:
+        return _index.expired(now, limit)
+    except Exception:
+        raise e.ErrorException(
+            "An issue occurred with the local filesystem. Please try again " +
+            "later. If the problem persists, try notifying a system " +
+            "administrator."
+        )
+
+
+def delete_paste(paste_id):
+    """
+    This method deletes the paste with the given Paste ID, along with all of
+    its metadata. If the paste does not exist, it is only removed from the
+    expiry index, where an interrupted deletion may have left it.
+    :param paste_id: ASCII string which represents the ID of the paste
+    :return:
+    """
+
+    try:
+        with _index.locked():
+            try:
+                legacy = not _is_record(paste_id)
+            except FileNotFoundError:
+                _index.forget_expired(paste_id, time.time())
+                return
+
+            if legacy:
+                old_metadata = _load_paste(paste_id)[1]
+                _remove_legacy_metadata(paste_id)
+            else:
+                old_metadata = _read_metadata(paste_id)
+            os.remove(_paste_path(paste_id))
+
+            _index.record(paste_id, old_metadata, None)
+    except Exception:
+        raise e.ErrorException(
+            "An issue occurred with the local filesystem. Please try again " +
+            "later. If the problem persists, try notifying a system " +
+            "administrator."
+        )
+
+
 def get_all_paste_ids(filters={}, fdefaults={}):
     """
     This method must return a Python list containing the ASCII ID of all
@@ -220,19 +584,78 @@ def get_all_paste_ids(filters={}, fdefaults={}):
     :return: a list containing all paste IDs
     """
 
-    allPastes = []
+    matches, remaining = _find_pastes(filters, fdefaults)
+
+    filtered = list(_filter_pastes(matches, remaining, fdefaults))
+
+    if len(filtered) == 0:
+        filtered = ['none']
+
+    return filtered
+
+
+def get_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    """
+    This method returns one page of the IDs of the pastes which match the
+    filters provided, in the order of their IDs. The cursor of a page is the
+    last Paste ID of the page before it.
+    :param filters: a dictionary of filters
+    :param fdefaults: a dictionary with the default value for each filter
+                      if it's not present
+    :param limit: the maximum number of paste IDs to return
+    :param cursor: the cursor returned with the previous page, or None for
+                   the first page
+    :return: a list with at most limit paste IDs, and the cursor of the next
+             page or None
+    """
+
+    paste_ids, remaining = _find_pastes(filters, fdefaults, ordered=True)
+    start = 0 if cursor is None else bisect_right(paste_ids, cursor)
+
+    page = list(islice(_filter_pastes(
+        (paste_ids[i] for i in range(start, len(paste_ids))),
+        remaining, fdefaults), limit + 1))
+
+    if len(page) > limit:
+        return page[:limit], page[limit - 1]
+    return page, None
+
+
+def get_recent_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    """
+    This method returns one page of the IDs of the pastes which have a date
+    and match the filters provided, newest first, using the date manifests
+    of the index. The cursor of a page is the date and the Paste ID of the
+    last paste of the page before it.
+    :param filters: a dictionary of filters
+    :param fdefaults: a dictionary with the default value for each filter
+                      if it's not present
+    :param limit: the maximum number of paste IDs to return
+    :param cursor: the cursor returned with the previous page, or None for
+                   the first page
+    :return: a list with at most limit paste IDs, and the cursor of the next
+             page or None
+    """
+
+    if cursor is not None:
+        date, _, paste_id = cursor.partition(":")
+        try:
+            cursor = (int(date), paste_id)
+        except ValueError:
+            raise e.ErrorException(
+                "This page of the paste listing does not exist."
+            )
 
     try:
-        for i in os.listdir("pastes"):
-            if "." in i:
+        pastes, remaining = _index.recent(filters, fdefaults, cursor)
+
+        page = []
+        for date, paste_id in pastes:
+            if not _matches(paste_id, remaining, fdefaults):
                 continue
-            for j in os.listdir("pastes/" + i):
-                if "." in j:
-                    continue
-                for k in os.listdir("pastes/" + i + "/" + j):
-                    if "." in k:
-                        continue
-                    allPastes.append(k)
+            page.append((date, paste_id))
+            if len(page) > limit:
+                break
     except Exception:
         raise e.ErrorException(
             "An issue occurred with the local filesystem. Please try again " +
@@ -240,25 +663,48 @@ def get_all_paste_ids(filters={}, fdefaults={}):
             "administrator."
         )
 
-    filtered = []
-    for p in allPastes:
-        keep = True
+    paste_ids = [paste_id for _, paste_id in page[:limit]]
 
-        try:
-            for k, v in filters.items():
-                gpmv = get_paste_metadata_value(p, k)
-                if gpmv is None:
-                    gpmv = fdefaults[k]
-                if gpmv != v:
-                    keep = False
-                    break
-        except (e.ErrorException, e.WarningException):
-            keep = False
-
-        if keep:
-            filtered.append(p)
+    if len(page) > limit:
+        return paste_ids, "%d:%s" % page[limit - 1]
+    return paste_ids, None
 
-    if len(filtered) == 0:
-        filtered = ['none']
 
-    return filtered
+def _find_pastes(filters, fdefaults, ordered=False):
+    """
+    This method looks up the pastes matching the filters in the index, as a
+    set, or as a sorted list if ordered is True.
+    """
+    try:
+        if ordered:
+            return _index.find_sorted(filters, fdefaults)
+        return _index.find(filters, fdefaults)
+    except Exception:
+        raise e.ErrorException(
+            "An issue occurred with the local filesystem. Please try again " +
+            "later. If the problem persists, try notifying a system " +
+            "administrator."
+        )
+
+
+def _filter_pastes(paste_ids, filters, fdefaults):
+    """
+    This method yields the pastes that match filters which the index could
+    not answer, by checking the metadata of every paste.
+    """
+
+    for p in paste_ids:
+        if _matches(p, filters, fdefaults):
+            yield p
+
+
+def _matches(paste_id, filters, fdefaults):
+    if not filters:
+        return True
+
+    try:
+        metadata = _read_metadata(paste_id)
+    except Exception:
+        return False
+
+    return filters_match(metadata, filters, fdefaults)
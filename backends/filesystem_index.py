@@ -0,0 +1,577 @@
+#!../bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the on-disk metadata index used by the filesystem backend
+so that listing pastes does not have to walk the whole paste tree and open
+every metadata file.
+
+The index lives under its own directory and is made of append-only posting
+lists, one per (metadata key, value) pair of every indexed key, plus one list
+per indexed key with the pastes that do not have that key at all, and one
+list with every paste. Each line of a posting list is either "+<paste id>" or
+"-<paste id>", and the current members of a list are found by replaying it.
+Lists are compacted once they carry more removals than members.
+
+Pastes that have a date are also listed in date manifests, one per day, so
+that the most recent pastes can be found by reading the manifests of the
+last few days only. Each line of a manifest is either "+<date> <paste id>
+<indexed metadata>" or "-<paste id>", and is replayed in the same way.
+
+Pastes that expire are listed in expiry manifests, one per hour, so that the
+pastes that have expired are found by reading the manifests of the hours
+that have passed only. Each line of an expiry manifest is either "+<expiry
+time> <paste id>" or "-<paste id>", and a manifest is removed once all of
+its pastes have been deleted.
+
+All writers serialize on an exclusive flock() of the lock file, and readers
+hold a shared one, so the index is safe to use from several Gunicorn workers
+at the same time.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from backends.utils import filters_match
+
+# Bump this whenever the on-disk layout of the index changes, so that the
+# index gets rebuilt from the paste tree on the next start.
+_INDEX_VERSION = 3
+
+# The metadata key holding the creation date of a paste, as a UNIX timestamp
+_DATE_KEY = "date"
+
+# The time span covered by each date manifest, in seconds
+_BUCKET_SECONDS = 86400
+
+# The metadata key holding the time a paste expires at, as a UNIX timestamp
+_EXPIRY_KEY = "expires"
+
+# The time span covered by each expiry manifest, in seconds
+_EXPIRY_BUCKET_SECONDS = 3600
+
+# Lists with less removals than this are never compacted.
+_COMPACT_MIN_REMOVALS = 1024
+
+# The number of sorted lookups kept by every process, one for every
+# combination of filters the pages of a listing were recently read with
+_SORTED_CACHE_SIZE = 2
+
+
+class FilesystemIndex(object):
+    def __init__(self, path, keys):
+        self._path = path
+        self._keys = keys
+
+        # (filters, defaults) -> (generation of the lists, sorted Paste IDs)
+        self._sorted = {}
+
+    def _lock_path(self):
+        return os.path.join(self._path, "lock")
+
+    def _version_path(self):
+        return os.path.join(self._path, "version")
+
+    def _all_path(self):
+        return os.path.join(self._path, "all")
+
+    def _key_path(self, key):
+        return os.path.join(self._path, "keys", quote(key, safe=""))
+
+    def _value_path(self, key, value):
+        return os.path.join(self._key_path(key), "=" + quote(value, safe=""))
+
+    def _absent_path(self, key):
+        return os.path.join(self._key_path(key), "absent")
+
+    def _dates_path(self):
+        return os.path.join(self._path, "dates")
+
+    def _bucket_path(self, date):
+        return os.path.join(self._dates_path(), str(date // _BUCKET_SECONDS))
+
+    def _expiry_path(self):
+        return os.path.join(self._path, "expiry")
+
+    def _expiry_bucket_path(self, expires):
+        return os.path.join(
+            self._expiry_path(), str(expires // _EXPIRY_BUCKET_SECONDS))
+
+    def _version(self):
+        return json.dumps({"version": _INDEX_VERSION, "keys": self._keys})
+
+    def _paths_for(self, metadata):
+        """
+        Returns the paths of all the posting lists a paste with the given
+        metadata must be a member of.
+        """
+        paths = [self._all_path()]
+        for key in self._keys:
+            if key in metadata:
+                paths.append(self._value_path(key, metadata[key]))
+            else:
+                paths.append(self._absent_path(key))
+        return paths
+
+    def _date_entry(self, metadata):
+        """
+        Returns the date and the indexed metadata of a paste with the given
+        metadata, or None if it has no valid date.
+        """
+        try:
+            date = int(metadata[_DATE_KEY])
+        except (KeyError, ValueError):
+            return None
+        if date < 0:
+            return None
+
+        return date, {k: v for k, v in metadata.items() if k in self._keys}
+
+    def _expiry(self, metadata):
+        """
+        Returns the time a paste with the given metadata expires at, or None
+        if it never expires.
+        """
+        try:
+            expires = int(metadata[_EXPIRY_KEY])
+        except (KeyError, ValueError):
+            return None
+        if expires < 0:
+            return None
+
+        return expires
+
+    def _date_line(self, paste_id, entry):
+        date, values = entry
+        return "+%d %s %s" % (date, paste_id, json.dumps(values))
+
+    @contextmanager
+    def _flock(self, operation):
+        fd = os.open(self._lock_path(), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def locked(self):
+        """
+        Returns a context manager holding the exclusive index lock. Callers
+        must hold it while changing a paste and calling record().
+        """
+        return self._flock(fcntl.LOCK_EX)
+
+    def _shared(self):
+        return self._flock(fcntl.LOCK_SH)
+
+    def is_built(self):
+        try:
+            with open(self._version_path(), "r") as fd:
+                return fd.read() == self._version()
+        except OSError:
+            return False
+
+    def ensure_built(self, pastes):
+        """
+        Builds the index from scratch, unless it is already built and up to
+        date. Only one process builds the index, the others wait for it.
+        :param pastes: a callable returning an iterable of (paste id,
+                       metadata) tuples for every stored paste
+        """
+        os.makedirs(self._path, exist_ok=True)
+
+        if self.is_built():
+            return
+
+        with self.locked():
+            if self.is_built():
+                return
+
+            shutil.rmtree(os.path.join(self._path, "keys"), ignore_errors=True)
+            shutil.rmtree(self._dates_path(), ignore_errors=True)
+            shutil.rmtree(self._expiry_path(), ignore_errors=True)
+
+            lists = {self._all_path(): []}
+            for paste_id, metadata in pastes():
+                for path in self._paths_for(metadata):
+                    lists.setdefault(path, []).append("+" + paste_id)
+
+                entry = self._date_entry(metadata)
+                if entry is not None:
+                    lists.setdefault(self._bucket_path(entry[0]), []).append(
+                        self._date_line(paste_id, entry))
+
+                expires = self._expiry(metadata)
+                if expires is not None:
+                    lists.setdefault(
+                        self._expiry_bucket_path(expires), []).append(
+                        "+%d %s" % (expires, paste_id))
+
+            for path, lines in lists.items():
+                self._write_atomic(
+                    path, "".join(line + "\n" for line in lines))
+
+            self._write_atomic(self._version_path(), self._version())
+
+    def record(self, paste_id, old_metadata, new_metadata):
+        """
+        Updates the index after a paste has been created, deleted or its
+        metadata has been changed. The caller must hold the lock from
+        locked().
+        :param paste_id: the ID of the changed paste
+        :param old_metadata: the metadata before the change, or None if the
+                             paste did not exist before
+        :param new_metadata: the metadata after the change, or None if the
+                             paste was deleted
+        """
+        old_paths = [] if old_metadata is None else \
+            self._paths_for(old_metadata)
+        new_paths = [] if new_metadata is None else \
+            self._paths_for(new_metadata)
+
+        for path in old_paths:
+            if path not in new_paths:
+                self._append(path, "-" + paste_id)
+        for path in new_paths:
+            if path not in old_paths:
+                self._append(path, "+" + paste_id)
+
+        old_entry = None if old_metadata is None else \
+            self._date_entry(old_metadata)
+        new_entry = None if new_metadata is None else \
+            self._date_entry(new_metadata)
+
+        if old_entry != new_entry:
+            if old_entry is not None:
+                self._append(self._bucket_path(old_entry[0]), "-" + paste_id)
+            if new_entry is not None:
+                self._append(
+                    self._bucket_path(new_entry[0]),
+                    self._date_line(paste_id, new_entry))
+
+        old_expires = None if old_metadata is None else \
+            self._expiry(old_metadata)
+        new_expires = None if new_metadata is None else \
+            self._expiry(new_metadata)
+
+        if old_expires != new_expires:
+            if old_expires is not None:
+                self._append(
+                    self._expiry_bucket_path(old_expires), "-" + paste_id)
+            if new_expires is not None:
+                self._append(
+                    self._expiry_bucket_path(new_expires),
+                    "+%d %s" % (new_expires, paste_id))
+
+    def find(self, filters, fdefaults):
+        """
+        Looks up all pastes matching the filters on the indexed keys.
+        :param filters: a dictionary of filters
+        :param fdefaults: a dictionary with the default value for each filter
+                          if it's not present
+        :return: a set with the matching Paste IDs, and a dictionary with
+                 the filters that could not be answered by the index and
+                 must still be checked against the metadata of every paste
+        """
+        indexed = {k: v for k, v in filters.items() if k in self._keys}
+        remaining = {k: v for k, v in filters.items() if k not in indexed}
+
+        to_compact = []
+
+        with self._shared():
+            if not indexed:
+                matches = self._read_list(self._all_path(), to_compact)
+
+            else:
+                matches = None
+                for key, value in indexed.items():
+                    candidates = self._read_list(
+                        self._value_path(key, value), to_compact)
+                    if fdefaults.get(key) == value:
+                        candidates |= self._read_list(
+                            self._absent_path(key), to_compact)
+                    if matches is None:
+                        matches = candidates
+                    else:
+                        matches &= candidates
+
+        for path in to_compact:
+            self._compact(path)
+
+        return matches, remaining
+
+    def find_sorted(self, filters, fdefaults):
+        """
+        Looks up all pastes matching the filters on the indexed keys, like
+        find, in the order of their IDs. The sorted list is kept until one
+        of the posting lists it was read from changes, so that going
+        through all the pages of a listing reads and sorts them only once.
+        The list returned must not be changed.
+        :return: a sorted list with the matching Paste IDs, and a dictionary
+                 with the filters that could not be answered by the index
+        """
+        indexed = {k: v for k, v in filters.items() if k in self._keys}
+        remaining = {k: v for k, v in filters.items() if k not in indexed}
+
+        paths = [] if indexed else [self._all_path()]
+        for key, value in sorted(indexed.items()):
+            paths.append(self._value_path(key, value))
+            if fdefaults.get(key) == value:
+                paths.append(self._absent_path(key))
+
+        # The generation is read before the lists, so that a change made in
+        # between is only ever seen as a newer generation
+        with self._shared():
+            generation = self._generation(paths)
+
+        key = tuple(paths)
+        cached = self._sorted.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1], remaining
+
+        matches, remaining = self.find(filters, fdefaults)
+        paste_ids = sorted(matches)
+
+        if key not in self._sorted and \
+                len(self._sorted) >= _SORTED_CACHE_SIZE:
+            self._sorted.pop(next(iter(self._sorted)))
+        self._sorted[key] = (generation, paste_ids)
+
+        return paste_ids, remaining
+
+    def _generation(self, paths):
+        """
+        Returns what identifies the current contents of posting lists, which
+        only ever grow by appending, or are replaced whole when compacted.
+        """
+        generation = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                generation.append(
+                    (stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                generation.append(None)
+        return generation
+
+    def recent(self, filters, fdefaults, cursor=None):
+        """
+        Looks up the pastes that have a date, newest first, and that match
+        the filters on the indexed keys.
+        :param filters: a dictionary of filters
+        :param fdefaults: a dictionary with the default value for each filter
+                          if it's not present
+        :param cursor: a (date, paste id) tuple, to only look up the pastes
+                       that come after it, or None
+        :return: an iterator of (date, paste id) tuples, and a dictionary
+                 with the filters that could not be answered by the index
+        """
+        indexed = {k: v for k, v in filters.items() if k in self._keys}
+        remaining = {k: v for k, v in filters.items() if k not in indexed}
+
+        return self._recent(indexed, fdefaults, cursor), remaining
+
+    def _recent(self, filters, fdefaults, cursor):
+        try:
+            buckets = sorted(
+                (int(b) for b in os.listdir(self._dates_path())
+                 if b.isdigit()),
+                reverse=True)
+        except FileNotFoundError:
+            return
+
+        for bucket in buckets:
+            if cursor is not None and bucket > cursor[0] // _BUCKET_SECONDS:
+                continue
+
+            path = os.path.join(self._dates_path(), str(bucket))
+            to_compact = []
+
+            # The lock is not held while the caller goes through the pastes
+            with self._shared():
+                entries = self._read_dates(path, to_compact)
+
+            for path in to_compact:
+                self._compact_dates(path)
+
+            pastes = sorted(
+                ((date, paste_id) for paste_id, (date, values)
+                 in entries.items()
+                 if filters_match(values, filters, fdefaults)),
+                reverse=True)
+
+            for date, paste_id in pastes:
+                if cursor is None or (date, paste_id) < cursor:
+                    yield date, paste_id
+
+    def expired(self, now, limit):
+        """
+        Looks up the pastes that expired at or before the given time, the
+        ones that expired first first.
+        :param now: the current time, as a UNIX timestamp
+        :param limit: the maximum number of pastes to look up
+        :return: a list with the matching Paste IDs
+        """
+        try:
+            buckets = sorted(
+                int(b) for b in os.listdir(self._expiry_path())
+                if b.isdigit())
+        except FileNotFoundError:
+            return []
+
+        paste_ids = []
+        for bucket in buckets:
+            if bucket > now // _EXPIRY_BUCKET_SECONDS or \
+                    len(paste_ids) >= limit:
+                break
+
+            path = os.path.join(self._expiry_path(), str(bucket))
+            with self._shared():
+                entries = self._read_expiry(path)
+
+            if not entries and bucket < now // _EXPIRY_BUCKET_SECONDS:
+                self._remove_expiry(path)
+                continue
+
+            paste_ids.extend(paste_id for expires, paste_id in sorted(
+                (expires, paste_id) for paste_id, expires in entries.items()
+                if expires <= now))
+
+        return paste_ids[:limit]
+
+    def forget_expired(self, paste_id, now):
+        """
+        Removes a paste that no longer exists from the expiry manifests of
+        the hours that have passed, where a deletion that was interrupted
+        may have left it. The caller must hold the lock from locked().
+        :param now: the current time, as a UNIX timestamp
+        """
+        try:
+            buckets = [
+                int(b) for b in os.listdir(self._expiry_path())
+                if b.isdigit()]
+        except FileNotFoundError:
+            return
+
+        for bucket in buckets:
+            if bucket > now // _EXPIRY_BUCKET_SECONDS:
+                continue
+
+            path = os.path.join(self._expiry_path(), str(bucket))
+            if paste_id in self._read_expiry(path):
+                self._append(path, "-" + paste_id)
+
+    def _read_expiry(self, path):
+        entries = {}
+
+        try:
+            with open(path, "r", encoding="ascii") as fd:
+                for line in fd:
+                    if not line.endswith("\n"):
+                        continue
+                    if line[0] == "+":
+                        expires, paste_id = line[1:-1].split(" ", 1)
+                        entries[paste_id] = int(expires)
+                    else:
+                        entries.pop(line[1:-1], None)
+        except FileNotFoundError:
+            pass
+
+        return entries
+
+    def _remove_expiry(self, path):
+        """
+        Removes an expiry manifest of an hour that has passed once all of
+        its pastes have been deleted, so that it is never read again.
+        """
+        with self.locked():
+            if not self._read_expiry(path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _read_dates(self, path, to_compact=None):
+        entries = {}
+        removals = 0
+
+        try:
+            with open(path, "r", encoding="utf-8") as fd:
+                for line in fd:
+                    if not line.endswith("\n"):
+                        continue
+                    if line[0] == "+":
+                        date, paste_id, values = line[1:-1].split(" ", 2)
+                        entries[paste_id] = (int(date), json.loads(values))
+                    else:
+                        entries.pop(line[1:-1], None)
+                        removals += 1
+        except FileNotFoundError:
+            return entries
+
+        if to_compact is not None and \
+                removals >= _COMPACT_MIN_REMOVALS and \
+                removals > len(entries):
+            to_compact.append(path)
+
+        return entries
+
+    def _compact_dates(self, path):
+        with self.locked():
+            entries = self._read_dates(path)
+            self._write_atomic(path, "".join(
+                self._date_line(paste_id, entry) + "\n"
+                for paste_id, entry in sorted(entries.items())))
+
+    def _read_list(self, path, to_compact=None):
+        members = set()
+        removals = 0
+
+        try:
+            with open(path, "r", encoding="ascii") as fd:
+                for line in fd:
+                    # Skip a line that is still being appended
+                    if not line.endswith("\n"):
+                        continue
+                    if line[0] == "+":
+                        members.add(line[1:-1])
+                    else:
+                        members.discard(line[1:-1])
+                        removals += 1
+        except FileNotFoundError:
+            return members
+
+        if to_compact is not None and \
+                removals >= _COMPACT_MIN_REMOVALS and \
+                removals > len(members):
+            to_compact.append(path)
+
+        return members
+
+    def _compact(self, path):
+        with self.locked():
+            self._write_list(path, sorted(self._read_list(path)))
+
+    def _append(self, path, line):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (line + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def _write_list(self, path, paste_ids):
+        self._write_atomic(
+            path, "".join("+" + paste_id + "\n" for paste_id in paste_ids))
+
+    def _write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = os.path.join(
+            os.path.dirname(path), ".tmp-" + os.path.basename(path))
+        with open(tmp, "w", encoding="utf-8") as fd:
+            fd.write(data)
+        os.replace(tmp, path)
@@ -0,0 +1,45 @@
+"""
+This file contains a backend layer that measures how long every backend
+operation takes, and counts the ones that fail. It wraps the whole stack of
+layers, so that it measures the operations as the application sees them,
+cache hits included.
+"""
+
+import time
+
+from backends.layer import BackendLayer
+
+
+class InstrumentationLayer(BackendLayer):
+    def __init__(self, backend, duration, errors):
+        """
+        :param duration: the histogram of the durations of the operations,
+                         labelled by operation
+        :param errors: the counter of the failed operations, labelled by
+                       operation
+        """
+        super(InstrumentationLayer, self).__init__(backend)
+        self._duration = duration
+        self._errors = errors
+
+    def __getattr__(self, name):
+        attribute = getattr(self._backend, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def operation(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            except self._backend.e.WarningException:
+                raise
+            except Exception:
+                self._errors.inc(name)
+                raise
+            finally:
+                self._duration.observe(time.perf_counter() - start, name)
+
+        # Later lookups find the operation without going through
+        # __getattr__ again
+        setattr(self, name, operation)
+        return operation
@@ -0,0 +1,155 @@
+"""
+This file contains the base class of backend layers. A layer wraps a backend
+module (or another layer) and is used by the application exactly like the
+backend module itself, so that features like caching can be added in front
+of any backend without changing it. Any attribute that a layer does not
+define is looked up on the backend it wraps.
+"""
+
+
+class BackendLayer(object):
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def _fetch_paste(self, paste_id):
+        """
+        Returns the (content, metadata) tuple of a paste from the wrapped
+        backend, or None if it does not exist, through get_paste if the
+        backend provides it or the individual calls otherwise.
+        """
+        if hasattr(self._backend, 'get_paste'):
+            return self._backend.get_paste(paste_id)
+
+        if not self._backend.does_paste_exist(paste_id):
+            return None
+
+        content = self._backend.get_paste_contents(paste_id)
+        try:
+            metadata = self._backend.get_paste_metadata(paste_id)
+        except self._backend.e.WarningException:
+            metadata = {}
+
+        return content, metadata
+
+
+class CacheLayer(BackendLayer):
+    """
+    Base class for layers that cache pastes in front of a backend. Subclasses
+    only implement the storage of cached pastes: _lookup, _store and
+    invalidate. Pastes are read through the cache, and any write to a paste
+    invalidates its cached copy.
+
+    Writes made through other processes, or other machines, do not
+    invalidate the cached copies of this one, so their metadata may be out
+    of date. does_paste_exist and get_paste_metadata always ask the backend,
+    for the callers that need to know the current state of a paste.
+    """
+
+    def __init__(self, backend):
+        super(CacheLayer, self).__init__(backend)
+        self.hits = 0
+        self.misses = 0
+
+        # Called with True for every cache hit and False for every miss, if
+        # set, for instance to keep metrics
+        self.on_lookup = None
+
+    def _lookup(self, paste_id):
+        raise NotImplementedError
+
+    def _store(self, paste_id, paste):
+        raise NotImplementedError
+
+    def invalidate(self, paste_id):
+        raise NotImplementedError
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.on_lookup is not None:
+            self.on_lookup(hit)
+
+    def new_paste(self, paste_id, paste_content):
+        self._backend.new_paste(paste_id, paste_content)
+        self.invalidate(paste_id)
+
+    def new_paste_stream(self, paste_id, paste_stream):
+        if hasattr(self._backend, 'new_paste_stream'):
+            self._backend.new_paste_stream(paste_id, paste_stream)
+        else:
+            self._backend.new_paste(
+                paste_id, paste_stream.read().decode('utf-8'))
+        self.invalidate(paste_id)
+
+    def create_paste(self, paste_id, paste_content, metadata):
+        if hasattr(self._backend, 'create_paste'):
+            self._backend.create_paste(paste_id, paste_content, metadata)
+        else:
+            self._backend.new_paste(paste_id, paste_content)
+            self._backend.update_paste_metadata(paste_id, metadata)
+        self.invalidate(paste_id)
+
+    def create_paste_stream(self, paste_id, paste_stream, metadata):
+        if hasattr(self._backend, 'create_paste_stream'):
+            self._backend.create_paste_stream(
+                paste_id, paste_stream, metadata)
+        elif hasattr(self._backend, 'new_paste_stream'):
+            self._backend.new_paste_stream(paste_id, paste_stream)
+            self._backend.update_paste_metadata(paste_id, metadata)
+        else:
+            self.create_paste(
+                paste_id, paste_stream.read().decode('utf-8'), metadata)
+            return
+        self.invalidate(paste_id)
+
+    def update_paste_metadata(self, paste_id, metadata):
+        self._backend.update_paste_metadata(paste_id, metadata)
+        self.invalidate(paste_id)
+
+    def delete_paste(self, paste_id):
+        self._backend.delete_paste(paste_id)
+        self.invalidate(paste_id)
+
+    def get_paste(self, paste_id):
+        paste = self._lookup(paste_id)
+        if paste is not None:
+            self._count(True)
+            return paste
+
+        self._count(False)
+        paste = self._fetch_paste(paste_id)
+        if paste is not None:
+            self._store(paste_id, paste)
+        return paste
+
+    def get_paste_contents(self, paste_id):
+        paste = self.get_paste(paste_id)
+        if paste is None:
+            raise self._backend.e.ErrorException(
+                'Paste %s does not exist' % paste_id)
+        return paste[0]
+
+    def get_paste_metadata_value(self, paste_id, key):
+        paste = self._lookup(paste_id)
+        if paste is not None:
+            return paste[1].get(key)
+        return self._backend.get_paste_metadata_value(paste_id, key)
+
+    def open_paste_stream(self, paste_id):
+        paste = self._lookup(paste_id)
+        if paste is not None:
+            self._count(True)
+            return [paste[0].encode('utf-8')]
+
+        # Large pastes are streamed past the cache instead of being loaded
+        # into it
+        if hasattr(self._backend, 'open_paste_stream'):
+            return self._backend.open_paste_stream(paste_id)
+
+        paste = self.get_paste(paste_id)
+        return None if paste is None else [paste[0].encode('utf-8')]
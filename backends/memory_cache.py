@@ -0,0 +1,61 @@
+"""
+This file contains a backend layer that keeps recently read pastes in the
+memory of the current process. Since the Paste ID is the SHA-256 of the
+content, the content of a paste never changes for a given ID, so popular
+pastes can be served without talking to the backend at all. The cache is
+bounded by the total size of the cached pastes and evicts the least
+recently used ones first.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from backends.layer import CacheLayer
+
+
+def _paste_size(paste):
+    content, metadata = paste
+    return len(content.encode('utf-8')) + sum(
+        len(k) + len(v) for k, v in metadata.items())
+
+
+class MemoryCache(CacheLayer):
+    def __init__(self, backend, max_bytes):
+        super(MemoryCache, self).__init__(backend)
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._pastes = OrderedDict()
+        self._lock = Lock()
+
+    def _lookup(self, paste_id):
+        with self._lock:
+            try:
+                paste, _ = self._pastes[paste_id]
+            except KeyError:
+                return None
+            self._pastes.move_to_end(paste_id)
+            return paste
+
+    def _store(self, paste_id, paste):
+        size = _paste_size(paste)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            self._discard(paste_id)
+            self._pastes[paste_id] = (paste, size)
+            self._size += size
+            while self._size > self._max_bytes:
+                _, (_, evicted_size) = self._pastes.popitem(last=False)
+                self._size -= evicted_size
+
+    def _discard(self, paste_id):
+        try:
+            _, size = self._pastes.pop(paste_id)
+        except KeyError:
+            return
+        self._size -= size
+
+    def invalidate(self, paste_id):
+        with self._lock:
+            self._discard(paste_id)
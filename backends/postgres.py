@@ -1,35 +1,177 @@
 from psycopg2 import Error
 from psycopg2 import connect
 
+# the application catches backend errors through this module attribute
+from backends import exceptions as e  # noqa: F401
 from backends.dbapi2 import DbApi2
+from backends.utils import SEARCH_INDEXED_CHARS
+from backends.utils import getenv_int
 from backends.utils import getenv_required
+from backends.utils import search_terms
 from backends.utils import wrap_exception
 
 _ENV_DATABASE_CONNECTION = 'TP_BACKEND_POSTGRES_DATABASE_CONNECTION'
+_ENV_POOL_MIN_SIZE = 'TP_BACKEND_POSTGRES_POOL_MIN_SIZE'
+_ENV_POOL_MAX_SIZE = 'TP_BACKEND_POSTGRES_POOL_MAX_SIZE'
+
+_DEFAULT_POOL_MIN_SIZE = 1
+_DEFAULT_POOL_MAX_SIZE = 4
 
 _wrap_postgres_exception = wrap_exception(
     Error,
     'Error while communicating with the Postgres database')
 
-_db = None  # type: DbApi2
+_db = None  # type: PostgresDbApi2
+
+
+class PostgresDbApi2(DbApi2):
+    """
+    Adds full-text search of the public pastes to DbApi2 with a tsvector
+    column of the pastes table and a GIN index on it. A trigger computes the
+    column from the content of a paste when its visibility is set to public,
+    and clears it when it is set to anything else. None of this is set up
+    until initialize_search is called, so that the writes of an instance
+    without search do not keep an index up to date.
+    """
+
+    def initialize_search(self):
+        indexed = "to_tsvector('simple', left(%s, {0}))".format(
+            SEARCH_INDEXED_CHARS)
+
+        # Adding the column is only done by the first of the processes
+        # starting together, while the others wait for it. It locks the
+        # table, so it is only attempted when the column is missing.
+        with self._write_cursor() as cursor:
+            if self._has_search_column(cursor):
+                return
+            cursor.execute('''
+                LOCK TABLE pastes IN ACCESS EXCLUSIVE MODE
+            ''')
+            if self._has_search_column(cursor):
+                return
+
+            cursor.execute('''
+                ALTER TABLE pastes ADD COLUMN search tsvector
+            ''')
+            # The metadata of a paste is replaced by deleting and inserting
+            # its rows, so only the inserted visibility is looked at, and the
+            # column is left alone if it is as it should be already
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION pastes_search_visibility()
+                RETURNS trigger AS $$
+                BEGIN
+                  UPDATE pastes SET search = CASE
+                    WHEN NEW.value = 'public' THEN {0} END
+                  WHERE id = NEW.id
+                    AND (search IS NULL) = (NEW.value = 'public');
+                  RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            '''.format(indexed % 'content'))
+            cursor.execute('''
+                CREATE TRIGGER pastes_search_visibility
+                AFTER INSERT ON pastes_metadata
+                FOR EACH ROW WHEN (NEW.key = 'visibility')
+                EXECUTE PROCEDURE pastes_search_visibility()
+            ''')
+
+            # The pastes stored before their visibility could be chosen
+            # have none, and are public
+            cursor.execute('''
+                UPDATE pastes p SET search = {0}
+                WHERE coalesce((
+                  SELECT value FROM pastes_metadata v
+                  WHERE v.id = p.id AND v.key = 'visibility'), 'public')
+                  = 'public'
+            '''.format(indexed % 'p.content'))
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS pastes_search
+                ON pastes USING GIN (search)
+            ''')
+
+    def _has_search_column(self, cursor):
+        cursor.execute('''
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'pastes' AND column_name = 'search'
+        ''')
+        return cursor.fetchone() is not None
+
+    def search_paste_ids(self, query, filters, fdefaults, limit,
+                         cursor=None):
+        terms = search_terms(query)
+        if not terms:
+            return [], None
+
+        joins, where, params = self._compile_filters(filters, fdefaults)
+
+        # Newest first, like the paste listing, in the order of the
+        # (key, value, id) index of the metadata, so that the dates of
+        # frequent words are read backwards from the index until the page is
+        # full instead of sorting all their matches, and pages continue from
+        # the last (date, Paste ID) of the previous one
+        if cursor is not None:
+            date, _, paste_id = cursor.partition(':')
+            where += ' AND (d.value, d.id) < (?, ?)'
+            params.extend([date, paste_id])
+
+        with self._read_cursor() as db_cursor:
+            db_cursor.execute(self._prepare_sql('''
+                SELECT p.id, d.value FROM pastes p
+                JOIN pastes_metadata d ON d.id = p.id AND d.key = ?
+                {0}
+                WHERE {1} AND p.search @@ plainto_tsquery('simple', ?)
+                ORDER BY d.value DESC, d.id DESC
+                LIMIT ?
+            '''.format(joins, where)),
+                ['date'] + params + [' '.join(terms), limit + 1])
+            rows = db_cursor.fetchall()
+
+        paste_ids = [paste_id for (paste_id, _) in rows[:limit]]
+
+        if len(rows) > limit:
+            return paste_ids, '%s:%s' % (rows[limit - 1][1],
+                                         rows[limit - 1][0])
+        return paste_ids, None
 
 
 @_wrap_postgres_exception
 def initialize_backend():
     global _db
 
-    _db = DbApi2(
-        connection=connect(getenv_required(_ENV_DATABASE_CONNECTION)),
-        paramstyle='%s')
+    database_connection = getenv_required(_ENV_DATABASE_CONNECTION)
+
+    _db = PostgresDbApi2(
+        connect=lambda: connect(database_connection),
+        paramstyle='%s',
+        min_connections=getenv_int(
+            _ENV_POOL_MIN_SIZE, _DEFAULT_POOL_MIN_SIZE),
+        max_connections=getenv_int(
+            _ENV_POOL_MAX_SIZE, _DEFAULT_POOL_MAX_SIZE),
+        server_side_cursors=True)
 
     return _db.initialize_backend()
 
 
+@_wrap_postgres_exception
+def initialize_search():
+    return _db.initialize_search()
+
+
 @_wrap_postgres_exception
 def new_paste(paste_id, paste_content):
     return _db.new_paste(paste_id, paste_content)
 
 
+@_wrap_postgres_exception
+def create_paste(paste_id, paste_content, metadata):
+    return _db.create_paste(paste_id, paste_content, metadata)
+
+
+@_wrap_postgres_exception
+def create_pastes(pastes):
+    return _db.create_pastes(pastes)
+
+
 @_wrap_postgres_exception
 def update_paste_metadata(paste_id, metadata):
     return _db.update_paste_metadata(paste_id, metadata)
@@ -45,6 +187,16 @@ def get_paste_contents(paste_id):
     return _db.get_paste_contents(paste_id)
 
 
+@_wrap_postgres_exception
+def get_paste(paste_id):
+    return _db.get_paste(paste_id)
+
+
+@_wrap_postgres_exception
+def open_paste_stream(paste_id):
+    return _db.open_paste_stream(paste_id)
+
+
 @_wrap_postgres_exception
 def get_paste_metadata(paste_id):
     return _db.get_paste_metadata(paste_id)
@@ -55,6 +207,31 @@ def get_paste_metadata_value(paste_id, key):
     return _db.get_paste_metadata_value(paste_id, key)
 
 
+@_wrap_postgres_exception
+def get_expired_paste_ids(now, limit):
+    return _db.get_expired_paste_ids(now, limit)
+
+
+@_wrap_postgres_exception
+def delete_paste(paste_id):
+    return _db.delete_paste(paste_id)
+
+
 @_wrap_postgres_exception
 def get_all_paste_ids(filters={}, fdefaults={}):
     return _db.get_all_paste_ids(filters, fdefaults)
+
+
+@_wrap_postgres_exception
+def get_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    return _db.get_paste_ids_page(filters, fdefaults, limit, cursor)
+
+
+@_wrap_postgres_exception
+def get_recent_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    return _db.get_recent_paste_ids_page(filters, fdefaults, limit, cursor)
+
+
+@_wrap_postgres_exception
+def search_paste_ids(query, filters, fdefaults, limit, cursor=None):
+    return _db.search_paste_ids(query, filters, fdefaults, limit, cursor)
@@ -0,0 +1,404 @@
+"""
+This file contains a backend layer that keeps a full-text index of the
+public pastes of backends that cannot search them themselves, such as the
+filesystem and the object stores, so that they provide search_paste_ids too.
+The index is an SQLite database with an FTS5 table, in a local file shared
+by all the TorPaste processes of a node.
+
+Every public paste created through the layer is indexed as soon as it is
+stored, and a paste is removed from the index as soon as its visibility is
+changed to anything else through the layer. The pastes stored before the
+index existed, or through other nodes, are indexed by a thread that goes
+through the public pastes of the backend periodically, which also drops the
+pastes that were deleted, or that stopped being public, through other nodes.
+Only one of the processes of a node refreshes the index at a time, and a
+refresh that was interrupted resumes where it stopped. Until the first
+refresh is done, searches only find the pastes indexed so far.
+"""
+
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from backends.layer import BackendLayer
+from backends.utils import SEARCH_INDEXED_CHARS
+from backends.utils import fts5_query
+from backends.utils import search_terms
+from backends.utils import wrap_exception
+
+_LISTING_PAGE_SIZE = 1000
+
+_wrap_index_exception = wrap_exception(
+    sqlite3.Error,
+    'Error while using the search index')
+
+# The operations that store a new paste along with its metadata, whose
+# content is their second argument. The pastes stored without metadata are
+# indexed when their metadata is set.
+_WRITES = [
+    "create_paste",
+    "create_paste_stream",
+]
+
+# The filter of the pastes that are indexed, the pastes stored before their
+# visibility could be chosen being public
+_PUBLIC = {"visibility": "public"}
+
+
+def _is_public(metadata):
+    return metadata.get("visibility", "public") == "public"
+
+
+def _peek(stream):
+    """
+    Returns the start of the content of a stream that is about to be stored,
+    and rewinds it.
+    """
+    position = stream.tell()
+    start = stream.read(SEARCH_INDEXED_CHARS)
+    stream.seek(position)
+
+    # A character may have been cut at the end
+    return start.decode("utf-8", "ignore")
+
+
+class SearchIndexLayer(BackendLayer):
+    def __init__(self, backend, path, refresh_seconds):
+        """
+        :param path: the SQLite database holding the index
+        :param refresh_seconds: how often the index is refreshed from the
+                                listing of the backend
+        """
+        super(SearchIndexLayer, self).__init__(backend)
+
+        self._path = path
+        self._refresh_seconds = refresh_seconds
+        self._local = threading.local()
+
+        # Taken by the process refreshing the index
+        self._lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        self._refresh_lock = threading.Lock()
+
+        # Forked processes each start a refreshing thread of their own
+        self._refresher_pid = None
+
+    def _connection(self):
+        """
+        Returns the connection to the index of the current thread, since
+        SQLite connections are not shared between threads or processes.
+        """
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = sqlite3.connect(self._path, timeout=60)
+            local.pid = os.getpid()
+        return local.connection
+
+    def _create_tables(self):
+        connection = self._connection()
+
+        # Searches are not blocked by the writers of other processes
+        connection.execute("PRAGMA journal_mode = WAL")
+
+        with connection:
+            # Checked is the time the paste was last known to be stored
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS pastes (
+                  rowid INTEGER PRIMARY KEY,
+                  id TEXT UNIQUE,
+                  metadata TEXT,
+                  checked REAL)
+            """)
+            # The content is kept along with the index, which is what FTS5
+            # needs to remove the words of a paste from it
+            connection.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS contents
+                USING fts5(content)
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS state (
+                  key TEXT PRIMARY KEY,
+                  value TEXT)
+            """)
+
+    def _index(self, paste_id, content, metadata, checked):
+        """
+        Adds a paste to the index, or updates its metadata if it is indexed
+        already, since a Paste ID is the hash of the content. A paste that
+        is not public is removed from the index instead.
+        :param content: the start of the content of the paste, which is
+                        only needed if it is public
+        """
+        connection = self._connection()
+        with connection:
+            if not _is_public(metadata):
+                self._remove(connection, "id = ?", [paste_id])
+                return
+
+            cursor = connection.execute("""
+                INSERT OR IGNORE INTO pastes (id, metadata, checked)
+                VALUES (?, ?, ?)
+            """, [paste_id, json.dumps(metadata), checked])
+
+            if cursor.rowcount:
+                connection.execute("""
+                    INSERT INTO contents (rowid, content) VALUES (?, ?)
+                """, [cursor.lastrowid, content])
+            else:
+                connection.execute("""
+                    UPDATE pastes SET metadata = ?, checked = ? WHERE id = ?
+                """, [json.dumps(metadata), checked, paste_id])
+
+    def _index_new(self, paste_id, content, metadata):
+        try:
+            self._index(paste_id, content, metadata, time.time())
+        except sqlite3.Error:
+            # The paste is stored, and the next refresh indexes it
+            pass
+
+    def _index_metadata(self, paste_id, metadata):
+        """
+        Updates the metadata of a paste in the index, which reads the paste
+        from the backend if it has just become public.
+        """
+        try:
+            if not _is_public(metadata):
+                self._index(paste_id, None, metadata, time.time())
+                return
+
+            connection = self._connection()
+            with connection:
+                cursor = connection.execute("""
+                    UPDATE pastes SET metadata = ? WHERE id = ?
+                """, [json.dumps(metadata), paste_id])
+            if cursor.rowcount:
+                return
+
+            paste = self._fetch_paste(paste_id)
+            if paste is not None:
+                self._index(paste_id, paste[0][:SEARCH_INDEXED_CHARS],
+                            metadata, time.time())
+        except (sqlite3.Error, self._backend.e.ErrorException):
+            # The metadata is stored, and the next refresh indexes the paste
+            # if it is public, or removes it otherwise
+            pass
+
+    def _remove(self, connection, where, params):
+        connection.execute("""
+            DELETE FROM contents WHERE rowid IN (
+              SELECT rowid FROM pastes WHERE {0})
+        """.format(where), params)
+        connection.execute(
+            "DELETE FROM pastes WHERE {0}".format(where), params)
+
+    @_wrap_index_exception
+    def search_paste_ids(self, query, filters, fdefaults, limit,
+                         cursor=None):
+        self._start_refresher()
+
+        terms = search_terms(query)
+        if not terms:
+            return [], None
+
+        conditions = ["contents MATCH ?"]
+        params = [fts5_query(terms)]
+
+        for key, value in sorted(filters.items()):
+            conditions.append("coalesce(json_extract(p.metadata, ?), ?) = ?")
+            params.extend(['$."%s"' % key, fdefaults.get(key), value])
+
+        # The pastes indexed last come first
+        if cursor is not None:
+            try:
+                params.append(int(cursor))
+            except ValueError:
+                return [], None
+            conditions.append("c.rowid < ?")
+
+        rows = self._connection().execute("""
+            SELECT p.id, c.rowid FROM contents c
+            JOIN pastes p ON p.rowid = c.rowid
+            WHERE {0}
+            ORDER BY c.rowid DESC
+            LIMIT ?
+        """.format(" AND ".join(conditions)), params + [limit + 1]).fetchall()
+
+        paste_ids = [paste_id for (paste_id, _) in rows[:limit]]
+
+        if len(rows) > limit:
+            return paste_ids, str(rows[limit - 1][1])
+        return paste_ids, None
+
+    def _list_pages(self, cursor):
+        """
+        Yields the IDs of the public pastes of the backend, in (list of
+        Paste IDs, cursor of the next page or None) tuples, starting from the
+        page of the given cursor.
+        """
+        if not hasattr(self._backend, "get_paste_ids_page"):
+            paste_ids = self._backend.get_all_paste_ids(_PUBLIC, _PUBLIC)
+            yield [paste_id for paste_id in paste_ids
+                   if paste_id != "none"], None
+            return
+
+        while True:
+            page, cursor = self._backend.get_paste_ids_page(
+                _PUBLIC, _PUBLIC, _LISTING_PAGE_SIZE, cursor)
+            yield page, cursor
+            if cursor is None:
+                return
+
+    def _get_state(self):
+        rows = self._connection().execute(
+            "SELECT key, value FROM state").fetchall()
+        return {key: json.loads(value) for (key, value) in rows}
+
+    def _set_state(self, connection, **state):
+        connection.executemany("""
+            INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)
+        """, [(key, json.dumps(value)) for key, value in state.items()])
+
+    def _check_page(self, paste_ids, started):
+        """
+        Marks the pastes of a page of the listing that are indexed as still
+        stored and public, and indexes the others.
+        """
+        connection = self._connection()
+        marks = ",".join("?" * len(paste_ids))
+
+        with connection:
+            connection.execute("""
+                UPDATE pastes SET checked = ?
+                WHERE id IN ({0}) AND checked < ?
+            """.format(marks), [started] + paste_ids + [started])
+            indexed = set(paste_id for (paste_id,) in connection.execute("""
+                SELECT id FROM pastes WHERE id IN ({0})
+            """.format(marks), paste_ids))
+
+        for paste_id in paste_ids:
+            if paste_id in indexed:
+                continue
+
+            paste = self._fetch_paste(paste_id)
+            if paste is not None:
+                content, metadata = paste
+                self._index(paste_id, content[:SEARCH_INDEXED_CHARS],
+                            metadata, started)
+
+    def refresh(self, force=False):
+        """
+        Indexes the public pastes of the backend that are not indexed yet,
+        and removes the ones that no longer exist or are no longer public
+        from the index, unless another process refreshed it recently or is
+        refreshing it now.
+        """
+        with self._refresh_lock:
+            try:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+
+            try:
+                self._refresh(force)
+            finally:
+                fcntl.lockf(self._lock_fd, fcntl.LOCK_UN)
+
+    def _refresh(self, force):
+        state = self._get_state()
+        started = state.get("started")
+        cursor = state.get("cursor")
+
+        if started is None:
+            finished = state.get("finished")
+            if not force and finished and \
+                    time.time() - finished < self._refresh_seconds:
+                return
+            started = time.time()
+            cursor = None
+
+        connection = self._connection()
+        for paste_ids, cursor in self._list_pages(cursor):
+            if paste_ids:
+                self._check_page(paste_ids, started)
+            with connection:
+                self._set_state(connection, started=started, cursor=cursor)
+
+        # The pastes created during the refresh were checked after it
+        # started, so only the ones that were deleted, or that are no longer
+        # public, are left behind
+        with connection:
+            self._remove(connection, "checked < ?", [started])
+            self._set_state(
+                connection, started=None, cursor=None, finished=time.time())
+
+    def _start_refresher(self):
+        if self._refresher_pid == os.getpid():
+            return
+        self._refresher_pid = os.getpid()
+
+        thread = threading.Thread(
+            target=self._refresh_periodically, daemon=True)
+        thread.start()
+
+    def _refresh_periodically(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                # The backend may be unavailable for a while, and the
+                # current index is still good until the next attempt
+                pass
+            time.sleep(self._refresh_seconds)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._backend, name)
+
+        if name in _WRITES:
+            def operation(paste_id, content, metadata):
+                self._start_refresher()
+
+                start = None
+                if _is_public(metadata):
+                    if hasattr(content, "read"):
+                        start = _peek(content)
+                    else:
+                        start = content[:SEARCH_INDEXED_CHARS]
+
+                result = attribute(paste_id, content, metadata)
+                self._index_new(paste_id, start, metadata)
+                return result
+        elif name == "create_pastes":
+            def operation(pastes):
+                self._start_refresher()
+                result = attribute(pastes)
+                for paste_id, content, metadata in pastes:
+                    self._index_new(
+                        paste_id, content[:SEARCH_INDEXED_CHARS], metadata)
+                return result
+        elif name == "update_paste_metadata":
+            def operation(paste_id, metadata):
+                result = attribute(paste_id, metadata)
+                self._index_metadata(paste_id, metadata)
+                return result
+        elif name == "delete_paste":
+            @_wrap_index_exception
+            def operation(paste_id):
+                # Pastes are removed first, so that they are never found
+                # once they are deleted
+                connection = self._connection()
+                with connection:
+                    self._remove(connection, "id = ?", [paste_id])
+                return attribute(paste_id)
+        else:
+            return attribute
+
+        # Only the operations the backend provides are wrapped, and later
+        # lookups find them without going through __getattr__ again
+        setattr(self, name, operation)
+        return operation
+
+    def initialize_backend(self):
+        self._backend.initialize_backend()
+        _wrap_index_exception(self._create_tables)()
@@ -0,0 +1,150 @@
+"""
+This file contains a backend layer that caches pastes in a memory-mapped
+file shared by all the TorPaste processes of a node, such as the Gunicorn
+workers, so that a paste is cached once per node instead of once per worker.
+
+The file starts with a small header, followed by a fixed number of slots of
+a fixed size. Every paste maps to a set of two neighbouring slots, and when
+both are taken the one that was written the longest time ago is evicted.
+Each slot is guarded by a sequence lock: writers take an fcntl lock on the
+slot and make its sequence number odd while they change it, and readers take
+no lock at all, but discard what they read if the sequence number was odd or
+changed while they were reading. Pastes that do not fit in a slot are never
+cached.
+"""
+
+import fcntl
+import json
+import mmap
+import struct
+import time
+from hashlib import sha256
+from threading import Lock
+
+from backends.layer import CacheLayer
+from backends.utils import open_shared_file
+
+_MAGIC = b"TPSC1\x00\x00\x00"
+
+# magic, slot size, slot count
+_HEADER = struct.Struct("<8sII")
+_HEADER_SIZE = 64
+
+# sequence number, time of the last write, payload length, key
+_SLOT_HEADER = struct.Struct("<QdI32s")
+_SEQUENCE = struct.Struct("<Q")
+
+_WAYS = 2
+
+
+def _encode_paste(paste):
+    content, metadata = paste
+    return json.dumps(metadata).encode("utf-8") + b"\n" + \
+        content.encode("utf-8")
+
+
+def _decode_paste(payload):
+    header_end = payload.index(b"\n")
+    metadata = json.loads(payload[:header_end].decode("utf-8"))
+    return payload[header_end + 1:].decode("utf-8"), metadata
+
+
+class SharedCache(CacheLayer):
+    def __init__(self, backend, path, size, slot_size):
+        super(SharedCache, self).__init__(backend)
+
+        # Keep slots 8-byte aligned, so that sequence numbers are too
+        self._slot_size = slot_size - slot_size % 8
+        self._slot_count = (size - _HEADER_SIZE) // self._slot_size
+        self._slot_count -= self._slot_count % _WAYS
+        if self._slot_count <= 0 or self._slot_size <= _SLOT_HEADER.size:
+            raise ValueError("Shared cache too small")
+
+        self._lock = Lock()
+        self._fd = open_shared_file(
+            path,
+            _HEADER.pack(_MAGIC, self._slot_size, self._slot_count),
+            _HEADER_SIZE + self._slot_count * self._slot_size)
+        self._map = mmap.mmap(self._fd, 0)
+
+    def _slots(self, key):
+        first = int.from_bytes(key[:8], "little") % \
+            (self._slot_count // _WAYS) * _WAYS
+        return [
+            _HEADER_SIZE + (first + way) * self._slot_size
+            for way in range(_WAYS)
+        ]
+
+    def _read(self, offset, key):
+        sequence, _, length, slot_key = \
+            _SLOT_HEADER.unpack_from(self._map, offset)
+        if sequence % 2 or length == 0 or slot_key != key:
+            return None
+
+        start = offset + _SLOT_HEADER.size
+        payload = self._map[start:start + length]
+
+        if _SEQUENCE.unpack_from(self._map, offset)[0] != sequence:
+            return None
+        return payload
+
+    def _lookup(self, paste_id):
+        key = sha256(paste_id.encode("utf-8")).digest()
+        for offset in self._slots(key):
+            payload = self._read(offset, key)
+            if payload is not None:
+                return _decode_paste(payload)
+        return None
+
+    def _write(self, offset, key, payload, wait=False):
+        """
+        Writes a payload to the slot at the given offset. If another process
+        is writing to the same slot, the write is skipped, unless wait is
+        set, in which case it waits for the other process to finish.
+        """
+        with self._lock:
+            try:
+                fcntl.lockf(
+                    self._fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB),
+                    self._slot_size, offset)
+            except OSError:
+                return
+
+            try:
+                sequence = _SEQUENCE.unpack_from(self._map, offset)[0]
+                _SEQUENCE.pack_into(self._map, offset, sequence + 1)
+
+                start = offset + _SLOT_HEADER.size
+                self._map[start:start + len(payload)] = payload
+                _SLOT_HEADER.pack_into(
+                    self._map, offset,
+                    sequence + 1, time.time(), len(payload), key)
+
+                _SEQUENCE.pack_into(self._map, offset, sequence + 2)
+            finally:
+                fcntl.lockf(
+                    self._fd, fcntl.LOCK_UN, self._slot_size, offset)
+
+    def _store(self, paste_id, paste):
+        payload = _encode_paste(paste)
+        if len(payload) > self._slot_size - _SLOT_HEADER.size:
+            return
+
+        key = sha256(paste_id.encode("utf-8")).digest()
+        victim, victim_written = None, None
+        for offset in self._slots(key):
+            _, written, length, slot_key = \
+                _SLOT_HEADER.unpack_from(self._map, offset)
+            if length == 0 or slot_key == key:
+                victim = offset
+                break
+            if victim is None or written < victim_written:
+                victim, victim_written = offset, written
+
+        self._write(victim, key, payload)
+
+    def invalidate(self, paste_id):
+        key = sha256(paste_id.encode("utf-8")).digest()
+        for offset in self._slots(key):
+            if _SLOT_HEADER.unpack_from(self._map, offset)[3] == key:
+                self._write(offset, bytes(32), b"", wait=True)
@@ -1,35 +1,215 @@
+import os
 from sqlite3 import Error
 from sqlite3 import connect
 
+# the application catches backend errors through this module attribute
+from backends import exceptions as e  # noqa: F401
 from backends.dbapi2 import DbApi2
+from backends.utils import SEARCH_INDEXED_CHARS
+from backends.utils import fts5_query
+from backends.utils import getenv_int
 from backends.utils import getenv_required
+from backends.utils import search_terms
 from backends.utils import wrap_exception
 
 _ENV_DATABASE_PATH = 'TP_BACKEND_SQLITE_DATABASE_PATH'
+_ENV_POOL_MIN_SIZE = 'TP_BACKEND_SQLITE_POOL_MIN_SIZE'
+_ENV_POOL_MAX_SIZE = 'TP_BACKEND_SQLITE_POOL_MAX_SIZE'
+
+_DEFAULT_POOL_MIN_SIZE = 1
+_DEFAULT_POOL_MAX_SIZE = 4
 
 _wrap_sqlite_exception = wrap_exception(
     Error,
     'Error while communicating with the SQLite database')
 
-_db = None  # type: DbApi2
+_db = None  # type: SQLiteDbApi2
+
+
+class SQLiteDbApi2(DbApi2):
+    """
+    Adds full-text search of the public pastes to DbApi2 with an FTS5
+    table. The table is contentless, so that the pastes are not stored
+    twice, and the IDs of the pastes it has indexed are kept in a table of
+    their own, whose rowids the FTS5 table uses and which, unlike the rowids
+    of the pastes table, are never renumbered by VACUUM. Triggers keep both
+    up to date: a paste is indexed when its visibility is set to public,
+    and removed from the index when it is set to anything else or when the
+    paste is deleted. None of this is set up until initialize_search is
+    called, so that the writes of an instance without search do not keep
+    an index up to date.
+    """
+
+    def initialize_backend(self):
+        # Pastes are streamed in a single read transaction, which would keep
+        # the writers waiting until the client has read the whole paste
+        # unless the database is in WAL mode
+        with self._write_cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode = WAL')
+
+        return super(SQLiteDbApi2, self).initialize_backend()
+
+    def _begin_snapshot(self, cursor):
+        # The sqlite3 module does not start a transaction before a query,
+        # and every query of one reads the same snapshot
+        cursor.execute('BEGIN')
+
+    def initialize_search(self):
+        indexed = "substr(%s.content, 1, {0})".format(SEARCH_INDEXED_CHARS)
+
+        with self._write_cursor() as cursor:
+            # Only the first of the processes starting together indexes the
+            # pastes stored before search was available
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT 1 FROM sqlite_master WHERE name = 'pastes_search'
+            ''')
+            created = cursor.fetchone() is not None
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS pastes_search_ids (
+                  rowid INTEGER PRIMARY KEY,
+                  id TEXT UNIQUE)
+            ''')
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS pastes_search
+                USING fts5(content, content='')
+            ''')
+            # The metadata of a paste is replaced by deleting and inserting
+            # its rows, so only the inserted visibility is looked at
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS pastes_search_publish
+                AFTER INSERT ON pastes_metadata
+                WHEN new.key = 'visibility' AND new.value = 'public'
+                  AND new.id NOT IN (SELECT id FROM pastes_search_ids)
+                BEGIN
+                  INSERT INTO pastes_search_ids (id)
+                  SELECT id FROM pastes WHERE id = new.id;
+                  INSERT INTO pastes_search (rowid, content)
+                  SELECT i.rowid, {0} FROM pastes_search_ids i
+                  JOIN pastes p ON p.id = i.id
+                  WHERE i.id = new.id;
+                END
+            '''.format(indexed % 'p'))
+            # Contentless tables are told the content of the rows they
+            # delete, to find their words
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS pastes_search_unpublish
+                AFTER INSERT ON pastes_metadata
+                WHEN new.key = 'visibility' AND new.value != 'public'
+                BEGIN
+                  INSERT INTO pastes_search (pastes_search, rowid, content)
+                  SELECT 'delete', i.rowid, {0} FROM pastes_search_ids i
+                  JOIN pastes p ON p.id = i.id
+                  WHERE i.id = new.id;
+                  DELETE FROM pastes_search_ids WHERE id = new.id;
+                END
+            '''.format(indexed % 'p'))
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS pastes_search_delete
+                AFTER DELETE ON pastes BEGIN
+                  INSERT INTO pastes_search (pastes_search, rowid, content)
+                  SELECT 'delete', rowid, {0} FROM pastes_search_ids
+                  WHERE id = old.id;
+                  DELETE FROM pastes_search_ids WHERE id = old.id;
+                END
+            '''.format(indexed % 'old'))
+
+            # The pastes stored before their visibility could be chosen
+            # have none, and are public
+            if not created:
+                cursor.execute('''
+                    INSERT INTO pastes_search_ids (id)
+                    SELECT p.id FROM pastes p
+                    LEFT JOIN pastes_metadata v
+                      ON v.id = p.id AND v.key = 'visibility'
+                    WHERE coalesce(v.value, 'public') = 'public'
+                    ORDER BY p.rowid
+                ''')
+                cursor.execute('''
+                    INSERT INTO pastes_search (rowid, content)
+                    SELECT i.rowid, {0} FROM pastes_search_ids i
+                    JOIN pastes p ON p.id = i.id
+                '''.format(indexed % 'p'))
+
+    def search_paste_ids(self, query, filters, fdefaults, limit,
+                         cursor=None):
+        terms = search_terms(query)
+        if not terms:
+            return [], None
+
+        # The IDs table is aliased as p, which is all the filters need
+        joins, where, params = self._compile_filters(filters, fdefaults)
+
+        # Pastes are indexed as they are created, so the newest come first
+        if cursor is not None:
+            try:
+                params.append(int(cursor))
+            except ValueError:
+                return [], None
+            where += ' AND s.rowid < ?'
+
+        with self._read_cursor() as db_cursor:
+            db_cursor.execute('''
+                SELECT p.id, s.rowid FROM pastes_search s
+                JOIN pastes_search_ids p ON p.rowid = s.rowid
+                {0}
+                WHERE {1} AND pastes_search MATCH ?
+                ORDER BY s.rowid DESC
+                LIMIT ?
+            '''.format(joins, where),
+                params + [fts5_query(terms), limit + 1])
+            rows = db_cursor.fetchall()
+
+        paste_ids = [paste_id for (paste_id, _) in rows[:limit]]
+
+        if len(rows) > limit:
+            return paste_ids, str(rows[limit - 1][1])
+        return paste_ids, None
 
 
 @_wrap_sqlite_exception
 def initialize_backend():
     global _db
 
-    _db = DbApi2(
-        connection=connect(getenv_required(_ENV_DATABASE_PATH)),
-        paramstyle='?')
+    database_path = getenv_required(_ENV_DATABASE_PATH)
+
+    # Pooled connections may be used by other threads than their creator
+    _db = SQLiteDbApi2(
+        connect=lambda: connect(database_path, check_same_thread=False),
+        paramstyle='?',
+        min_connections=getenv_int(
+            _ENV_POOL_MIN_SIZE, _DEFAULT_POOL_MIN_SIZE),
+        max_connections=getenv_int(
+            _ENV_POOL_MAX_SIZE, _DEFAULT_POOL_MAX_SIZE))
 
     return _db.initialize_backend()
 
 
+def get_data_path():
+    return os.path.abspath(getenv_required(_ENV_DATABASE_PATH))
+
+
+@_wrap_sqlite_exception
+def initialize_search():
+    return _db.initialize_search()
+
+
 @_wrap_sqlite_exception
 def new_paste(paste_id, paste_content):
     return _db.new_paste(paste_id, paste_content)
 
 
+@_wrap_sqlite_exception
+def create_paste(paste_id, paste_content, metadata):
+    return _db.create_paste(paste_id, paste_content, metadata)
+
+
+@_wrap_sqlite_exception
+def create_pastes(pastes):
+    return _db.create_pastes(pastes)
+
+
 @_wrap_sqlite_exception
 def update_paste_metadata(paste_id, metadata):
     return _db.update_paste_metadata(paste_id, metadata)
@@ -45,6 +225,16 @@ def get_paste_contents(paste_id):
     return _db.get_paste_contents(paste_id)
 
 
+@_wrap_sqlite_exception
+def get_paste(paste_id):
+    return _db.get_paste(paste_id)
+
+
+@_wrap_sqlite_exception
+def open_paste_stream(paste_id):
+    return _db.open_paste_stream(paste_id)
+
+
 @_wrap_sqlite_exception
 def get_paste_metadata(paste_id):
     return _db.get_paste_metadata(paste_id)
@@ -55,6 +245,31 @@ def get_paste_metadata_value(paste_id, key):
     return _db.get_paste_metadata_value(paste_id, key)
 
 
+@_wrap_sqlite_exception
+def get_expired_paste_ids(now, limit):
+    return _db.get_expired_paste_ids(now, limit)
+
+
+@_wrap_sqlite_exception
+def delete_paste(paste_id):
+    return _db.delete_paste(paste_id)
+
+
 @_wrap_sqlite_exception
 def get_all_paste_ids(filters={}, fdefaults={}):
     return _db.get_all_paste_ids(filters, fdefaults)
+
+
+@_wrap_sqlite_exception
+def get_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    return _db.get_paste_ids_page(filters, fdefaults, limit, cursor)
+
+
+@_wrap_sqlite_exception
+def get_recent_paste_ids_page(filters, fdefaults, limit, cursor=None):
+    return _db.get_recent_paste_ids_page(filters, fdefaults, limit, cursor)
+
+
+@_wrap_sqlite_exception
+def search_paste_ids(query, filters, fdefaults, limit, cursor=None):
+    return _db.search_paste_ids(query, filters, fdefaults, limit, cursor)
@@ -1,8 +1,16 @@
+import os
+import re
 from functools import wraps
+from hashlib import sha256
 from os import environ
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
 
 from backends.exceptions import ErrorException
 
+# The size of the parts in which backends read paste contents for streaming
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def wrap_exception(exception_type, error_message):
     def _typed_exception_wrapper(func):
@@ -16,6 +24,53 @@ def wrap_exception(exception_type, error_message):
     return _typed_exception_wrapper
 
 
+def open_shared_file(path, header, size):
+    """
+    Opens the file that the TorPaste processes of a node share through
+    mmap, creating it with the given header and size if it does not exist.
+    A file that other processes may have mapped is never truncated, which
+    would crash them when they access the part that was cut, so every layout
+    gets a file of its own, named after the path and the header, which is
+    created whole under another name and then linked into place. The files
+    of other layouts are unlinked, which processes that still have them
+    mapped, such as the old ones of a rolling restart, do not notice.
+    :param header: the bytes the file starts with, which describe its layout
+    :return: the file descriptor of the file, opened for reading and writing
+    """
+    directory, prefix = os.path.split(path)
+    name = "%s.%s" % (prefix, sha256(header).hexdigest()[:16])
+    final = os.path.join(directory, name)
+
+    if not os.path.exists(final):
+        # Hidden, so that it is never mistaken for the file of a layout
+        tmp = os.path.join(directory, ".%s.tmp-%d" % (name, os.getpid()))
+        tmp_fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(tmp_fd, size)
+            os.pwrite(tmp_fd, header, 0)
+            os.link(tmp, final)
+        except FileExistsError:
+            # Another process created it first
+            pass
+        finally:
+            os.close(tmp_fd)
+            os.unlink(tmp)
+
+    fd = os.open(final, os.O_RDWR)
+    if os.fstat(fd).st_size != size:
+        os.close(fd)
+        raise ValueError("%s does not have the size of its layout" % final)
+
+    for other in os.listdir(directory or "."):
+        if other.startswith(prefix + ".") and other != name:
+            try:
+                os.unlink(os.path.join(directory, other))
+            except FileNotFoundError:
+                pass
+
+    return fd
+
+
 def getenv_required(key):
     try:
         return environ[key]
@@ -49,3 +104,81 @@ def filters_match(metadata, filters, fdefaults):
             return False
 
     return True
+
+
+# Object store backends keep an index of the pastes by date as empty objects
+# whose names start with this prefix, sort newest first, and carry the Paste
+# ID and the values of the indexed metadata keys
+RECENT_INDEX_PREFIX = 'index/recent/'
+
+_MAX_DATE = 9999999999
+
+
+def recent_index_key(paste_id, metadata, indexed_keys):
+    try:
+        date = int(metadata['date'])
+    except (KeyError, ValueError):
+        return None
+
+    if not 0 <= date <= _MAX_DATE:
+        return None
+
+    values = urlencode(sorted(
+        (key, metadata[key]) for key in indexed_keys if key in metadata))
+
+    return '%s%010d/%s/%s' % (
+        RECENT_INDEX_PREFIX, _MAX_DATE - date, paste_id, values or '-')
+
+
+def parse_recent_index_key(key):
+    _, paste_id, values = key[len(RECENT_INDEX_PREFIX):].split('/', 2)
+    return paste_id, dict(parse_qsl(values))
+
+
+# They also keep an index of the pastes that expire, whose names sort by the
+# time they expire at, soonest first
+EXPIRY_INDEX_PREFIX = 'index/expiry/'
+
+
+def expiry_index_key(paste_id, metadata):
+    try:
+        expires = int(metadata['expires'])
+    except (KeyError, ValueError):
+        return None
+
+    if not 0 <= expires <= _MAX_DATE:
+        return None
+
+    return '%s%010d/%s' % (EXPIRY_INDEX_PREFIX, expires, paste_id)
+
+
+def parse_expiry_index_key(key):
+    expires, paste_id = key[len(EXPIRY_INDEX_PREFIX):].split('/', 1)
+    return int(expires), paste_id
+
+
+def is_index_key(key):
+    return '/' in key
+
+
+# Only the start of every paste is indexed for searching, so that a huge
+# paste costs no more to index than this. It is small enough for the words
+# of any text this long, with their positions, to fit in the 1 MB a
+# Postgres tsvector is limited to, even if every one of them is different.
+SEARCH_INDEXED_CHARS = 64 * 1024
+
+_SEARCH_MAX_TERMS = 16
+
+
+def search_terms(query):
+    """
+    Splits a search query into the words a paste must all contain to match
+    it, ignoring punctuation and case, so that queries never carry the
+    operators of the full-text search engines.
+    """
+    return re.findall(r'\w+', query.lower())[:_SEARCH_MAX_TERMS]
+
+
+def fts5_query(terms):
+    # Quoted terms are matched as words, whatever they are
+    return ' '.join('"%s"' % term for term in terms)
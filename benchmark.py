@@ -0,0 +1,660 @@
+#!bin/python
+
+"""
+This file contains the benchmarks of TorPaste. They fill a backend with a
+corpus of pastes, and then measure paste creation, paste views, raw pastes
+and the paste listing in one of three modes:
+
+    backend   calling the functions of the backend module directly
+    app       through the Flask test client, in the same process
+    gunicorn  through HTTP requests to Gunicorn workers
+
+Every backend and mode runs in a process of its own, from an empty
+directory, so that the backends start from scratch and the memory used by
+each can be measured. The backends that need a service use a local stand-in:
+moto for aws_s3 (moto[server] in the gunicorn mode), an Azure storage
+emulator such as Azurite for azure_storage (which has to be running
+already), and the database in TP_BACKEND_POSTGRES_DATABASE_CONNECTION for
+postgres. Any other TP_ variable in the environment applies to the
+benchmarked application, so that caches and compression can be benchmarked
+too.
+
+    python benchmark.py run --backend filesystem --backend sqlite \\
+        --mode backend --mode app --corpus 10k --sizes lognormal:2048:1.5
+    python benchmark.py compare old.json new.json
+
+The results are saved as JSON, in benchmark-results/ by default, and two
+runs can be compared with the compare command.
+"""
+
+import argparse
+import http.client
+import importlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from hashlib import sha256
+from urllib.parse import urlencode
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+BACKENDS = ["filesystem", "sqlite", "postgres", "aws_s3", "azure_storage"]
+MODES = ["backend", "app", "gunicorn"]
+
+# At most this many Paste IDs of the corpus are kept to be read during the
+# benchmark, so that large corpora do not count towards the memory used
+_SAMPLE_SIZE = 10000
+
+_WORDS = (
+    "the quick brown fox jumps over lazy dog lorem ipsum dolor sit amet "
+    "def return import class self none true false if else for while with "
+    "0 1 2 3 42 100 1024 error warning info debug log line paste tor onion"
+).split(" ")
+
+
+def parse_count(value):
+    """
+    Parses a number of pastes such as 1000, 10k or 1M.
+    """
+    multipliers = {"k": 1000, "M": 1000000}
+    if value and value[-1] in multipliers:
+        return int(value[:-1]) * multipliers[value[-1]]
+    return int(value)
+
+
+def parse_sizes(value):
+    """
+    Parses a paste size distribution, which is one of fixed:SIZE,
+    uniform:MIN:MAX or lognormal:MEDIAN:SIGMA, with sizes in bytes.
+    :return: a callable returning a random paste size from a random.Random
+    """
+    name, *params = value.split(":")
+
+    try:
+        if name == "fixed":
+            size, = map(int, params)
+            return lambda rng: size
+        if name == "uniform":
+            low, high = map(int, params)
+            return lambda rng: rng.randint(low, high)
+        if name == "lognormal":
+            median, sigma = int(params[0]), float(params[1])
+            return lambda rng: max(1, int(
+                rng.lognormvariate(math.log(median), sigma)))
+    except ValueError:
+        pass
+
+    raise argparse.ArgumentTypeError("Invalid size distribution: " + value)
+
+
+def make_content(rng, size):
+    words = rng.choices(_WORDS, k=size // 4 + 1)
+    return " ".join(words)[:size]
+
+
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def rss_bytes(pid):
+    """
+    Returns the resident memory of a process, in bytes, or None where it
+    cannot be read.
+    """
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    try:
+        with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _StandIns(object):
+    """
+    Sets up the environment of a backend, and the local services it needs.
+    """
+
+    def __init__(self, backend, mode, workdir):
+        self._backend = backend
+        self._mode = mode
+        self._workdir = workdir
+        self._stop = []
+
+    def __enter__(self):
+        os.environ["TP_BACKEND"] = self._backend
+
+        if self._backend == "sqlite":
+            os.environ["TP_BACKEND_SQLITE_DATABASE_PATH"] = os.path.join(
+                self._workdir, "torpaste.sqlite")
+
+        elif self._backend == "postgres":
+            if not os.environ.get("TP_BACKEND_POSTGRES_DATABASE_CONNECTION"):
+                raise RuntimeError(
+                    "TP_BACKEND_POSTGRES_DATABASE_CONNECTION is not set")
+
+        elif self._backend == "azure_storage":
+            os.environ.setdefault("TP_BACKEND_AZURE_STORAGE_EMULATED", "true")
+
+        elif self._backend == "aws_s3":
+            os.environ.setdefault("TP_BACKEND_AWS_S3_ACCESS_KEY_ID", "bench")
+            os.environ.setdefault(
+                "TP_BACKEND_AWS_S3_SECRET_ACCESS_KEY", "bench")
+            os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+            if not os.environ.get("TP_BACKEND_AWS_S3_ENDPOINT_URL"):
+                # Gunicorn workers cannot share an in-process mock, so they
+                # get a moto server instead
+                if self._mode == "gunicorn":
+                    from moto.server import ThreadedMotoServer
+                    port = free_port()
+                    server = ThreadedMotoServer(port=port, verbose=False)
+                    server.start()
+                    self._stop.append(server.stop)
+                    os.environ["TP_BACKEND_AWS_S3_ENDPOINT_URL"] = \
+                        "http://127.0.0.1:%d" % port
+                else:
+                    from moto import mock_aws
+                    mock = mock_aws()
+                    mock.start()
+                    self._stop.append(mock.stop)
+
+        return self
+
+    def __exit__(self, *exc_info):
+        for stop in reversed(self._stop):
+            stop()
+
+
+def _populate(b, corpus, sizes, seed):
+    """
+    Fills the backend with the corpus, through the backend functions.
+    :return: a random sample of the Paste IDs of the corpus
+    """
+    rng = random.Random(seed)
+    sample = []
+    now = int(time.time())
+
+    for i in range(corpus):
+        content = make_content(rng, sizes(rng))
+        paste_id = sha256(content.encode("utf-8")).hexdigest()
+        metadata = {
+            "date": str(now - corpus + i),
+            "visibility": "public",
+        }
+
+        if hasattr(b, "create_paste"):
+            b.create_paste(paste_id, content, metadata)
+        else:
+            b.new_paste(paste_id, content)
+            b.update_paste_metadata(paste_id, metadata)
+
+        # Reservoir sampling, so that every paste is as likely to be read
+        if len(sample) < _SAMPLE_SIZE:
+            sample.append(paste_id)
+        else:
+            j = rng.randrange(i + 1)
+            if j < _SAMPLE_SIZE:
+                sample[j] = paste_id
+
+        if (i + 1) % 10000 == 0:
+            print("  %d/%d pastes" % (i + 1, corpus), file=sys.stderr)
+
+    return sample
+
+
+def _backend_operations(b, sample, sizes):
+    listing_filters = {"visibility": "public"}
+
+    def create(rng):
+        content = make_content(rng, sizes(rng))
+        paste_id = sha256(content.encode("utf-8")).hexdigest()
+        metadata = {"date": str(int(time.time())), "visibility": "public"}
+        if hasattr(b, "create_paste"):
+            b.create_paste(paste_id, content, metadata)
+        else:
+            b.new_paste(paste_id, content)
+            b.update_paste_metadata(paste_id, metadata)
+
+    def view(rng):
+        paste_id = rng.choice(sample)
+        if hasattr(b, "get_paste"):
+            b.get_paste(paste_id)
+        else:
+            b.get_paste_contents(paste_id)
+            b.get_paste_metadata(paste_id)
+
+    def raw(rng):
+        paste_id = rng.choice(sample)
+        if not hasattr(b, "open_paste_stream"):
+            b.get_paste_contents(paste_id)
+            return
+        stream = b.open_paste_stream(paste_id)
+        if hasattr(stream, "read"):
+            with stream:
+                while stream.read(64 * 1024):
+                    pass
+        else:
+            for _ in stream:
+                pass
+
+    def missing(rng):
+        b.does_paste_exist("%064x" % rng.getrandbits(256))
+
+    def listing(rng):
+        if hasattr(b, "get_recent_paste_ids_page"):
+            b.get_recent_paste_ids_page(
+                listing_filters, listing_filters, 100)
+        else:
+            b.get_all_paste_ids(listing_filters, listing_filters)
+
+    return [
+        ("create", create),
+        ("view", view),
+        ("raw", raw),
+        ("missing", missing),
+        ("list", listing),
+    ]
+
+
+def _http_operations(request, sample, sizes):
+    """
+    :param request: a callable taking a method, a path, a body and headers
+                    and returning the status code of the response
+    """
+    def check(status, expected):
+        if status not in expected:
+            raise RuntimeError("Unexpected status %d" % status)
+
+    def create(rng):
+        body = urlencode({"content": make_content(rng, sizes(rng))})
+        check(request(
+            "POST", "/new", body.encode("utf-8"),
+            {"Content-Type": "application/x-www-form-urlencoded"}), (302,))
+
+    def view(rng):
+        check(request("GET", "/view/" + rng.choice(sample)), (200,))
+
+    def raw(rng):
+        check(request("GET", "/raw/" + rng.choice(sample)), (200,))
+
+    def missing(rng):
+        paste_id = "%064x" % rng.getrandbits(256)
+        check(request("GET", "/view/" + paste_id), (404,))
+
+    def listing(rng):
+        check(request("GET", "/list"), (200,))
+
+    return [
+        ("create", create),
+        ("view", view),
+        ("raw", raw),
+        ("missing", missing),
+        ("list", listing),
+    ]
+
+
+def _measure(operation, count, concurrency, seed):
+    """
+    Runs an operation count times, split between concurrency threads.
+    :return: a dictionary of the results
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(index, runs):
+        rng = random.Random("%s-%d" % (seed, index))
+        own = []
+        failed = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            try:
+                operation(rng)
+            except Exception as ex:
+                failed.append("%s: %s" % (type(ex).__name__, ex))
+                continue
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+            errors.extend(failed)
+
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(i, count // concurrency + (i < count % concurrency)))
+        for i in range(concurrency)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {
+        "count": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "mean_ms": ms(sum(latencies) / len(latencies) if latencies else None),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+
+
+def _start_gunicorn(workers, workdir):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=REPOSITORY)
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn",
+            "-w", str(workers),
+            "-b", "127.0.0.1:%d" % port,
+            "--log-level", "warning",
+            "torpaste:app",
+        ],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Gunicorn exited with %d" % process.returncode)
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/about")
+            connection.getresponse().read()
+            connection.close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError("Gunicorn did not start")
+
+
+def _run_case(spec, results):
+    """
+    Runs the benchmark of a backend in a mode. This runs in a process of its
+    own, from an empty directory.
+    """
+    workdir = tempfile.mkdtemp(prefix="torpaste-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPOSITORY)
+    # TorPaste reads its version from the repository
+    os.environ["GIT_DIR"] = os.path.join(REPOSITORY, ".git")
+
+    backend, mode = spec["backend"], spec["mode"]
+    sizes = parse_sizes(spec["sizes"])
+    result = {
+        "backend": backend,
+        "mode": mode,
+        "corpus": spec["corpus"],
+        "sizes": spec["sizes"],
+        "concurrency": spec["concurrency"],
+    }
+
+    try:
+        with _StandIns(backend, mode, workdir):
+            b = importlib.import_module("backends." + backend)
+            b.initialize_backend()
+
+            start = time.perf_counter()
+            sample = _populate(b, spec["corpus"], sizes, spec["seed"])
+            result["populate_seconds"] = round(time.perf_counter() - start, 3)
+
+            if mode == "backend":
+                operations = _backend_operations(b, sample, sizes)
+            elif mode == "app":
+                import torpaste
+                local = threading.local()
+
+                def request(method, path, body=None, headers=None):
+                    if not hasattr(local, "client"):
+                        local.client = torpaste.app.test_client()
+                    response = local.client.open(
+                        path, method=method, data=body, headers=headers)
+                    response.get_data()
+                    return response.status_code
+                operations = _http_operations(request, sample, sizes)
+            else:
+                process, port = _start_gunicorn(spec["workers"], workdir)
+
+                def request(method, path, body=None, headers=None):
+                    connection = http.client.HTTPConnection(
+                        "127.0.0.1", port, timeout=60)
+                    try:
+                        connection.request(method, path, body, headers or {})
+                        response = connection.getresponse()
+                        response.read()
+                        return response.status
+                    finally:
+                        connection.close()
+                operations = _http_operations(request, sample, sizes)
+
+            try:
+                result["operations"] = {}
+                for name, operation in operations:
+                    print("  %s %s %s" % (backend, mode, name),
+                          file=sys.stderr)
+                    result["operations"][name] = _measure(
+                        operation,
+                        spec["operations"],
+                        spec["concurrency"],
+                        spec["seed"])
+
+                if mode == "gunicorn":
+                    pids = [process.pid] + child_pids(process.pid)
+                    result["rss_bytes"] = sum(
+                        rss_bytes(pid) or 0 for pid in pids)
+                else:
+                    result["rss_bytes"] = rss_bytes(os.getpid())
+                result["max_rss_bytes"] = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss * 1024
+            finally:
+                if mode == "gunicorn":
+                    process.terminate()
+                    process.wait()
+    except Exception as ex:
+        result["error"] = "%s: %s" % (type(ex).__name__, ex)
+    finally:
+        os.chdir(REPOSITORY)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results.put(result)
+
+
+def run(args):
+    context = multiprocessing.get_context("spawn")
+    report = {
+        "version": subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=REPOSITORY).decode("utf-8").strip(),
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "arguments": {
+            k: v for k, v in vars(args).items() if k != "function"
+        },
+        "results": [],
+    }
+
+    for corpus in args.corpus:
+        for backend in args.backend:
+            for mode in args.mode:
+                print("%s, %s, %d pastes" % (backend, mode, corpus),
+                      file=sys.stderr)
+                spec = {
+                    "backend": backend,
+                    "mode": mode,
+                    "corpus": corpus,
+                    "sizes": args.sizes,
+                    "operations": args.operations,
+                    "concurrency": args.concurrency,
+                    "workers": args.workers,
+                    "seed": args.seed,
+                }
+
+                results = context.Queue()
+                process = context.Process(
+                    target=_run_case, args=(spec, results))
+                process.start()
+                result = results.get()
+                process.join()
+
+                report["results"].append(result)
+                print_result(result)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to " + args.output, file=sys.stderr)
+
+
+def print_result(result):
+    if "error" in result:
+        print("%-14s %-9s %8d  failed: %s" % (
+            result["backend"], result["mode"], result["corpus"],
+            result["error"]))
+        return
+
+    for name, op in result["operations"].items():
+        print("%-14s %-9s %8d %-8s p50 %9s ms  p99 %9s ms  %9s/s  %s" % (
+            result["backend"], result["mode"], result["corpus"], name,
+            op["p50_ms"], op["p99_ms"], op["throughput"],
+            "%d errors" % op["errors"] if op["errors"] else ""))
+    if result.get("rss_bytes"):
+        print("%-14s %-9s %8d rss %.1f MB" % (
+            result["backend"], result["mode"], result["corpus"],
+            result["rss_bytes"] / 1024 / 1024))
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    def index(report):
+        return {
+            (r["backend"], r["mode"], r["corpus"]): r
+            for r in report["results"] if "error" not in r
+        }
+
+    def change(before, after):
+        if not before or after is None:
+            return ""
+        return "%+.1f%%" % ((after - before) / before * 100)
+
+    print("%s -> %s" % (old["version"], new["version"]))
+    old_results = index(old)
+    for key, after in sorted(index(new).items()):
+        before = old_results.get(key)
+        if before is None:
+            continue
+        for name, op in after["operations"].items():
+            previous = before["operations"].get(name)
+            if previous is None:
+                continue
+            print("%-14s %-9s %8d %-8s p50 %8s  p99 %8s  throughput %8s" % (
+                key + (name,) + (
+                    change(previous["p50_ms"], op["p50_ms"]),
+                    change(previous["p99_ms"], op["p99_ms"]),
+                    change(previous["throughput"], op["throughput"]))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of TorPaste")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--backend", action="append", choices=BACKENDS,
+        help="a backend to benchmark, can be repeated (default: filesystem)")
+    run_parser.add_argument(
+        "--mode", action="append", choices=MODES,
+        help="how to drive the backend, can be repeated (default: backend)")
+    run_parser.add_argument(
+        "--corpus", action="append", type=parse_count,
+        help="the number of pastes stored before measuring, such as 1k or "
+             "1M, can be repeated (default: 1k)")
+    run_parser.add_argument(
+        "--sizes", default="lognormal:2048:1.0",
+        help="the distribution of paste sizes in bytes: fixed:SIZE, "
+             "uniform:MIN:MAX or lognormal:MEDIAN:SIGMA "
+             "(default: lognormal:2048:1.0)")
+    run_parser.add_argument(
+        "--operations", type=int, default=1000,
+        help="the number of times each operation is measured "
+             "(default: 1000)")
+    run_parser.add_argument(
+        "--concurrency", type=int, default=1,
+        help="the number of operations running at the same time "
+             "(default: 1)")
+    run_parser.add_argument(
+        "--workers", type=int, default=4,
+        help="the number of Gunicorn workers (default: 4)")
+    run_parser.add_argument("--seed", default="torpaste")
+    run_parser.add_argument(
+        "--output",
+        help="the file the results are saved to "
+             "(default: benchmark-results/<date>.json)")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = commands.add_parser(
+        "compare", help="compare the results of two runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        parse_sizes(args.sizes)
+        args.backend = args.backend or ["filesystem"]
+        args.mode = args.mode or ["backend"]
+        args.corpus = args.corpus or [1000]
+        args.output = args.output or os.path.join(
+            "benchmark-results",
+            datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
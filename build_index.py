@@ -0,0 +1,78 @@
+#!bin/python
+
+"""
+This file contains the tool that adds the pastes stored before the paste
+listing was ordered by date to the date index of the object store backends,
+which must be run once after upgrading a deployment with existing pastes:
+
+    TP_BACKEND_AWS_S3_ACCESS_KEY_ID=... \\
+        TP_BACKEND_AWS_S3_SECRET_ACCESS_KEY=... \\
+        python build_index.py --backend aws_s3
+
+The backend is configured with its usual TP_BACKEND_ variables. TorPaste
+keeps running meanwhile, and lists the pastes by Paste ID until the index is
+built. The progress is saved in the backend after every batch, so that an
+interrupted build resumes where it stopped when it is started again. Once
+it is built, the Bloom filter of the TorPaste processes of the node, at
+TP_BLOOM_FILTER_PATH, is invalidated like migrate.py does, so that it is
+rebuilt from a listing taken after the backend was upgraded.
+"""
+
+import argparse
+import importlib
+import os
+import sys
+import time
+
+from backends import bloom_filter
+
+BACKENDS = ["aws_s3", "azure_storage"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add the existing pastes to the date index of a backend")
+    parser.add_argument(
+        "--backend", required=True, choices=BACKENDS,
+        help="the backend to build the index of")
+    parser.add_argument(
+        "--batch-size", type=int, default=1000,
+        help="the number of pastes added and checkpointed at once "
+             "(default: 1000)")
+    args = parser.parse_args()
+
+    if args.batch_size < 1:
+        print("Invalid --batch-size", file=sys.stderr)
+        exit(1)
+
+    try:
+        backend = importlib.import_module("backends." + args.backend)
+        backend.initialize_backend()
+    except Exception as ex:
+        print("Failed to initialize the backend: %s" % ex, file=sys.stderr)
+        exit(1)
+
+    start = time.time()
+    added = 0
+    finished = False
+
+    while not finished:
+        try:
+            count, finished = backend.build_recent_index(args.batch_size)
+        except backend.e.ErrorException as ex:
+            print("Failed to build the index, run this again to resume: "
+                  "%s" % ex, file=sys.stderr)
+            exit(1)
+
+        added += count
+        elapsed = time.time() - start
+        print("%d pastes added (%.0f pastes/s)" % (
+            added, added / elapsed if elapsed else 0), file=sys.stderr)
+
+    bloom_filter.invalidate(
+        os.getenv("TP_BLOOM_FILTER_PATH") or bloom_filter.DEFAULT_PATH)
+    print("The date index is built", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 #!bin/python
 
 import time
+from bisect import bisect_right
+from codecs import getincrementaldecoder
 from hashlib import sha256
+from tempfile import SpooledTemporaryFile
+from urllib.parse import unquote_to_bytes
 
 
 def format_size(size):
@@ -24,6 +28,224 @@ def format_size(size):
     return str(round(size, 1)) + " " + scales[count]
 
 
+# The size of the parts in which uploaded pastes are read
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Uploaded pastes are kept in memory up to this size, and in a temporary
+# file after that
+_UPLOAD_SPOOL_SIZE = 1024 * 1024
+
+# The maximum size of every form field other than the paste content
+_MAX_FIELD_SIZE = 1024
+
+# The maximum length of search queries
+_MAX_QUERY_LENGTH = 256
+
+# The room left for the other form fields when checking the length of an
+# upload against the maximum paste size
+_MAX_FORM_OVERHEAD = 4096
+
+
+def _get_visibility(metadata, config):
+    """
+    This method returns the visibility requested for a new paste, or the
+    default one if none was requested.
+    :return: The visibility, or None if it is not currently supported.
+    """
+    try:
+        visibility = metadata['visibility']
+    except KeyError:
+        return config['ENABLED_PASTE_VISIBILITIES'][0]
+
+    if visibility not in config['ENABLED_PASTE_VISIBILITIES']:
+        return None
+    return visibility
+
+
+def _get_expiry(metadata, config):
+    """
+    This method returns the expiry requested for a new paste, or the
+    default one if none was requested.
+    :return: The expiry, or None if it is not currently supported.
+    """
+    try:
+        expiry = metadata['expiry']
+    except KeyError:
+        return next(iter(config['ENABLED_PASTE_EXPIRIES']))
+
+    if expiry not in config['ENABLED_PASTE_EXPIRIES']:
+        return None
+    return expiry
+
+
+def _expiry_time(expiry, config):
+    """
+    This method returns the time a new paste with the given expiry expires
+    at, as a UNIX timestamp, or None if it never expires.
+    """
+    seconds = config['ENABLED_PASTE_EXPIRIES'][expiry]
+    if seconds is None:
+        return None
+    return int(time.time()) + seconds
+
+
+def _parse_expires(expires):
+    """
+    This method parses the "expires" metadata value of a paste.
+    :return: The time the paste expires at, as a UNIX timestamp, or None if
+             it never expires.
+    """
+    try:
+        return int(expires)
+    except (TypeError, ValueError):
+        return None
+
+
+def has_expired(expires, now):
+    """
+    This method tells whether a paste has expired, given the value of its
+    "expires" metadata key.
+    :param expires: The "expires" metadata value of the paste, or None
+    :param now: The current time, as a UNIX timestamp
+    :return: True if the paste has expired, or False if it expires later
+             or never does.
+    """
+    expires = _parse_expires(expires)
+    return expires is not None and expires <= now
+
+
+def _current_expires(b, paste_id, expires):
+    """
+    This method returns the time a paste expires at, given the one read
+    along with it, which may come from a cache that another process did not
+    update when the paste was submitted again. Submitting a paste again
+    never makes it expire sooner, unless it had expired already, so only
+    an expiry time that has passed is read again from the backend.
+    :return: The expiry time, as read, or None if the paste never expires.
+             A paste that no longer exists has expired.
+    """
+    if not has_expired(expires, time.time()):
+        return expires
+
+    try:
+        if not b.does_paste_exist(paste_id):
+            return expires
+        return b.get_paste_metadata(paste_id).get("expires")
+    except b.e.WarningException:
+        return None
+    except b.e.ErrorException:
+        # Without the backend, the paste is taken to have expired as read
+        return expires
+
+
+def _merge_expires(current, expires, now):
+    """
+    This method returns the time a paste submitted again expires at, given
+    the metadata it currently has. The paste is kept for as long as any of
+    the submissions that have not expired yet asked for.
+    :param current: The current metadata of the paste
+    :param expires: The time the new submission expires at, or None
+    :param now: The current time, as a UNIX timestamp
+    """
+    if has_expired(current.get("expires"), now):
+        return expires
+
+    current_expires = _parse_expires(current.get("expires"))
+    if current_expires is None or expires is None:
+        return None
+    return max(current_expires, expires)
+
+
+def _too_large_error(config):
+    return "ERROR", "The paste sent is too large. This TorPaste " +\
+        "instance has a maximum allowed paste size of " +\
+        format_size(config['MAX_PASTE_SIZE']) + "."
+
+
+def write_new_paste(b, paste_id, content, metadata):
+    """
+    This method writes a paste that does not exist yet to the backend, in
+    a single operation if the backend provides create_paste (or
+    create_paste_stream) for that.
+    :param content: The content of the paste, as a string or as a binary
+                    file object
+    :return: True if the metadata was written along with the content, or
+             False if it still needs to be.
+    """
+    if isinstance(content, str):
+        if hasattr(b, 'create_paste'):
+            b.create_paste(paste_id, content, metadata)
+            return True
+        b.new_paste(paste_id, content)
+        return False
+
+    content.seek(0)
+    if hasattr(b, 'create_paste_stream'):
+        b.create_paste_stream(paste_id, content, metadata)
+        return True
+    if hasattr(b, 'new_paste_stream'):
+        b.new_paste_stream(paste_id, content)
+        return False
+    return write_new_paste(b, paste_id, content.read().decode("utf-8"),
+                           metadata)
+
+
+def _store_new_paste(paste_id, content, visibility, expires, config):
+    """
+    This method stores a new paste in the currently used backend, along with
+    its metadata. If the paste already exists, its content is not written
+    again, and neither is its metadata if the visibility and the expiry time
+    are the same.
+    :param paste_id: The Paste ID of the new paste
+    :param content: The content of the paste, as a string or as a binary
+                    file object
+    :param visibility: The visibility of the new paste
+    :param expires: The time the new paste expires at, or None
+    :param config: The TorPaste configuration object
+    :return: The result of the action (ERROR/OK) and some data (error
+             message/Paste ID).
+    """
+    b = config['b']
+    now = int(time.time())
+
+    metadata = {
+        "date": str(now),
+        "visibility": visibility
+    }
+    if expires is not None:
+        metadata["expires"] = str(expires)
+
+    # Paste IDs are the hash of the content, so a paste with the same ID
+    # already has the same content, and only its metadata may change
+    try:
+        exists = b.does_paste_exist(paste_id)
+        if exists:
+            try:
+                current = b.get_paste_metadata(paste_id)
+            except b.e.WarningException:
+                current = {}
+
+            expires = _merge_expires(current, expires, now)
+            metadata.pop("expires", None)
+            if expires is not None:
+                metadata["expires"] = str(expires)
+
+            if (current.get("visibility") == visibility and
+                    current.get("expires") == metadata.get("expires")):
+                return "OK", paste_id
+        elif write_new_paste(b, paste_id, content, metadata):
+            return "OK", paste_id
+    except b.e.ErrorException as errmsg:
+        return "ERROR", errmsg
+
+    try:
+        b.update_paste_metadata(paste_id, metadata)
+    except b.e.ErrorException as errmsg:
+        return "ERROR", errmsg
+
+    return "OK", paste_id
+
+
 def create_new_paste(content, metadata, config):
     """
     This method is responsible for creating new pastes by directly
@@ -37,55 +259,183 @@ def create_new_paste(content, metadata, config):
              Paste ID) as well as the suggested HTTP Status Code to return.
     """
 
-    try:
-        visibility = metadata['visibility']
-        if visibility not in config['ENABLED_PASTE_VISIBILITIES']:
-            return "ERROR", "The requested paste visibility is not " +\
-                "currently supported."
-    except KeyError:
-        visibility = config['ENABLED_PASTE_VISIBILITIES'][0]
+    visibility = _get_visibility(metadata, config)
+    if visibility is None:
+        return "ERROR", "The requested paste visibility is not " +\
+            "currently supported."
+
+    expiry = _get_expiry(metadata, config)
+    if expiry is None:
+        return "ERROR", "The requested paste expiry is not " +\
+            "currently supported."
 
     try:
-        paste_id = str(sha256(content.encode('utf-8')).hexdigest())
+        encoded = content.encode('utf-8')
     except Exception:
         return "ERROR", "An issue occurred while handling the paste. " +\
             "Please try again later. If the problem persists, try " +\
             "notifying a system administrator."
 
-    if (len(content.encode('utf-8')) > config['MAX_PASTE_SIZE']):
-        return "ERROR", "The paste sent is too large. This TorPaste " +\
-            "instance has a maximum allowed paste size of " +\
-            format_size(config['MAX_PASTE_SIZE']) + "."
+    if (len(encoded) > config['MAX_PASTE_SIZE']):
+        return _too_large_error(config)
 
-    try:
-        config['b'].new_paste(paste_id, content)
-    except config['b'].e.ErrorException as errmsg:
-        return "ERROR", errmsg
+    paste_id = str(sha256(encoded).hexdigest())
 
-    try:
-        config['b'].update_paste_metadata(
-            paste_id,
-            {
-                "date": str(int(time.time())),
-                "visibility": visibility
-            }
-        )
-    except config['b'].e.ErrorException as errmsg:
-        return "ERROR", errmsg
+    return _store_new_paste(
+        paste_id, content, visibility, _expiry_time(expiry, config), config)
 
-    return "OK", paste_id
 
+def _parse_form(stream, length):
+    """
+    This method parses an application/x-www-form-urlencoded request body
+    while it is being read, without ever holding all of it in memory.
+    :param stream: The request body stream
+    :param length: The length of the request body
+    :return: An iterator of (field name, decoded bytes) tuples, with a tuple
+             for every part of the value of every field, in order. Every
+             field starts with a tuple whose bytes are None.
+    """
+    in_name = True
+    name = b""
+    pending = b""
 
-def view_existing_paste(paste_id, config):
+    while length > 0:
+        chunk = stream.read(min(length, _UPLOAD_CHUNK_SIZE))
+        if not chunk:
+            break
+        length -= len(chunk)
+
+        data = pending + chunk
+
+        # Keep percent escapes that are split between chunks for later
+        if length > 0:
+            cut = data.rfind(b"%", len(data) - 2)
+            if cut == -1:
+                cut = len(data)
+        else:
+            cut = len(data)
+        data, pending = data[:cut], data[cut:]
+
+        for i, part in enumerate(data.split(b"&")):
+            if i > 0:
+                in_name = True
+                name = b""
+
+            if in_name:
+                name_part, separator, part = part.partition(b"=")
+                name += name_part
+                if not separator:
+                    if len(name) > _MAX_FIELD_SIZE:
+                        raise ValueError("Form field name too long")
+                    continue
+                in_name = False
+                field = unquote_to_bytes(name.replace(b"+", b" ")) \
+                    .decode("utf-8", "replace")
+                yield field, None
+
+            if part:
+                yield field, unquote_to_bytes(part.replace(b"+", b" "))
+
+
+def create_new_paste_from_stream(stream, length, config):
     """
-    This method is responsible for checking if a paste with a given Paste ID
-    exists, and if it does, return its contents and needed metadata in order
-    for the View Paste view to work.
-    :param paste_id: The Paste ID to look for.
+    This method is responsible for creating new pastes from a form that is
+    still being uploaded. The paste content is hashed and checked against
+    the Maximum Allowed Paste Size while it is read, and is then handed to
+    the backend as a file, so that only a small part of it is ever held in
+    memory.
+    :param stream: The request body stream, which must be an
+                   application/x-www-form-urlencoded form
+    :param length: The length of the request body, from Content-Length
     :param config: The TorPaste configuration object
-    :return: The result of the action (ERROR/WARNING/OK), some data (error
-             message / data tuple) as well as the suggested HTTP Status Code
-             to return.
+    :return: The result of the action (ERROR/OK) and some data (error
+             message/Paste ID).
+    """
+
+    # Every byte of the paste takes at least one and at most three bytes in
+    # the form, so longer forms can be refused without reading them
+    if (length is None):
+        return "ERROR", "The length of the paste sent is not known."
+    if (length > 3 * config['MAX_PASTE_SIZE'] + _MAX_FORM_OVERHEAD):
+        return _too_large_error(config)
+
+    fields = {}
+    content = SpooledTemporaryFile(max_size=_UPLOAD_SPOOL_SIZE)
+    content_hash = sha256()
+    content_size = 0
+
+    # The content is decoded as it is read, like Flask decodes forms, so
+    # that invalid UTF-8 is stored as it would be without streaming
+    decoder = getincrementaldecoder("utf-8")("replace")
+
+    try:
+        for field, data in _parse_form(stream, length):
+            if field != "content":
+                if data is not None:
+                    fields[field] = fields.get(field, b"") + data
+                    if len(fields[field]) > _MAX_FIELD_SIZE:
+                        raise ValueError("Form field too long")
+                continue
+            if data is None:
+                continue
+
+            data = decoder.decode(data).encode("utf-8")
+            content_size += len(data)
+            if (content_size > config['MAX_PASTE_SIZE']):
+                content.close()
+                return _too_large_error(config)
+
+            content_hash.update(data)
+            content.write(data)
+
+        data = decoder.decode(b"", final=True).encode("utf-8")
+        content_size += len(data)
+        content_hash.update(data)
+        content.write(data)
+    except Exception:
+        content.close()
+        return "ERROR", "An issue occurred while handling the paste. " +\
+            "Please try again later. If the problem persists, try " +\
+            "notifying a system administrator."
+
+    if (content_size == 0):
+        content.close()
+        return "ERROR", "Please enter some text to include in the paste."
+    if (content_size > config['MAX_PASTE_SIZE']):
+        content.close()
+        return _too_large_error(config)
+
+    metadata = {
+        k: v.decode("utf-8", "replace") for k, v in fields.items()
+    }
+    visibility = _get_visibility(metadata, config)
+    if visibility is None:
+        content.close()
+        return "ERROR", "The requested paste visibility is not " +\
+            "currently supported."
+
+    expiry = _get_expiry(metadata, config)
+    if expiry is None:
+        content.close()
+        return "ERROR", "The requested paste expiry is not " +\
+            "currently supported."
+
+    paste_id = content_hash.hexdigest()
+
+    try:
+        return _store_new_paste(
+            paste_id, content, visibility, _expiry_time(expiry, config),
+            config)
+    finally:
+        content.close()
+
+
+def _check_paste_id(paste_id):
+    """
+    This method checks that a Paste ID looks valid before asking the backend
+    about it.
+    :param paste_id: The Paste ID to check
+    :return: None if the Paste ID is valid, otherwise an ERROR result tuple
     """
     if (not paste_id.isalnum()):
         return "ERROR", "Invalid Paste ID. Please check the link " +\
@@ -96,39 +446,173 @@ def view_existing_paste(paste_id, config):
            "are 64 characters long. Please make sure the link you " +\
            "clicked is correct or use the Pastes button above.", 400
 
-    if (not config['b'].does_paste_exist(paste_id)):
+    return None
+
+
+def view_existing_paste(paste_id, config):
+    """
+    This method is responsible for checking if a paste with a given Paste ID
+    exists, and if it does, return its contents and needed metadata in order
+    for the View Paste view to work. If the backend provides get_paste, this
+    takes a single backend operation, otherwise it takes three. Pastes that
+    have expired are not found, even if they have not been deleted yet.
+    :param paste_id: The Paste ID to look for.
+    :param config: The TorPaste configuration object
+    :return: The result of the action (ERROR/WARNING/OK), some data (error
+             message / (content, date, expiry time) tuple) as well as the
+             suggested HTTP Status Code to return. WARNING means that the
+             paste date is not available, in which case it is None in the
+             data tuple. The expiry time is None if the paste never expires.
+    """
+    error = _check_paste_id(paste_id)
+    if error is not None:
+        return error
+
+    b = config['b']
+
+    if hasattr(b, 'get_paste'):
+        try:
+            paste = b.get_paste(paste_id)
+        except b.e.ErrorException as errmsg:
+            return "ERROR", errmsg, 500
+
+        if paste is None:
+            return "ERROR", "A paste with this Paste ID could not be " +\
+                "found. Sorry.", 404
+
+        paste_content, paste_metadata = paste
+
+    else:
+        if (not b.does_paste_exist(paste_id)):
+            return "ERROR", "A paste with this Paste ID could not be " +\
+                "found. Sorry.", 404
+
+        try:
+            paste_content = b.get_paste_contents(paste_id)
+        except b.e.ErrorException as errmsg:
+            return "ERROR", errmsg, 500
+
+        try:
+            paste_metadata = b.get_paste_metadata(paste_id)
+        except b.e.ErrorException as errmsg:
+            return "ERROR", errmsg, 500
+        except b.e.WarningException:
+            paste_metadata = {}
+
+    paste_date = paste_metadata.get("date")
+    paste_expires = _current_expires(
+        b, paste_id, paste_metadata.get("expires"))
+
+    if has_expired(paste_expires, time.time()):
         return "ERROR", "A paste with this Paste ID could not be " +\
             "found. Sorry.", 404
 
+    paste_expires = _parse_expires(paste_expires)
+
+    if paste_date is None:
+        return "WARNING", (paste_content, None, paste_expires), 200
+
+    return "OK", (paste_content, paste_date, paste_expires), 200
+
+
+def open_raw_paste(paste_id, config, encodings=()):
+    """
+    This method is responsible for opening a paste so that its raw contents
+    can be sent to the client. If the backend provides open_paste_stream,
+    the contents are streamed in parts, otherwise they are loaded in full.
+    If the backend stores the paste compressed with one of the content
+    encodings the client accepts, it is sent as it is stored.
+    :param paste_id: The Paste ID to look for.
+    :param config: The TorPaste configuration object
+    :param encodings: The content encodings the client accepts
+    :return: The result of the action (ERROR/OK), some data (error message /
+             (iterable of byte strings or binary file object, content
+             encoding or None, expiry time or None) tuple) as well as the
+             suggested HTTP Status Code to return.
+    """
+    error = _check_paste_id(paste_id)
+    if error is not None:
+        return error
+
+    b = config['b']
+
+    if not hasattr(b, 'open_paste_stream'):
+        status, data, code = view_existing_paste(paste_id, config)
+        if (status == "ERROR"):
+            return status, data, code
+        return "OK", ([data[0].encode('utf-8')], None, data[2]), 200
+
     try:
-        paste_content = config['b'].get_paste_contents(paste_id)
-    except config['b'].e.ErrorException as errmsg:
+        if hasattr(b, 'open_encoded_paste_stream'):
+            stream, encoding = b.open_encoded_paste_stream(
+                paste_id, encodings)
+        else:
+            stream, encoding = b.open_paste_stream(paste_id), None
+    except b.e.ErrorException as errmsg:
         return "ERROR", errmsg, 500
 
+    if stream is None:
+        return "ERROR", "A paste with this Paste ID could not be " +\
+            "found. Sorry.", 404
+
+    # Streams carry no metadata, so the expiry time takes another operation
     try:
-        paste_date = config['b'].get_paste_metadata_value(paste_id, "date")
-    except config['b'].e.ErrorException as errmsg:
+        expires = b.get_paste_metadata_value(paste_id, "expires")
+    except b.e.ErrorException as errmsg:
+        _close(stream)
         return "ERROR", errmsg, 500
-    except config['b'].e.WarningException as errmsg:
-        return "WARNING", errmsg, 500
+    except b.e.WarningException:
+        expires = None
+    expires = _current_expires(b, paste_id, expires)
+
+    if has_expired(expires, time.time()):
+        _close(stream)
+        return "ERROR", "A paste with this Paste ID could not be " +\
+            "found. Sorry.", 404
+
+    return "OK", (stream, encoding, _parse_expires(expires)), 200
 
-    return "OK", (paste_content, paste_date), 200
 
+def _close(stream):
+    if hasattr(stream, "close"):
+        stream.close()
 
-def get_paste_listing(config, filters={}, fdefaults={}):
+
+def get_paste_listing(config, filters={}, fdefaults={}, cursor=None):
     """
-    This method is responsible for returning a list of all currently saved
-    pastes, or a list with only one element ("none") if there are no pastes.
+    This method is responsible for returning a page of the list of currently
+    saved pastes, newest first if the backend supports it, or ordered by
+    Paste ID otherwise. If the backend does not support paging at all, the
+    whole list is loaded from it and then split in pages.
     :param config: The TorPaste configuration object
     :param filters: a dictionary of filters to apply on the listing
-    :return: A list with all Paste IDs of all stored pastes. If no stored
-             pastes exist, a list with only one element, "none".
+    :param fdefaults: a dictionary with the default value for each filter
+    :param cursor: the cursor of the page to return, as returned with the
+                   previous page, or None for the first page
+    :return: A tuple with a list of the Paste IDs in the page and the cursor
+             of the next page, or None if this is the last page.
     """
     if (not config['PASTE_LIST_ACTIVE']):
         return "ERROR", "Paste listing has been disabled by the " +\
             "administrator.", 503
 
     b = config['b']
+    limit = config['PASTE_LIST_PAGE_SIZE']
+
+    if hasattr(b, 'get_recent_paste_ids_page'):
+        get_page = b.get_recent_paste_ids_page
+    elif hasattr(b, 'get_paste_ids_page'):
+        get_page = b.get_paste_ids_page
+    else:
+        get_page = None
+
+    if get_page is not None:
+        try:
+            page = get_page(filters, fdefaults, limit, cursor)
+        except b.e.ErrorException as errmsg:
+            return "ERROR", errmsg, 500
+
+        return "OK", page, 200
 
     try:
         paste_list = b.get_all_paste_ids(filters, fdefaults)
@@ -136,6 +620,97 @@ def get_paste_listing(config, filters={}, fdefaults={}):
         return "ERROR", errmsg, 500
 
     if (paste_list[0] == "none"):
-        return "OK", "none", 200
+        return "OK", ([], None), 200
+
+    paste_list.sort()
+    if cursor is not None:
+        paste_list = paste_list[bisect_right(paste_list, cursor):]
+
+    if len(paste_list) > limit:
+        return "OK", (paste_list[:limit], paste_list[limit - 1]), 200
+    return "OK", (paste_list, None), 200
+
+
+def search_pastes(config, query, filters={}, fdefaults={}, cursor=None):
+    """
+    This method is responsible for returning a page of the pastes that
+    contain all the words of a search query, most recent first. The
+    backend searches an index of the pastes that is updated as they are
+    stored, its own or one kept on this machine for it.
+    :param config: The TorPaste configuration object
+    :param query: the words to search for
+    :param filters: a dictionary of filters to apply on the results
+    :param fdefaults: a dictionary with the default value for each filter
+    :param cursor: the cursor of the page to return, as returned with the
+                   previous page, or None for the first page
+    :return: A tuple with a list of the Paste IDs in the page and the cursor
+             of the next page, or None if this is the last page.
+    """
+    if (not config['SEARCH_ACTIVE']):
+        return "ERROR", "Search has been disabled by the administrator.", 503
+
+    b = config['b']
+    if (not hasattr(b, 'search_paste_ids')):
+        return "ERROR", "Search is not supported by the backend.", 503
+
+    if (len(query) > _MAX_QUERY_LENGTH):
+        return "ERROR", "Search queries can be at most " +\
+            str(_MAX_QUERY_LENGTH) + " characters long.", 400
+
+    try:
+        page = b.search_paste_ids(
+            query, filters, fdefaults, config['PASTE_LIST_PAGE_SIZE'], cursor)
+    except b.e.ErrorException as errmsg:
+        return "ERROR", errmsg, 500
+
+    return "OK", page, 200
+
+
+def reap_expired_pastes(config):
+    """
+    This method deletes the pastes that have expired from the currently
+    used backend, in batches, until none is left. The expired pastes are
+    looked up in the expiry index of the backend, so that the pastes that
+    have not expired are never read.
+    :param config: The TorPaste configuration object
+    :return: The number of pastes deleted
+    """
+    b = config['b']
+    limit = config['REAPER_BATCH_SIZE']
+
+    if not hasattr(b, 'get_expired_paste_ids') or \
+            not hasattr(b, 'delete_paste'):
+        return 0
+
+    deleted = 0
+    while True:
+        now = int(time.time())
+        paste_ids = b.get_expired_paste_ids(now, limit)
+
+        batch = 0
+        for paste_id in paste_ids:
+            try:
+                # A paste that no longer exists is left in the expiry index
+                # by an interrupted deletion, which deleting it again undoes
+                if not b.does_paste_exist(paste_id):
+                    b.delete_paste(paste_id)
+                    batch += 1
+                    continue
+
+                # The paste may have been submitted again since, and expire
+                # later
+                try:
+                    expires = b.get_paste_metadata_value(paste_id, "expires")
+                except b.e.WarningException:
+                    expires = None
+                if has_expired(expires, now):
+                    b.delete_paste(paste_id)
+                    batch += 1
+            except b.e.ErrorException:
+                # The other pastes of the batch are still deleted, and this
+                # one is tried again in the next run
+                continue
 
-    return "OK", paste_list, 200
+        deleted += batch
+        if len(paste_ids) < limit or batch == 0:
+            return deleted
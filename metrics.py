@@ -0,0 +1,354 @@
+"""
+This file contains the metrics of TorPaste, which are exposed in the text
+format of Prometheus on /metrics when TP_METRICS_DIR is set.
+
+Gunicorn handles requests in several worker processes, so the metrics cannot
+simply be kept in the memory of each process. Every process keeps its values
+in a memory-mapped file of its own in the metrics directory, which no other
+process writes to, and /metrics adds up the files of all the processes. The
+files of the workers that have exited are still counted, so that counters
+never go backwards when Gunicorn restarts a worker.
+
+A file starts with a small header holding the number of bytes in use, and is
+followed by entries made of the length of a key, the key and a double, which
+are only ever appended. The number of bytes in use is updated after the entry
+is written, so that readers never see a partial entry.
+"""
+
+import json
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+_MAGIC = b"TPMT1\x00\x00\x00"
+
+# magic, bytes in use
+_HEADER = struct.Struct("<8sQ")
+_KEY_LENGTH = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+
+_INITIAL_SIZE = 64 * 1024
+
+# The upper bounds of the buckets of the duration histograms, in seconds
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+def _padded(length):
+    return length + -length % 8
+
+
+def _read_values(path):
+    """
+    Reads the values stored in the metrics file of a process.
+    :return: a list of (key, value) tuples
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) < _HEADER.size:
+        return []
+    magic, used = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC:
+        return []
+
+    values = []
+    offset = _HEADER.size
+    while offset < min(used, len(data)):
+        length = _KEY_LENGTH.unpack_from(data, offset)[0]
+        key_start = offset + _KEY_LENGTH.size
+        value_start = _padded(key_start + length)
+        values.append((
+            data[key_start:key_start + length].decode("utf-8"),
+            _VALUE.unpack_from(data, value_start)[0]
+        ))
+        offset = value_start + _VALUE.size
+
+    return values
+
+
+class _ValuesFile(object):
+    """
+    The memory-mapped file holding the values of the metrics of a single
+    process.
+    """
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        size = os.fstat(self._fd).st_size
+        self._offsets = {}
+        if size >= _HEADER.size and \
+                os.pread(self._fd, len(_MAGIC), 0) == _MAGIC:
+            # A process with the same PID used the file before
+            self._used = _HEADER.unpack(os.pread(self._fd, _HEADER.size, 0))[1]
+        else:
+            size = _INITIAL_SIZE
+            os.ftruncate(self._fd, size)
+            self._used = _HEADER.size
+            os.pwrite(self._fd, _HEADER.pack(_MAGIC, self._used), 0)
+
+        self._map = mmap.mmap(self._fd, size)
+        self._index()
+
+    def _index(self):
+        offset = _HEADER.size
+        while offset < self._used:
+            length = _KEY_LENGTH.unpack_from(self._map, offset)[0]
+            key_start = offset + _KEY_LENGTH.size
+            value_start = _padded(key_start + length)
+            key = self._map[key_start:key_start + length].decode("utf-8")
+            self._offsets[key] = value_start
+            offset = value_start + _VALUE.size
+
+    def _append(self, key):
+        encoded = key.encode("utf-8")
+        value_start = _padded(self._used + _KEY_LENGTH.size + len(encoded))
+        end = value_start + _VALUE.size
+
+        if end > len(self._map):
+            size = len(self._map)
+            while size < end:
+                size *= 2
+            self._map.close()
+            os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+
+        _KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        start = self._used + _KEY_LENGTH.size
+        self._map[start:start + len(encoded)] = encoded
+        _VALUE.pack_into(self._map, value_start, 0.0)
+
+        self._used = end
+        _HEADER.pack_into(self._map, 0, _MAGIC, self._used)
+        self._offsets[key] = value_start
+        return value_start
+
+    def add(self, key, amount):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._append(key)
+        value = _VALUE.unpack_from(self._map, offset)[0]
+        _VALUE.pack_into(self._map, offset, value + amount)
+
+
+class Registry(object):
+    def __init__(self, path):
+        """
+        :param path: the directory holding the metrics files of all the
+                     TorPaste processes
+        """
+        os.makedirs(path, exist_ok=True)
+
+        self._path = path
+        self._metrics = OrderedDict()
+        self._lock = Lock()
+        self._file = None
+        self._pid = None
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def add(self, name, suffix, labels, amount):
+        key = json.dumps([name, suffix, labels])
+
+        with self._lock:
+            # Processes forked after the registry was created, such as the
+            # workers of a preloading Gunicorn, each get a file of their own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._file = _ValuesFile(os.path.join(
+                    self._path, "metrics-%d.db" % self._pid))
+            self._file.add(key, amount)
+
+    def collect(self):
+        """
+        Adds up the values of the metrics files of all the processes.
+        :return: a dictionary of the values of every metric name, sample
+                 suffix and labels
+        """
+        values = {}
+
+        for name in os.listdir(self._path):
+            if not name.startswith("metrics-") or not name.endswith(".db"):
+                continue
+            try:
+                file_values = _read_values(os.path.join(self._path, name))
+            except OSError:
+                continue
+
+            for key, value in file_values:
+                metric, suffix, labels = json.loads(key)
+                key = (metric, suffix, tuple(map(tuple, labels)))
+                values[key] = values.get(key, 0.0) + value
+
+        return values
+
+    def render(self):
+        """
+        Returns the metrics of all the processes in the text format of
+        Prometheus.
+        """
+        samples = {}
+        for (name, suffix, labels), value in self.collect().items():
+            samples.setdefault(name, []).append((suffix, labels, value))
+
+        lines = []
+        for metric in self._metrics.values():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            lines.extend(metric.render(samples.get(metric.name, [])))
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    escaped = [
+        (k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for k, v in labels
+    ]
+    return "{" + ",".join('%s="%s"' % label for label in escaped) + "}"
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, registry, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self._labels = labels
+        self._registry = registry
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        labels = [list(label) for label in zip(self._labels, label_values)]
+        self._registry.add(self.name, "", labels, amount)
+
+    def render(self, samples):
+        for _, labels, value in sorted(samples):
+            yield "%s%s %s" % (
+                self.name, _format_labels(labels), _format_value(value))
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labels=(),
+                 buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self._labels = labels
+        self._buckets = buckets
+        self._registry = registry
+        registry.register(self)
+
+    def observe(self, value, *label_values):
+        labels = [list(label) for label in zip(self._labels, label_values)]
+
+        # Buckets are stored on their own, and only made cumulative when
+        # they are rendered
+        for bound in self._buckets:
+            if value <= bound:
+                self._registry.add(
+                    self.name, "_bucket", labels + [["le", repr(bound)]], 1)
+                break
+
+        self._registry.add(self.name, "_sum", labels, value)
+        self._registry.add(self.name, "_count", labels, 1)
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self, samples):
+        series = {}
+        for suffix, labels, value in samples:
+            if suffix == "_bucket":
+                labels, le = labels[:-1], float(labels[-1][1])
+                series.setdefault(labels, {}).setdefault(
+                    "buckets", {})[le] = value
+            else:
+                series.setdefault(labels, {})[suffix] = value
+
+        for labels in sorted(series):
+            values = series[labels]
+            buckets = values.get("buckets", {})
+            count = values.get("_count", 0.0)
+
+            cumulative = 0.0
+            for bound in self._buckets:
+                cumulative += buckets.get(float(bound), 0.0)
+                yield "%s_bucket%s %s" % (
+                    self.name,
+                    _format_labels(labels + (("le", repr(bound)),)),
+                    _format_value(cumulative))
+            yield "%s_bucket%s %s" % (
+                self.name, _format_labels(labels + (("le", "+Inf"),)),
+                _format_value(count))
+            yield "%s_sum%s %s" % (
+                self.name, _format_labels(labels),
+                repr(values.get("_sum", 0.0)))
+            yield "%s_count%s %s" % (
+                self.name, _format_labels(labels), _format_value(count))
+
+
+class Metrics(object):
+    """
+    The metrics TorPaste keeps, in a registry backed by the given directory.
+    """
+
+    def __init__(self, path):
+        self.registry = Registry(path)
+
+        self.requests = Counter(
+            self.registry, "torpaste_requests_total",
+            "Requests handled, by route, method and status code.",
+            ("route", "method", "status"))
+        self.request_duration = Histogram(
+            self.registry, "torpaste_request_duration_seconds",
+            "Time spent handling requests, by route and method.",
+            ("route", "method"))
+        self.backend_duration = Histogram(
+            self.registry, "torpaste_backend_operation_duration_seconds",
+            "Time spent in backend operations, including the caches, by "
+            "operation.",
+            ("operation",))
+        self.backend_errors = Counter(
+            self.registry, "torpaste_backend_errors_total",
+            "Backend operations that failed, by operation.",
+            ("operation",))
+        self.render_duration = Histogram(
+            self.registry, "torpaste_template_render_duration_seconds",
+            "Time spent rendering templates, by template.",
+            ("template",))
+        self.cache_requests = Counter(
+            self.registry, "torpaste_cache_requests_total",
+            "Lookups in the caches, by cache and result.",
+            ("cache", "result"))
+
+    def cache_lookup(self, cache):
+        """
+        Returns a callable counting the hits and misses of a cache, which is
+        called with True for every hit and False for every miss.
+        """
+        def lookup(hit):
+            self.cache_requests.inc(cache, "hit" if hit else "miss")
+        return lookup
@@ -0,0 +1,449 @@
+#!bin/python
+
+"""
+This file contains the tool that copies every paste, along with its
+metadata, from one backend to another, such as from filesystem to postgres
+when moving to a bigger deployment:
+
+    TP_BACKEND_POSTGRES_DATABASE_CONNECTION=... \\
+        python migrate.py --from filesystem --to postgres
+
+Both backends are configured with their usual TP_BACKEND_ variables, and the
+pastes are compressed with TP_COMPRESSION if it is set, like TorPaste does.
+Pastes stored compressed in the source backend are decompressed first.
+
+The pastes are listed in batches, and the pastes of every batch are read and
+written by a pool of threads, or written with a single operation if the
+destination backend provides create_pastes. The content of every paste is
+hashed as it is read and compared with its Paste ID, so that pastes that
+were damaged in the source backend are reported instead of being copied.
+Pastes that have expired are not copied either.
+
+After every batch, the position in the listing of the source backend is
+saved to a checkpoint file, so that an interrupted migration resumes where
+it stopped when it is started again. The IDs of the pastes that failed to
+be copied are saved along with it, and copied again first when the
+migration is started again, which only finishes once none is left. Copying
+a paste that was already copied is harmless, since Paste IDs are the hash
+of the content.
+
+The Bloom filter of the TorPaste processes of the node, at
+TP_BLOOM_FILTER_PATH, is invalidated after every batch, so that they find the
+copied pastes. On other nodes they are found once their filter is rebuilt.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from tempfile import SpooledTemporaryFile
+
+import logic
+from backends import bloom_filter
+from backends.compression import CompressionLayer
+from backends.utils import STREAM_CHUNK_SIZE
+
+BACKENDS = ["filesystem", "sqlite", "postgres", "aws_s3", "azure_storage"]
+
+# The metadata key the compression layer keeps the codec of a paste in,
+# which depends on how the destination backend stores the paste
+_CODEC_KEY = "codec"
+
+# Pastes are kept in memory up to this size while they are copied, and in a
+# temporary file after that. Larger pastes are also never written in
+# batches, so that a batch never holds much more than this per paste.
+_SPOOL_SIZE = 256 * 1024
+
+
+class _Paste(object):
+    def __init__(self, paste_id, content, size, digest, metadata):
+        self.paste_id = paste_id
+        self.content = content
+        self.size = size
+        self.digest = digest
+        self.metadata = metadata
+
+
+def open_backend(name):
+    backend = importlib.import_module("backends." + name)
+    backend.initialize_backend()
+    return backend
+
+
+def decompressing(backend):
+    """
+    Returns the backend wrapped so that the pastes stored compressed are
+    decompressed when they are read.
+    """
+    try:
+        # The codec is only used to write pastes
+        return CompressionLayer(backend, "gzip")
+    except ValueError:
+        # The backend cannot store compressed pastes at all
+        return backend
+
+
+def list_batches(backend, size, cursor=None):
+    """
+    Lists the IDs of all the pastes of a backend, whatever their visibility,
+    in batches.
+    :param cursor: the cursor of the batch to start from, or None
+    :return: an iterator of (list of Paste IDs, cursor of the next batch or
+             None) tuples
+    """
+    if hasattr(backend, "get_paste_ids_page"):
+        while True:
+            paste_ids, cursor = backend.get_paste_ids_page(
+                {}, {}, size, cursor)
+            yield paste_ids, cursor
+            if cursor is None:
+                return
+
+    # Without pages, the whole listing is loaded and the cursor is the last
+    # Paste ID of the batch
+    paste_ids = sorted(
+        paste_id for paste_id in backend.get_all_paste_ids({}, {})
+        if paste_id != "none")
+    if cursor is not None:
+        paste_ids = paste_ids[bisect_right(paste_ids, cursor):]
+
+    for start in range(0, len(paste_ids), size):
+        batch = paste_ids[start:start + size]
+        if start + size < len(paste_ids):
+            yield batch, batch[-1]
+        else:
+            yield batch, None
+
+    if not paste_ids:
+        yield [], None
+
+
+def read_paste(backend, paste_id):
+    """
+    Reads a paste from a backend, and hashes its content while it is read.
+    :return: a _Paste, or None if the paste no longer exists
+    """
+    if hasattr(backend, "open_paste_stream"):
+        stream = backend.open_paste_stream(paste_id)
+        if stream is None:
+            return None
+        try:
+            metadata = backend.get_paste_metadata(paste_id)
+        except backend.e.WarningException:
+            metadata = {}
+        except BaseException:
+            _close(stream)
+            raise
+    elif hasattr(backend, "get_paste"):
+        paste = backend.get_paste(paste_id)
+        if paste is None:
+            return None
+        stream = [paste[0].encode("utf-8")]
+        metadata = paste[1]
+    else:
+        if not backend.does_paste_exist(paste_id):
+            return None
+        stream = [backend.get_paste_contents(paste_id).encode("utf-8")]
+        try:
+            metadata = backend.get_paste_metadata(paste_id)
+        except backend.e.WarningException:
+            metadata = {}
+
+    content = SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+    digest = sha256()
+    size = 0
+    try:
+        if hasattr(stream, "read"):
+            chunks = iter(lambda: stream.read(STREAM_CHUNK_SIZE), b"")
+        else:
+            chunks = stream
+        for chunk in chunks:
+            digest.update(chunk)
+            content.write(chunk)
+            size += len(chunk)
+    except BaseException:
+        content.close()
+        raise
+    finally:
+        _close(stream)
+
+    metadata = {k: v for k, v in metadata.items() if k != _CODEC_KEY}
+    return _Paste(paste_id, content, size, digest.hexdigest(), metadata)
+
+
+def _close(stream):
+    if hasattr(stream, "close"):
+        stream.close()
+
+
+class Migration(object):
+    def __init__(self, source, destination, workers):
+        self._source = source
+        self._destination = destination
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+        self.copied = 0
+        self.missing = 0
+        self.expired = 0
+        self.corrupted = 0
+        self.failed = 0
+        self.bytes = 0
+
+        # The IDs of the pastes that failed to be copied, to try again
+        self.failed_ids = []
+
+    def _copy(self, paste_id):
+        """
+        Copies a paste, unless it can be written along with the others of
+        its batch.
+        :return: a (result, _Paste or None) tuple, where result is one of
+                 "copied", "batch", "missing", "expired", "corrupted" and
+                 "failed"
+        """
+        try:
+            paste = read_paste(self._source, paste_id)
+        except Exception as ex:
+            print("Failed to read %s: %s" % (paste_id, ex), file=sys.stderr)
+            return "failed", None
+
+        if paste is None:
+            return "missing", None
+        if paste.digest != paste_id:
+            paste.content.close()
+            print("Content of %s does not match its Paste ID" % paste_id,
+                  file=sys.stderr)
+            return "corrupted", None
+        if logic.has_expired(paste.metadata.get("expires"), time.time()):
+            paste.content.close()
+            return "expired", None
+
+        if hasattr(self._destination, "create_pastes") and \
+                paste.size <= _SPOOL_SIZE:
+            return "batch", paste
+
+        try:
+            if not logic.write_new_paste(
+                    self._destination, paste_id, paste.content,
+                    paste.metadata):
+                self._destination.update_paste_metadata(
+                    paste_id, paste.metadata)
+        except Exception as ex:
+            print("Failed to write %s: %s" % (paste_id, ex), file=sys.stderr)
+            return "failed", None
+        finally:
+            paste.content.close()
+
+        return "copied", paste
+
+    def _create_batch(self, pastes):
+        if not pastes:
+            return "copied"
+
+        try:
+            batch = []
+            for paste in pastes:
+                paste.content.seek(0)
+                batch.append((
+                    paste.paste_id,
+                    paste.content.read().decode("utf-8"),
+                    paste.metadata))
+            self._destination.create_pastes(batch)
+        except Exception as ex:
+            print("Failed to write a batch of %d pastes: %s" % (
+                len(pastes), ex), file=sys.stderr)
+            return "failed"
+        finally:
+            for paste in pastes:
+                paste.content.close()
+
+        return "copied"
+
+    def copy_batch(self, paste_ids):
+        batch = []
+        results = self._pool.map(self._copy, paste_ids)
+        for paste_id, (result, paste) in zip(paste_ids, results):
+            if result == "batch":
+                batch.append(paste)
+                continue
+            setattr(self, result, getattr(self, result) + 1)
+            if result == "copied":
+                self.bytes += paste.size
+            elif result == "failed":
+                self.failed_ids.append(paste_id)
+
+        result = self._create_batch(batch)
+        setattr(self, result, getattr(self, result) + len(batch))
+        if result == "copied":
+            self.bytes += sum(paste.size for paste in batch)
+        else:
+            self.failed_ids.extend(paste.paste_id for paste in batch)
+
+    def retry_batch(self, paste_ids):
+        """
+        Copies again pastes that failed to be copied before, which are no
+        longer counted as failed unless they fail again.
+        """
+        self.failed -= len(paste_ids)
+        self.copy_batch(paste_ids)
+
+    def counts(self):
+        return {
+            "copied": self.copied,
+            "missing": self.missing,
+            "expired": self.expired,
+            "corrupted": self.corrupted,
+            "failed": self.failed,
+            "bytes": self.bytes,
+        }
+
+    def restore(self, counts):
+        for key, value in counts.items():
+            setattr(self, key, value)
+
+
+def load_checkpoint(path, source, destination):
+    try:
+        with open(path, "r") as fd:
+            checkpoint = json.load(fd)
+    except FileNotFoundError:
+        return None
+
+    if (checkpoint["from"], checkpoint["to"]) != (source, destination):
+        print("The checkpoint %s is of a migration from %s to %s" % (
+            path, checkpoint["from"], checkpoint["to"]), file=sys.stderr)
+        exit(1)
+
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fd:
+        json.dump(checkpoint, fd)
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy every paste from one backend to another")
+    parser.add_argument(
+        "--from", dest="source", required=True, choices=BACKENDS,
+        help="the backend to copy the pastes from")
+    parser.add_argument(
+        "--to", dest="destination", required=True, choices=BACKENDS,
+        help="the backend to copy the pastes to")
+    parser.add_argument(
+        "--workers", type=int, default=16,
+        help="the number of pastes copied at the same time (default: 16)")
+    parser.add_argument(
+        "--batch-size", type=int, default=500,
+        help="the number of pastes listed, written and checkpointed at once "
+             "(default: 500)")
+    parser.add_argument(
+        "--checkpoint", default="migrate-checkpoint.json",
+        help="the file the progress is saved to, and resumed from "
+             "(default: migrate-checkpoint.json)")
+    parser.add_argument(
+        "--restart", action="store_true",
+        help="start over, even if the checkpoint file exists")
+    args = parser.parse_args()
+
+    if args.source == args.destination:
+        print("Both backends are configured by the same variables, so the "
+              "pastes cannot be copied between two %s backends" %
+              args.source, file=sys.stderr)
+        exit(1)
+    if args.workers < 1 or args.batch_size < 1:
+        print("Invalid --workers or --batch-size", file=sys.stderr)
+        exit(1)
+
+    checkpoint = None
+    if not args.restart:
+        checkpoint = load_checkpoint(
+            args.checkpoint, args.source, args.destination)
+    if checkpoint is not None and checkpoint["finished"]:
+        print("This migration has already finished, use --restart to run it "
+              "again", file=sys.stderr)
+        return
+
+    try:
+        source = decompressing(open_backend(args.source))
+        destination = open_backend(args.destination)
+    except Exception as ex:
+        print("Failed to initialize the backends: %s" % ex, file=sys.stderr)
+        exit(1)
+
+    compression = os.getenv("TP_COMPRESSION") or ""
+    if compression:
+        try:
+            destination = CompressionLayer(destination, compression)
+        except ValueError as ex:
+            print("Invalid TP_COMPRESSION: " + str(ex), file=sys.stderr)
+            exit(1)
+
+    migration = Migration(source, destination, args.workers)
+    cursor = None
+    listed = False
+    retries = []
+    if checkpoint is not None:
+        migration.restore(checkpoint["counts"])
+        cursor = checkpoint["cursor"]
+        listed = checkpoint["listed"]
+        retries = checkpoint["failed_ids"]
+        print("Resuming after %d pastes, retrying %d" % (
+            migration.copied, len(retries)), file=sys.stderr)
+
+    start = time.time()
+    copied = migration.copied
+
+    def save(pending):
+        failed_ids = pending + migration.failed_ids
+        save_checkpoint(args.checkpoint, {
+            "from": args.source,
+            "to": args.destination,
+            "cursor": cursor,
+            # The listing has been gone through, but it is only finished
+            # once every paste that failed has been copied
+            "listed": listed,
+            "failed_ids": failed_ids,
+            "finished": listed and not failed_ids,
+            "counts": migration.counts(),
+        })
+        bloom_filter.invalidate(
+            os.getenv("TP_BLOOM_FILTER_PATH") or bloom_filter.DEFAULT_PATH)
+
+        elapsed = time.time() - start
+        print("%d pastes copied, %d failed (%.0f pastes/s)" % (
+            migration.copied, migration.failed + migration.corrupted,
+            (migration.copied - copied) / elapsed if elapsed else 0),
+            file=sys.stderr)
+
+    while retries:
+        batch = retries[:args.batch_size]
+        retries = retries[args.batch_size:]
+        migration.retry_batch(batch)
+        save(retries)
+
+    if not listed:
+        for paste_ids, cursor in list_batches(
+                source, args.batch_size, cursor):
+            migration.copy_batch(paste_ids)
+            listed = cursor is None
+            save([])
+
+    print(json.dumps(migration.counts()))
+
+    if migration.failed_ids:
+        print("%d pastes failed to be copied, run this again to retry them" %
+              len(migration.failed_ids), file=sys.stderr)
+    if migration.failed or migration.corrupted:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
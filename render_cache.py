@@ -0,0 +1,114 @@
+"""
+This file contains a cache of fully rendered pages, so that popular pastes
+can be viewed without rendering their page again. Since the Paste ID is the
+SHA-256 of the content, the page of a paste only changes with a new version
+of TorPaste, which is part of the cache key.
+
+Every page can also be kept compressed with the content encodings HTTP
+clients accept, which are computed the first time a client asks for them.
+The cache is bounded by the total size of the cached pages, including their
+compressed copies, and evicts the least recently used ones first.
+"""
+
+import gzip
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_ENCODERS = {
+    "gzip": lambda body: gzip.compress(body, 6),
+}
+if brotli is not None:
+    _ENCODERS["br"] = lambda body: brotli.compress(body, quality=5)
+
+# The content encodings pages can be sent with, most preferred first
+ENCODINGS = [e for e in ("br", "gzip") if e in _ENCODERS]
+
+
+class RenderedPage(object):
+    def __init__(self, body, last_modified, expires=None):
+        self.last_modified = last_modified
+        self.expires = expires
+        self.bodies = {None: body}
+
+    def size(self):
+        return sum(len(body) for body in self.bodies.values())
+
+
+class RenderCache(object):
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._pages = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                page = self._pages[key]
+            except KeyError:
+                return None
+            self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, body, last_modified, expires=None):
+        """
+        Caches the rendered page of a paste.
+        :param key: the key of the page
+        :param body: the rendered page, in bytes
+        :param last_modified: the date of the paste, or None
+        :param expires: the time the paste expires at, or None
+        :return: the cached page
+        """
+        page = RenderedPage(body, last_modified, expires)
+        if page.size() > self._max_bytes:
+            return page
+
+        with self._lock:
+            self._discard(key)
+            self._pages[key] = page
+            self._size += page.size()
+            self._evict()
+
+        return page
+
+    def encoded(self, key, page, encoding):
+        """
+        Returns the body of a page with the given content encoding, and
+        keeps it for the next clients that ask for it.
+        """
+        try:
+            return page.bodies[encoding]
+        except KeyError:
+            pass
+
+        body = _ENCODERS[encoding](page.bodies[None])
+
+        with self._lock:
+            if encoding not in page.bodies and \
+                    self._pages.get(key) is page:
+                page.bodies[encoding] = body
+                self._size += len(body)
+                self._evict()
+
+        return body
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        try:
+            page = self._pages.pop(key)
+        except KeyError:
+            return
+        self._size -= page.size()
+
+    def _evict(self):
+        while self._size > self._max_bytes:
+            _, page = self._pages.popitem(last=False)
+            self._size -= page.size()
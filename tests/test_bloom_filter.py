@@ -0,0 +1,77 @@
+"""
+Tests of the Bloom filter of the IDs of all the pastes, over the filesystem
+backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+
+import backends.filesystem
+from backends import bloom_filter
+from backends.bloom_filter import BloomFilterLayer
+
+# Paste IDs are SHA-256 hashes, which the filesystem backend stores by prefix
+A = "aa" * 32
+B = "bb" * 32
+MISSING = "cc" * 32
+
+METADATA = {"date": "1", "visibility": "public"}
+
+
+class BloomFilterTest(unittest.TestCase):
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._directory = tempfile.TemporaryDirectory()
+        os.chdir(self._directory.name)
+
+        self.path = os.path.join(self._directory.name, "bloom")
+        self.b = BloomFilterLayer(backends.filesystem, self.path, 1000, 3600)
+        self.b.initialize_backend()
+
+        # The rebuilds are started by the tests themselves
+        self.b._rebuilder_pid = os.getpid()
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._directory.cleanup()
+
+    def test_pastes_created_through_it_are_found(self):
+        self.b.create_paste(A, "content", METADATA)
+
+        self.assertEqual(self.b.get_paste(A), ("content", METADATA))
+        self.assertIsNone(self.b.get_paste(MISSING))
+
+    def test_pastes_stored_elsewhere_are_found_once_invalidated(self):
+        backends.filesystem.create_paste(A, "content", METADATA)
+        self.assertIsNone(self.b.get_paste(A))
+
+        bloom_filter.invalidate(self.path)
+        self.assertEqual(self.b.get_paste(A), ("content", METADATA))
+
+        # Rebuilt even though the last rebuild is recent
+        self.b.rebuild()
+        self.assertTrue(self.b.might_exist(A))
+        self.assertFalse(self.b.might_exist(MISSING))
+
+    def test_invalidation_during_rebuild_keeps_it_invalid(self):
+        listing = self.b._list_paste_ids
+
+        def invalidating_listing():
+            for paste_id in listing():
+                yield paste_id
+            backends.filesystem.create_paste(B, "content", METADATA)
+            bloom_filter.invalidate(self.path)
+
+        self.b._list_paste_ids = invalidating_listing
+        self.b.rebuild(force=True)
+
+        self.assertEqual(self.b.get_paste(B), ("content", METADATA))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Tests of the layer that compresses the content of pastes, over the
+filesystem backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+
+import backends.filesystem
+from backends.compression import CompressionLayer
+
+# Paste IDs are SHA-256 hashes, which the filesystem backend stores by prefix
+A = "aa" * 32
+B = "bb" * 32
+
+# Large enough to be stored compressed
+CONTENT = "zebra " * 100
+
+METADATA = {"date": "1", "visibility": "public"}
+
+
+class CompressionLayerTest(unittest.TestCase):
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._directory = tempfile.TemporaryDirectory()
+        os.chdir(self._directory.name)
+
+        backends.filesystem.initialize_backend()
+        self.b = CompressionLayer(backends.filesystem, "gzip")
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._directory.cleanup()
+
+    def test_metadata_update_keeps_the_codec_without_reading_the_paste(self):
+        self.b.create_paste(A, CONTENT, METADATA)
+
+        opened = []
+        self.b._open = lambda paste_id: opened.append(paste_id)
+        self.b.update_paste_metadata(A, {"date": "2", "codec": "zstd"})
+
+        self.assertEqual(opened, [])
+        self.assertEqual(
+            backends.filesystem.get_paste_metadata(A),
+            {"date": "2", "codec": "gzip"})
+
+    def test_new_paste_records_the_codec(self):
+        self.b.new_paste(A, CONTENT)
+        self.b.new_paste(B, "small")
+
+        self.assertEqual(
+            backends.filesystem.get_paste_metadata(A), {"codec": "gzip"})
+        self.assertIsNone(
+            backends.filesystem.get_paste_metadata_value(B, "codec"))
+        self.assertEqual(self.b.get_paste_contents(A), CONTENT)
+
+    def test_missing_paste_contents_raise_the_backend_error(self):
+        with self.assertRaises(backends.filesystem.e.ErrorException):
+            self.b.get_paste_contents(A)
+
+
+if __name__ == "__main__":
+    unittest.main()
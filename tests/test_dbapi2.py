@@ -0,0 +1,101 @@
+"""
+Tests of the parts of the database backends that DbApi2 provides, through
+the sqlite backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import backends.sqlite
+from backends.dbapi2 import ConnectionPool
+from backends.utils import STREAM_CHUNK_SIZE
+
+# Paste IDs are SHA-256 hashes
+A = "aa" * 32
+B = "bb" * 32
+
+METADATA = {"date": "1", "visibility": "public"}
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+
+        def connect():
+            connection = sqlite3.connect(":memory:")
+            self.opened.append(connection)
+            return connection
+
+        self.pool = ConnectionPool(connect, 1, 2)
+
+    def test_idle_connection_is_reused(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_connection_closed_while_idle_is_replaced(self):
+        # As if the server had closed it, however recently it was used
+        self.opened[0].close()
+
+        with self.pool.connection() as connection:
+            connection.execute("SELECT 1")
+
+        self.assertIsNot(connection, self.opened[0])
+        self.assertEqual(len(self.opened), 2)
+
+
+class PasteStreamTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        os.environ["TP_BACKEND_SQLITE_DATABASE_PATH"] = os.path.join(
+            self._directory.name, "db.sqlite")
+        backends.sqlite.initialize_backend()
+
+        self.content = "x" * STREAM_CHUNK_SIZE + "y" * STREAM_CHUNK_SIZE
+        backends.sqlite.create_paste(A, self.content, METADATA)
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_paste_is_streamed_in_parts(self):
+        stream = backends.sqlite.open_paste_stream(A)
+
+        self.assertEqual(
+            list(stream), [b"x" * STREAM_CHUNK_SIZE, b"y" * STREAM_CHUNK_SIZE])
+        self.assertIsNone(backends.sqlite.open_paste_stream(B))
+
+    def test_paste_replaced_while_streamed_is_read_whole(self):
+        stream = backends.sqlite.open_paste_stream(A)
+        first = next(stream)
+
+        # Writers are not kept waiting by the stream either
+        backends.sqlite.delete_paste(A)
+        backends.sqlite.create_paste(A, "short", METADATA)
+        backends.sqlite.create_paste(B, "other", METADATA)
+
+        content = first + b"".join(stream)
+        self.assertEqual(content.decode("utf-8"), self.content)
+        self.assertEqual(
+            b"".join(backends.sqlite.open_paste_stream(A)), b"short")
+
+    def test_stream_closed_early_releases_its_connection(self):
+        stream = backends.sqlite.open_paste_stream(A)
+        next(stream)
+        stream.close()
+
+        backends.sqlite.create_paste(B, "other", METADATA)
+        self.assertTrue(backends.sqlite.does_paste_exist(B))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+Tests of the full-text search of the public pastes, through the index of the
+sqlite backend and through the index SearchIndexLayer keeps for the backends
+that cannot search pastes themselves.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import backends.filesystem
+import backends.sqlite
+from backends.search_index import SearchIndexLayer
+
+PUBLIC = {"visibility": "public"}
+
+# Paste IDs are SHA-256 hashes, which the filesystem backend stores by prefix
+A = "aa" * 32
+B = "bb" * 32
+
+
+def _metadata(visibility, date):
+    return {"date": str(date), "visibility": visibility}
+
+
+class SearchVisibilityTests(object):
+    """
+    The tests every searchable backend must pass, which are run against the
+    backend the test case sets up as self.b.
+    """
+
+    def search(self, query="zebra"):
+        paste_ids, _ = self.b.search_paste_ids(query, PUBLIC, PUBLIC, 10)
+        return sorted(paste_ids)
+
+    def test_unlisted_pastes_never_match(self):
+        self.b.create_paste(A, "zebra public", _metadata("public", 1))
+        self.b.create_paste(B, "zebra unlisted", _metadata("unlisted", 2))
+
+        self.assertEqual(self.search(), [A])
+        self.assertEqual(self.search("unlisted"), [])
+
+    def test_paste_made_unlisted_stops_matching(self):
+        self.b.create_paste(A, "zebra", _metadata("public", 1))
+        self.b.update_paste_metadata(A, _metadata("unlisted", 1))
+
+        self.assertEqual(self.search(), [])
+
+    def test_paste_made_public_starts_matching(self):
+        self.b.create_paste(A, "zebra", _metadata("unlisted", 1))
+        self.b.update_paste_metadata(A, _metadata("public", 1))
+
+        self.assertEqual(self.search(), [A])
+
+    def test_deleted_paste_stops_matching(self):
+        self.b.create_paste(A, "zebra", _metadata("public", 1))
+        self.b.delete_paste(A)
+
+        self.assertEqual(self.search(), [])
+
+    def test_unlisted_batch_pastes_never_match(self):
+        if not hasattr(self.b, "create_pastes"):
+            self.skipTest("the backend does not store pastes in batches")
+
+        self.b.create_pastes([
+            (A, "zebra one", _metadata("public", 1)),
+            (B, "zebra two", _metadata("unlisted", 2)),
+        ])
+
+        self.assertEqual(self.search(), [A])
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._directory = tempfile.TemporaryDirectory()
+        os.chdir(self._directory.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._directory.cleanup()
+
+
+class SQLiteSearchTest(SearchVisibilityTests, TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(SQLiteSearchTest, self).setUp()
+        os.environ["TP_BACKEND_SQLITE_DATABASE_PATH"] = "db.sqlite"
+        self.b = backends.sqlite
+        self.b.initialize_backend()
+        self.b.initialize_search()
+
+    def test_search_is_not_set_up_until_enabled(self):
+        os.environ["TP_BACKEND_SQLITE_DATABASE_PATH"] = "other.sqlite"
+        backends.sqlite.initialize_backend()
+
+        tables = sqlite3.connect("other.sqlite").execute("""
+            SELECT name FROM sqlite_master WHERE name LIKE 'pastes_search%'
+        """).fetchall()
+        self.assertEqual(tables, [])
+
+    def test_existing_public_pastes_are_indexed(self):
+        os.environ["TP_BACKEND_SQLITE_DATABASE_PATH"] = "other.sqlite"
+        backends.sqlite.initialize_backend()
+        backends.sqlite.create_paste(A, "zebra", _metadata("public", 1))
+        backends.sqlite.create_paste(B, "zebra", _metadata("unlisted", 2))
+        backends.sqlite.initialize_search()
+
+        self.assertEqual(self.search(), [A])
+
+
+class SearchIndexLayerTest(SearchVisibilityTests, TemporaryDirectoryTestCase):
+    def setUp(self):
+        super(SearchIndexLayerTest, self).setUp()
+        self.b = SearchIndexLayer(
+            backends.filesystem, "search-index.sqlite", 3600)
+        self.b.initialize_backend()
+
+        # The refreshes are started by the tests themselves
+        self.b._refresher_pid = os.getpid()
+
+    def test_paste_made_unlisted_elsewhere_is_dropped_by_refresh(self):
+        self.b.create_paste(A, "zebra", _metadata("public", 1))
+        backends.filesystem.update_paste_metadata(
+            A, _metadata("unlisted", 1))
+        self.b.refresh(force=True)
+
+        self.assertEqual(self.search(), [])
+
+    def test_paste_made_public_elsewhere_is_added_by_refresh(self):
+        self.b.create_paste(A, "zebra", _metadata("unlisted", 1))
+        backends.filesystem.update_paste_metadata(
+            A, _metadata("public", 1))
+        self.b.refresh(force=True)
+
+        self.assertEqual(self.search(), [A])
+
+    def test_unlisted_pastes_are_not_stored_in_the_index(self):
+        self.b.create_paste(B, "zebra", _metadata("unlisted", 1))
+        self.b.refresh(force=True)
+
+        rows = sqlite3.connect("search-index.sqlite").execute(
+            "SELECT id FROM pastes").fetchall()
+        self.assertEqual(rows, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
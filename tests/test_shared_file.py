@@ -0,0 +1,60 @@
+"""
+Tests of the files that SharedCache and BloomFilterLayer share between the
+TorPaste processes of a node.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import mmap
+import os
+import tempfile
+import unittest
+
+from backends.utils import open_shared_file
+
+
+class OpenSharedFileTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, "shared")
+        self._fds = []
+
+    def tearDown(self):
+        for fd in self._fds:
+            os.close(fd)
+        self._directory.cleanup()
+
+    def open(self, header, size):
+        fd = open_shared_file(self.path, header, size)
+        self._fds.append(fd)
+        return fd
+
+    def test_file_is_created_with_header_and_size(self):
+        fd = self.open(b"layout", 4096)
+
+        self.assertEqual(os.fstat(fd).st_size, 4096)
+        self.assertEqual(os.pread(fd, 6, 0), b"layout")
+
+    def test_same_layout_shares_the_file(self):
+        first = self.open(b"layout", 4096)
+        os.pwrite(first, b"data", 100)
+        second = self.open(b"layout", 4096)
+
+        self.assertEqual(os.pread(second, 4, 100), b"data")
+
+    def test_new_layout_leaves_mapped_file_intact(self):
+        old = mmap.mmap(self.open(b"old", 8192), 0)
+        old[5000:5004] = b"data"
+        self.open(b"new", 4096)
+
+        # Reading past the size of the new layout would raise SIGBUS if the
+        # old file had been truncated
+        self.assertEqual(old[5000:5004], b"data")
+        self.assertEqual(len(os.listdir(self._directory.name)), 1)
+        old.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
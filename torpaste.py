@@ -1,24 +1,47 @@
 #!bin/python
 # -*- coding: utf-8 -*-
 
+import fcntl
 import importlib
+import os
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
+from hashlib import sha256
 from os import getenv
 import sys
 import logic
 from subprocess import check_output
 
+from backends.bloom_filter import DEFAULT_PATH as BLOOM_FILTER_DEFAULT_PATH
+from backends.bloom_filter import BloomFilterLayer
+from backends.compression import CompressionLayer
+from backends.instrumentation import InstrumentationLayer
+from backends.memory_cache import MemoryCache
+from backends.search_index import SearchIndexLayer
+from backends.shared_cache import SharedCache
+from metrics import Metrics
+from render_cache import ENCODINGS as RENDER_ENCODINGS
+from render_cache import RenderCache
+from render_cache import RenderedPage
+
 from flask import Flask
 from flask import Response
+from flask import before_render_template
+from flask import g
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import template_rendered
+from flask import url_for
+from werkzeug.wsgi import wrap_file
 
 app = Flask(__name__)
 
 # Calculate Software Version
 VERSION = check_output(["git", "describe"]).decode("utf-8").replace("\n", "")
+VERSION_TAG = sha256(VERSION.encode("utf-8")).hexdigest()[:16]
 
 # Compatible Backends List
 COMPATIBLE_BACKENDS = [
@@ -34,6 +57,17 @@ COMPATIBLE_BACKENDS = [
 # unlisted: can be viewed by all, is not listed in /list ("hidden")
 AVAILABLE_VISIBILITIES = ["public", "unlisted"]
 
+# Available list of paste expiries, with the number of seconds after which
+# pastes with each of them are deleted
+# never: the paste is kept forever
+AVAILABLE_EXPIRIES = OrderedDict([
+    ("never", None),
+    ("hour", 3600),
+    ("day", 24 * 3600),
+    ("week", 7 * 24 * 3600),
+    ("month", 30 * 24 * 3600),
+])
+
 
 @app.route('/')
 def index():
@@ -55,100 +89,256 @@ def new_paste():
             page="new"
         )
     else:
-        if (request.form['content']):
+        # Forms sent by the browser are read as they are uploaded, and any
+        # other kind of form is left to Flask
+        if (request.mimetype == "application/x-www-form-urlencoded"):
+            status, message = logic.create_new_paste_from_stream(
+                request.stream,
+                request.content_length,
+                config
+            )
+        elif (request.form['content']):
             status, message = logic.create_new_paste(
                 request.form['content'],
                 request.form,
                 config
             )
-            if (status == "ERROR"):
-                return Response(
-                    render_template(
-                        "index.html",
-                        config=config,
-                        version=VERSION,
-                        page="new",
-                        error=message
-                    ),
-                    400
-                )
-
-            if (status == "OK"):
-                return redirect("/view/" + message)
         else:
+            status, message = "ERROR", "Please enter some text to " +\
+                "include in the paste."
+
+        if (status == "ERROR"):
             return Response(
                 render_template(
                     "index.html",
                     config=config,
                     version=VERSION,
-                    error="Please enter some text to include in the paste.",
-                    page="new"
+                    page="new",
+                    error=message
                 ),
                 400
             )
 
+        # Submitting an existing paste again may change its metadata
+        if config['RENDER_CACHE'] is not None:
+            config['RENDER_CACHE'].invalidate((VERSION_TAG, message))
+
+        return redirect("/view/" + message)
+
+
+# The content of a paste never changes for a given Paste ID, so the raw
+# paste can be cached for as long as clients and proxies want to
+RAW_PASTE_MAX_AGE = 365 * 24 * 3600
+
+# The paste page also depends on the TorPaste version, and is revalidated
+# more often
+VIEW_PASTE_MAX_AGE = 24 * 3600
+
+
+def paste_etag(kind, pasteid, expires=None):
+    """
+    Returns the ETag of a page showing a paste. Since the Paste ID is the
+    hash of the content, it is known before the paste is even read, unless
+    the paste expires: those must be read to be revalidated, so that they
+    are never revalidated after they have expired.
+    """
+    if kind == "view":
+        etag = "view-" + pasteid + "-" + VERSION_TAG
+    else:
+        etag = kind + "-" + pasteid
+    if expires is not None:
+        etag += "-" + str(expires)
+    return etag
+
+
+def paste_max_age(max_age, expires):
+    """
+    Returns how long a page showing a paste can be cached for, which is
+    never past the time the paste expires at.
+    """
+    if expires is None:
+        return max_age
+    return max(0, min(max_age, expires - int(time.time())))
+
+
+def not_modified(etag, cache_control, weak=False):
+    response = Response(status=304)
+    response.set_etag(etag, weak)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
 
 @app.route("/view/<pasteid>")
 def view_paste(pasteid):
-    status, data, code = logic.view_existing_paste(pasteid, config)
+    etag = paste_etag("view", pasteid)
+    cache_control = "public, max-age=%d" % VIEW_PASTE_MAX_AGE
+
+    # The ETag is weak, since the page may be sent compressed with it too
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag, cache_control, weak=True)
+
+    render_cache = config['RENDER_CACHE']
+    page = None
+    if render_cache is not None:
+        page = render_cache.get((VERSION_TAG, pasteid))
+        if page is not None and page.expires is not None and \
+                page.expires <= time.time():
+            render_cache.invalidate((VERSION_TAG, pasteid))
+            page = None
+        if config['METRICS'] is not None:
+            config['METRICS'].cache_requests.inc(
+                "render", "miss" if page is None else "hit")
+
+    if page is None:
+        status, data, code = logic.view_existing_paste(pasteid, config)
+
+        if (status == "ERROR"):
+            return Response(
+                render_template(
+                    "index.html",
+                    config=config,
+                    version=VERSION,
+                    error=data,
+                    page="new"
+                ),
+                code
+            )
 
-    if (status == "ERROR"):
-        return Response(
-            render_template(
-                "index.html",
-                config=config,
-                version=VERSION,
-                error=data,
-                page="new"
-            ),
-            code
-        )
+        paste_size = logic.format_size(len(data[0].encode('utf-8')))
 
-    if (status == "OK"):
-        paste_date = datetime.fromtimestamp(
-            int(
-                data[1]
-            ) + time.altzone + 3600).strftime("%H:%M:%S %d/%m/%Y")
+        if (status == "OK"):
+            paste_date = datetime.fromtimestamp(
+                int(
+                    data[1]
+                ) + time.altzone + 3600).strftime("%H:%M:%S %d/%m/%Y")
+            last_modified = int(data[1])
 
-        paste_size = logic.format_size(len(data[0].encode('utf-8')))
+        if (status == "WARNING"):
+            paste_date = "Not available."
+            last_modified = None
 
-    if (status == "WARNING"):
-        paste_date = "Not available."
+        paste_expires = None
+        if data[2] is not None:
+            paste_expires = datetime.fromtimestamp(
+                data[2] + time.altzone + 3600).strftime("%H:%M:%S %d/%m/%Y")
 
-    return Response(
-        render_template(
+        body = render_template(
             "view.html",
             content=data[0],
             date=paste_date,
+            expires=paste_expires,
             size=paste_size,
             pid=pasteid,
             config=config,
             version=VERSION,
             page="view"
-        ),
-        200
-    )
+        ).encode('utf-8')
+
+        if render_cache is None:
+            page = RenderedPage(body, last_modified, data[2])
+        else:
+            page = render_cache.put(
+                (VERSION_TAG, pasteid), body, last_modified, data[2])
+
+    if page.expires is not None:
+        etag = paste_etag("view", pasteid, page.expires)
+        cache_control = "public, max-age=%d" % paste_max_age(
+            VIEW_PASTE_MAX_AGE, page.expires)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag, cache_control, weak=True)
+
+    # Cached pages are also sent compressed to the clients that accept it
+    encoding = None
+    if render_cache is not None:
+        for accepted in RENDER_ENCODINGS:
+            if request.accept_encodings[accepted] > 0:
+                encoding = accepted
+                break
+
+    if encoding is None:
+        body = page.bodies[None]
+    else:
+        body = render_cache.encoded((VERSION_TAG, pasteid), page, encoding)
+
+    response = Response(body, 200, mimetype="text/html")
+
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = cache_control
+    if page.last_modified is not None:
+        response.last_modified = page.last_modified
+    if render_cache is not None:
+        response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.content_encoding = encoding
+    return response
 
 
 @app.route("/raw/<pasteid>")
 def raw_paste(pasteid):
-    status, data, code = logic.view_existing_paste(pasteid, config)
+    encodings = [
+        encoding for encoding, quality in request.accept_encodings
+        if quality > 0
+    ]
+    cache_control = "public, max-age=%d, immutable" % RAW_PASTE_MAX_AGE
+
+    # Every content encoding of a paste has its own ETag
+    for encoding in [None] + encodings:
+        etag = paste_etag("raw" if encoding is None else encoding, pasteid)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag, cache_control)
+
+    status, data, code = logic.open_raw_paste(pasteid, config, encodings)
 
     if (status == "ERROR" and code >= 500):
         return Response(data, code, mimetype="text/plain")
     if (status == "ERROR"):
         return Response("No such paste", code, mimetype="text/plain")
-    return Response(data[0], mimetype="text/plain")
+
+    stream, encoding, expires = data
+
+    if expires is not None:
+        etag = paste_etag(
+            "raw" if encoding is None else encoding, pasteid, expires)
+        cache_control = "public, max-age=%d" % paste_max_age(
+            RAW_PASTE_MAX_AGE, expires)
+        if request.if_none_match.contains(etag):
+            if hasattr(stream, "close"):
+                stream.close()
+            return not_modified(etag, cache_control)
+
+    # Files are handed to the WSGI server, which can send them with
+    # sendfile(), and anything else is sent as it is read from the backend
+    if hasattr(stream, "read"):
+        stream = wrap_file(request.environ, stream)
+    response = Response(
+        stream, mimetype="text/plain", direct_passthrough=True)
+
+    if config['COMPRESSION']:
+        response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.content_encoding = encoding
+
+    response.set_etag(
+        paste_etag("raw" if encoding is None else encoding, pasteid, expires))
+    response.headers["Cache-Control"] = cache_control
+    return response
 
 
 @app.route("/list")
 def list():
     listFilters = {"visibility": "public"}
     defaultFilters = {"visibility": "public"}
+
+    # The cursors of all the pages before the current one, so that the
+    # previous page can be linked to as well
+    cursor = request.args.get("cursor") or None
+    back = request.args.getlist("back")
+
     status, data, code = logic.get_paste_listing(
         config,
         listFilters,
-        defaultFilters
+        defaultFilters,
+        cursor
     )
 
     if (status == "ERROR"):
@@ -163,16 +353,110 @@ def list():
             code
         )
 
-    return Response(
+    pastes, next_cursor = data
+
+    next_page = None
+    if next_cursor is not None:
+        next_page = url_for(
+            "list",
+            cursor=next_cursor,
+            back=back + [cursor or ""]
+        )
+
+    previous_page = None
+    if cursor is not None:
+        previous_page = url_for(
+            "list",
+            cursor=back[-1] if back else None,
+            back=back[:-1]
+        )
+
+    response = Response(
         render_template(
             "list.html",
-            pastes=data,
+            pastes=pastes,
+            next_page=next_page,
+            previous_page=previous_page,
             config=config,
             version=VERSION,
             page="list"
         )
     )
 
+    # The listing changes whenever a paste is created, so it must always be
+    # revalidated, but it is only sent again if it did change
+    response.add_etag()
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/search")
+def search():
+    searchFilters = {"visibility": "public"}
+    defaultFilters = {"visibility": "public"}
+
+    query = request.args.get("q") or ""
+    cursor = request.args.get("cursor") or None
+    back = request.args.getlist("back")
+
+    status, data, code = logic.search_pastes(
+        config,
+        query,
+        searchFilters,
+        defaultFilters,
+        cursor
+    )
+
+    if (status == "ERROR"):
+        return Response(
+            render_template(
+                "index.html",
+                config=config,
+                version=VERSION,
+                page="new",
+                error=data
+            ),
+            code
+        )
+
+    pastes, next_cursor = data
+
+    next_page = None
+    if next_cursor is not None:
+        next_page = url_for(
+            "search",
+            q=query,
+            cursor=next_cursor,
+            back=back + [cursor or ""]
+        )
+
+    previous_page = None
+    if cursor is not None:
+        previous_page = url_for(
+            "search",
+            q=query,
+            cursor=back[-1] if back else None,
+            back=back[:-1]
+        )
+
+    response = Response(
+        render_template(
+            "search.html",
+            query=query,
+            pastes=pastes,
+            next_page=next_page,
+            previous_page=previous_page,
+            config=config,
+            version=VERSION,
+            page="search"
+        )
+    )
+
+    # Like the listing, results change whenever a paste is created
+    response.add_etag()
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
 
 @app.route("/about")
 def about_tor_paste():
@@ -184,6 +468,92 @@ def about_tor_paste():
     )
 
 
+@app.route("/metrics")
+def metrics():
+    if config['METRICS'] is None:
+        return Response("Not Found", 404, mimetype="text/plain")
+
+    return Response(
+        config['METRICS'].registry.render(),
+        mimetype="text/plain; version=0.0.4",
+        headers={"Cache-Control": "no-store"}
+    )
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+# The process the reaper thread was started in, since forked processes each
+# start a reaper thread of their own, and the lock of the threads of a
+# process handling their first requests at the same time
+reaper_pid = None
+reaper_start_lock = threading.Lock()
+
+
+@app.before_request
+def start_reaper():
+    global reaper_pid
+    if config['REAPER_INTERVAL_SECONDS'] <= 0 or reaper_pid == os.getpid():
+        return
+    with reaper_start_lock:
+        if reaper_pid == os.getpid():
+            return
+        reaper_pid = os.getpid()
+
+    thread = threading.Thread(target=reap_periodically, daemon=True)
+    thread.start()
+
+
+def reap_periodically():
+    """
+    Deletes the pastes that have expired every REAPER_INTERVAL_SECONDS.
+    Only one of the processes of a machine does so, the one holding the
+    reaper lock, and the thread of another one takes over when it exits.
+    """
+    # The file is opened by every process, since the processes forked after
+    # opening it would share a single flock lock
+    fd = os.open(config['REAPER_LOCK_PATH'], os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+    while True:
+        time.sleep(config['REAPER_INTERVAL_SECONDS'])
+        try:
+            logic.reap_expired_pastes(config)
+        except Exception:
+            # The backend may be unavailable for a while, and the pastes
+            # that have expired are not shown in the meantime anyway
+            pass
+
+
+@app.after_request
+def record_request_metrics(response):
+    if config['METRICS'] is None or "request_start" not in g:
+        return response
+
+    # Requests are labelled with the route rule and not with the URL, so
+    # that every paste does not get a series of its own
+    route = request.url_rule.rule if request.url_rule else "none"
+    config['METRICS'].request_duration.observe(
+        time.perf_counter() - g.request_start, route, request.method)
+    config['METRICS'].requests.inc(
+        route, request.method, str(response.status_code))
+    return response
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def record_render_metrics(sender, template, context, **extra):
+    if config['METRICS'] is not None and "render_start" in g:
+        config['METRICS'].render_duration.observe(
+            time.perf_counter() - g.render_start, template.name)
+
+
 @app.after_request
 def additional_headers(response):
     response.headers["X-Frame-Options"] = "DENY"
@@ -231,6 +601,18 @@ def load_config():
         )
         exit(1)
 
+    # Directory holding the metrics of all TorPaste processes on this
+    # machine, which are exposed on /metrics if set
+    METRICS_DIR = getenv("TP_METRICS_DIR") or ""
+
+    METRICS = None
+    if METRICS_DIR:
+        try:
+            METRICS = Metrics(METRICS_DIR)
+        except OSError:
+            print("Failed to set up the metrics directory " + METRICS_DIR)
+            exit(1)
+
     # Maximum Paste Size
     MAX_PASTE_SIZE = getenv("TP_PASTE_MAX_SIZE") or "1 P"
 
@@ -257,11 +639,149 @@ def load_config():
         print("An unknown error occured while determining max paste size.")
         exit(1)
 
+    # Compression of the paste content in the backend
+    COMPRESSION = getenv("TP_COMPRESSION") or ""
+
+    if COMPRESSION:
+        try:
+            b = CompressionLayer(b, COMPRESSION)
+        except ValueError as ex:
+            print("Invalid TP_COMPRESSION: " + str(ex))
+            exit(1)
+
+    # Enable the full-text search of the public pastes, which the backends
+    # that cannot search pastes themselves do with an index kept on this
+    # machine
+    SEARCH_ACTIVE = getenv("TP_SEARCH_ACTIVE") in ["True", "true", "1"]
+
+    SEARCH_INDEX_PATH = getenv("TP_SEARCH_INDEX_PATH") or \
+        "search-index.sqlite"
+    SEARCH_INDEX_REFRESH_SECONDS = \
+        getenv("TP_SEARCH_INDEX_REFRESH_SECONDS") or "3600"
+
+    try:
+        SEARCH_INDEX_REFRESH_SECONDS = int(SEARCH_INDEX_REFRESH_SECONDS)
+    except ValueError:
+        print("Invalid TP_SEARCH_INDEX_REFRESH_SECONDS: " +
+              SEARCH_INDEX_REFRESH_SECONDS)
+        exit(1)
+
+    if SEARCH_ACTIVE and not hasattr(b, "search_paste_ids"):
+        try:
+            b = SearchIndexLayer(
+                b,
+                SEARCH_INDEX_PATH,
+                SEARCH_INDEX_REFRESH_SECONDS
+            )
+        except OSError:
+            print("Failed to set up the search index at " + SEARCH_INDEX_PATH)
+            exit(1)
+
+    # Size of the cache of recently viewed pastes shared by all TorPaste
+    # processes on this machine, in bytes
+    SHARED_CACHE_BYTES = getenv("TP_SHARED_CACHE_BYTES") or "0"
+    SHARED_CACHE_SLOT_BYTES = getenv("TP_SHARED_CACHE_SLOT_BYTES") or "65536"
+    SHARED_CACHE_PATH = getenv("TP_SHARED_CACHE_PATH") or \
+        "/dev/shm/torpaste-cache"
+
+    try:
+        SHARED_CACHE_BYTES = int(SHARED_CACHE_BYTES)
+        SHARED_CACHE_SLOT_BYTES = int(SHARED_CACHE_SLOT_BYTES)
+    except ValueError:
+        print("Invalid TP_SHARED_CACHE_BYTES or TP_SHARED_CACHE_SLOT_BYTES")
+        exit(1)
+
+    if SHARED_CACHE_BYTES > 0:
+        try:
+            b = SharedCache(
+                b,
+                SHARED_CACHE_PATH,
+                SHARED_CACHE_BYTES,
+                SHARED_CACHE_SLOT_BYTES
+            )
+        except (OSError, ValueError):
+            print("Failed to set up the shared cache at " + SHARED_CACHE_PATH)
+            exit(1)
+        if METRICS is not None:
+            b.on_lookup = METRICS.cache_lookup("shared")
+
+    # Size of the in-process cache of recently viewed pastes, in bytes
+    CACHE_MAX_BYTES = getenv("TP_CACHE_MAX_BYTES") or "0"
+
+    try:
+        CACHE_MAX_BYTES = int(CACHE_MAX_BYTES)
+    except ValueError:
+        print("Invalid TP_CACHE_MAX_BYTES: " + CACHE_MAX_BYTES)
+        exit(1)
+
+    if CACHE_MAX_BYTES > 0:
+        b = MemoryCache(b, CACHE_MAX_BYTES)
+        if METRICS is not None:
+            b.on_lookup = METRICS.cache_lookup("memory")
+
+    # Number of pastes the filter of the IDs of all pastes, shared by all
+    # TorPaste processes on this machine, is sized for
+    BLOOM_FILTER_CAPACITY = getenv("TP_BLOOM_FILTER_CAPACITY") or "0"
+    BLOOM_FILTER_REBUILD_SECONDS = \
+        getenv("TP_BLOOM_FILTER_REBUILD_SECONDS") or "3600"
+    BLOOM_FILTER_PATH = getenv("TP_BLOOM_FILTER_PATH") or \
+        BLOOM_FILTER_DEFAULT_PATH
+
+    try:
+        BLOOM_FILTER_CAPACITY = int(BLOOM_FILTER_CAPACITY)
+        BLOOM_FILTER_REBUILD_SECONDS = int(BLOOM_FILTER_REBUILD_SECONDS)
+    except ValueError:
+        print("Invalid TP_BLOOM_FILTER_CAPACITY or " +
+              "TP_BLOOM_FILTER_REBUILD_SECONDS")
+        exit(1)
+
+    if BLOOM_FILTER_CAPACITY > 0:
+        try:
+            b = BloomFilterLayer(
+                b,
+                BLOOM_FILTER_PATH,
+                BLOOM_FILTER_CAPACITY,
+                BLOOM_FILTER_REBUILD_SECONDS
+            )
+        except (OSError, ValueError):
+            print("Failed to set up the Bloom filter at " + BLOOM_FILTER_PATH)
+            exit(1)
+
+    if METRICS is not None:
+        b = InstrumentationLayer(
+            b, METRICS.backend_duration, METRICS.backend_errors)
+
+    # Size of the cache of rendered paste pages of each TorPaste process
+    RENDER_CACHE_MAX_BYTES = getenv("TP_RENDER_CACHE_MAX_BYTES") or "0"
+
+    try:
+        RENDER_CACHE_MAX_BYTES = int(RENDER_CACHE_MAX_BYTES)
+    except ValueError:
+        print("Invalid TP_RENDER_CACHE_MAX_BYTES: " + RENDER_CACHE_MAX_BYTES)
+        exit(1)
+
+    RENDER_CACHE = None
+    if RENDER_CACHE_MAX_BYTES > 0:
+        RENDER_CACHE = RenderCache(RENDER_CACHE_MAX_BYTES)
+
     # Disable the paste listing feature
     PASTE_LIST_ACTIVE = getenv("TP_PASTE_LIST_ACTIVE") or True
     if PASTE_LIST_ACTIVE in ["False", "false", 0, "0"]:
         PASTE_LIST_ACTIVE = False
 
+    # Number of pastes in each page of the paste listing
+    PASTE_LIST_PAGE_SIZE = getenv("TP_PASTE_LIST_PAGE_SIZE") or "100"
+
+    try:
+        PASTE_LIST_PAGE_SIZE = int(PASTE_LIST_PAGE_SIZE)
+    except ValueError:
+        PASTE_LIST_PAGE_SIZE = 0
+
+    if PASTE_LIST_PAGE_SIZE < 1:
+        print("Invalid TP_PASTE_LIST_PAGE_SIZE: " +
+              getenv("TP_PASTE_LIST_PAGE_SIZE"))
+        exit(1)
+
     # Content Security Policy Handling
     CSP_REPORT_URI = getenv("TP_CSP_REPORT_URI") or False
 
@@ -281,12 +801,71 @@ def load_config():
         print("No valid visibilities found for pastes.")
         exit(1)
 
+    # control the enabled paste expiries, the first one being the default:
+    # never = the paste is kept forever
+    # hour, day, week, month = the paste is deleted after that long
+    expiryEnv = "TP_ENABLED_PASTE_EXPIRIES"
+    ENABLED_PASTE_EXPIRIES = getenv(expiryEnv) or \
+        ",".join(AVAILABLE_EXPIRIES)
+    ENABLED_PASTE_EXPIRIES = ENABLED_PASTE_EXPIRIES.replace(' ', '')
+    ENABLED_PASTE_EXPIRIES = OrderedDict(
+        (expiry, AVAILABLE_EXPIRIES[expiry])
+        for expiry in ENABLED_PASTE_EXPIRIES.split(',')
+        if expiry in AVAILABLE_EXPIRIES)
+
+    if len(ENABLED_PASTE_EXPIRIES) == 0:
+        print("No valid expiries found for pastes.")
+        exit(1)
+
+    # How often the pastes that have expired are deleted, in seconds, and
+    # how many are looked up at once
+    REAPER_INTERVAL_SECONDS = getenv("TP_REAPER_INTERVAL_SECONDS") or "60"
+    REAPER_BATCH_SIZE = getenv("TP_REAPER_BATCH_SIZE") or "100"
+
+    try:
+        REAPER_INTERVAL_SECONDS = int(REAPER_INTERVAL_SECONDS)
+        REAPER_BATCH_SIZE = int(REAPER_BATCH_SIZE)
+    except ValueError:
+        REAPER_BATCH_SIZE = 0
+
+    if REAPER_BATCH_SIZE < 1:
+        print("Invalid TP_REAPER_INTERVAL_SECONDS or TP_REAPER_BATCH_SIZE")
+        exit(1)
+
+    # The file locked by the process deleting the expired pastes, shared by
+    # all TorPaste processes on this machine using the same data
+    REAPER_LOCK_PATH = getenv("TP_REAPER_LOCK_PATH")
+    if not REAPER_LOCK_PATH and hasattr(b, "get_data_path"):
+        try:
+            REAPER_LOCK_PATH = b.get_data_path() + ".reaper.lock"
+        except b.e.ErrorException:
+            # Reported when the backend is initialized
+            pass
+    REAPER_LOCK_PATH = REAPER_LOCK_PATH or "torpaste-reaper.lock"
+
+    if REAPER_INTERVAL_SECONDS > 0:
+        try:
+            os.close(os.open(
+                REAPER_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600))
+        except OSError:
+            print("Failed to set up the reaper lock at " + REAPER_LOCK_PATH)
+            exit(1)
+
     return {
         "MAX_PASTE_SIZE": MAX_PASTE_SIZE,
+        "COMPRESSION": COMPRESSION,
+        "RENDER_CACHE": RENDER_CACHE,
+        "METRICS": METRICS,
         "WEBSITE_TITLE": WEBSITE_TITLE,
         "PASTE_LIST_ACTIVE": PASTE_LIST_ACTIVE,
+        "PASTE_LIST_PAGE_SIZE": PASTE_LIST_PAGE_SIZE,
+        "SEARCH_ACTIVE": SEARCH_ACTIVE,
         "CSP_REPORT_URI": CSP_REPORT_URI,
         "ENABLED_PASTE_VISIBILITIES": ENABLED_PASTE_VISIBILITIES,
+        "ENABLED_PASTE_EXPIRIES": ENABLED_PASTE_EXPIRIES,
+        "REAPER_INTERVAL_SECONDS": REAPER_INTERVAL_SECONDS,
+        "REAPER_BATCH_SIZE": REAPER_BATCH_SIZE,
+        "REAPER_LOCK_PATH": REAPER_LOCK_PATH,
         "b": b
     }
 
@@ -301,6 +880,15 @@ except Exception:
     print("Failed to initialize backend")
     exit(1)
 
+# The backends that search pastes themselves only index them if searching
+# is enabled
+if config['SEARCH_ACTIVE'] and hasattr(b, "initialize_search"):
+    try:
+        b.initialize_search()
+    except Exception:
+        print("Failed to initialize the search of the backend")
+        exit(1)
+
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0")